@@ -1,28 +1,60 @@
 from fastapi import (
-    APIRouter, UploadFile, File, Form, HTTPException, Request,
+    APIRouter, BackgroundTasks, HTTPException, Request, Response,
     Security, Query as FastAPIQuery, status
 )
 from typing import Optional, Dict, Any, List
-from datetime import datetime
+from datetime import datetime, timezone
 from pydantic import BaseModel, Field
-from tempfile import NamedTemporaryFile
+from fastapi.responses import FileResponse, StreamingResponse
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+import asyncio
+import hashlib
 import uuid
 import json
+import time
 import os
-import shutil
 
 from security import get_api_key
+from executor import run_storage
+from uploads import stream_multipart, discard, UploadError
+from query import compile_query, describe_plan
+from metrics import DERIVATIVE_RENDER_SECONDS, DERIVATIVE_REQUESTS
+import imaging
 from storage import (
-    save_uploadfile,
-    insert_file_metadata,
+    get_upload_dir,
+    get_record_path,
+    store_record,
+    store_records,
     get_file_metadata_by_id,
-    remove_file_metadata,
+    delete_record as delete_record_helper,
     update_metadata as update_metadata_helper,
+    set_metadata_fields,
     settings,
     create_bucket as create_bucket_helper,
+    BucketDeleting,
     delete_bucket as delete_bucket_helper,
+    purge_deleted_bucket,
     list_buckets as list_buckets_helper,
-    search_metadata
+    list_bucket_stats,
+    get_bucket_stats as get_bucket_stats_helper,
+    search_metadata,
+    search_text,
+    get_records,
+    delete_records,
+    patch_records,
+    add_metadata_index,
+    remove_metadata_index,
+    list_metadata_indexes,
+    query_records,
+    get_changes,
+    ChangesExpired,
+    create_webhook as create_webhook_helper,
+    list_webhooks as list_webhooks_helper,
+    delete_webhook as delete_webhook_helper,
+    get_derivative_path,
+    get_derivative,
+    add_derivative
 )
 
 router = APIRouter(prefix="/api/v1")
@@ -50,21 +82,138 @@ class FileRecord(BaseModel):
     upload_time: Optional[datetime] = None
     created_at: Optional[datetime] = None
     updated_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
 
 class FileRecordSummary(BaseModel):
     """Summary information of a file record for listings."""
     id: str
     file_url: str
 
+class BucketStats(BaseModel):
+    """Record count, stored bytes and earliest expiry of a bucket."""
+    bucket: str
+    record_count: int
+    total_bytes: int
+    next_expiry: Optional[datetime] = None
+    expiring_soon: Optional[int] = None
+
 class BucketListResponse(BaseModel):
-    """List of bucket names."""
+    """List of bucket names, with their statistics when requested."""
     buckets: List[str]
+    stats: Optional[List[BucketStats]] = None
+
+class BatchUploadItem(BaseModel):
+    """Outcome of one file in a batch upload."""
+    filename: str
+    status: str = Field(..., example="created")
+    id: Optional[str] = None
+    file_url: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchUploadResponse(BaseModel):
+    """Per-file results of a batch upload."""
+    created: int
+    failed: int
+    items: List[BatchUploadItem]
+
+class MetadataIndexListResponse(BaseModel):
+    """Metadata keys indexed for a bucket."""
+    bucket: str
+    keys: List[str]
 
 class MetadataFieldUpdate(BaseModel):
     """Request body for updating a single metadata field."""
     key: str
     value: Any
 
+class MetadataFieldsUpdate(BaseModel):
+    """Request body for updating several metadata fields at once."""
+    fields: Dict[str, Any]
+
+class MetadataFilter(BaseModel):
+    """Typed metadata equality filter, as in the records search."""
+    key: str
+    value: Any
+    value_type: str = Field("string", pattern="^(string|boolean|number|datetime)$")
+
+class RecordSelection(BaseModel):
+    """Records addressed by a list of ids, a metadata filter, or both."""
+    ids: Optional[List[str]] = None
+    filter: Optional[MetadataFilter] = None
+
+class BatchPatchRequest(RecordSelection):
+    """Metadata merge patch applied to the selected records; a null value removes the key."""
+    metadata: Dict[str, Any]
+
+class BatchGetResponse(BaseModel):
+    """Records found by a batch get, and requested ids that were not found."""
+    records: List[FileRecord]
+    missing: List[str] = []
+
+class BatchCountResponse(BaseModel):
+    """Number of records affected by a batch operation."""
+    count: int
+
+class RecordQuery(BaseModel):
+    """Filter (AND/OR/NOT over metadata keys and record fields) and ordering of a records query."""
+    filter: Optional[Dict[str, Any]] = Field(None, example={
+        "and": [
+            {"key": "status", "in": ["draft", "review"]},
+            {"key": "pages", "between": [10, 200]},
+            {"or": [{"key": "due", "lt": "2025-01-01", "type": "datetime"}, {"key": "urgent", "exists": True}]},
+        ]
+    })
+    order_by: Optional[List[Dict[str, Any]]] = Field(None, example=[{"key": "pages", "desc": True}])
+    limit: int = Field(50, ge=1, le=1000)
+    cursor: Optional[str] = None
+    explain: bool = False
+
+class QueryPlan(BaseModel):
+    """How SQLite runs a records query."""
+    indexes: List[str]
+    full_scan: bool
+    sorts_in_temp_btree: bool
+    suggestions: List[str]
+    details: List[str]
+
+class RecordQueryResponse(BaseModel):
+    """One page of records matching a query."""
+    records: List[FileRecord]
+    next_cursor: Optional[str] = None
+    plan: Optional[QueryPlan] = None
+
+class Change(BaseModel):
+    """One entry of a bucket's change feed."""
+    seq: int
+    bucket: str
+    id: Optional[str] = Field(None, description="Record id; absent for bucket_delete")
+    op: str = Field(..., description="create, update, delete, expire or bucket_delete")
+    at: datetime
+
+class ChangesResponse(BaseModel):
+    """Changes after the requested position, and where to continue from."""
+    changes: List[Change]
+    next_since: int
+
+class WebhookCreate(BaseModel):
+    """A webhook subscription to a bucket's record events."""
+    url: str = Field(..., example="https://example.com/hooks/filenest")
+    events: Optional[List[str]] = Field(None, example=["create", "expire"],
+                                        description="create, update, delete, expire, bucket_delete; all by default")
+    secret: Optional[str] = Field(None, description="Signing secret; generated when omitted")
+
+class Webhook(BaseModel):
+    """A webhook subscription and the state of its deliveries."""
+    id: str
+    bucket: str
+    url: str
+    events: List[str]
+    created_at: datetime
+    secret: Optional[str] = Field(None, description="Only returned when the subscription is created")
+    pending: Optional[int] = None
+    failed: Optional[int] = None
+    last_error: Optional[str] = None
+
 # -------------------------------
 # Utility Functions
 # -------------------------------
@@ -77,54 +226,175 @@ def validate_filename(filename: str) -> str:
     """
     return filename.replace("..", "")
 
+def record_file_url(request: Request, record: Dict[str, Any]) -> str:
+    """Public URL of a record's bytes under the /files mount."""
+    relative = os.path.relpath(get_record_path(record), settings.STORAGE_DIR)
+    return f"{request.base_url}files/{relative}"
+
+def record_details(request: Request, record: Dict[str, Any]) -> Dict[str, Any]:
+    """FileRecord fields for a storage record."""
+    return {
+        "id": record["id"],
+        "file_url": record_file_url(request, record),
+        "metadata": record.get("metadata"),
+        "ttl_seconds": record.get("ttl_seconds"),
+        "upload_time": record.get("upload_time"),
+        "created_at": record.get("created_at"),
+        "updated_at": record.get("updated_at"),
+        "expires_at": record.get("expires_at")
+    }
+
 # -------------------------------
 # Bucket Routes
 # -------------------------------
 
 @router.post("/buckets/{bucket}", response_model=StatusResponse, tags=["Buckets"])
-def create_bucket(bucket: str, api_key: str = Security(get_api_key)):
+async def create_bucket(bucket: str, api_key: str = Security(get_api_key)):
     """
     Create a new bucket with the specified name.
 
-    - Returns 409 Conflict if the bucket already exists.
+    - Returns 409 Conflict if the bucket already exists or is still being deleted.
     - Bucket names should be unique.
     """
-    create_bucket_helper(bucket)
+    try:
+        await run_storage(create_bucket_helper, bucket)
+    except FileExistsError as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
     return {"status": "success", "message": f"Bucket '{bucket}' created."}
 
-@router.get("/buckets", response_model=BucketListResponse, tags=["Buckets"])
-def list_buckets(api_key: str = Security(get_api_key)):
+def bucket_stats_details(stats: Dict[str, Any]) -> Dict[str, Any]:
+    """BucketStats fields for a storage stats row."""
+    return {
+        "bucket": stats["bucket"],
+        "record_count": stats["record_count"],
+        "total_bytes": stats["total_bytes"],
+        "next_expiry": stats["min_expires_at"],
+        "expiring_soon": stats.get("expiring_soon"),
+    }
+
+@router.get("/buckets", response_model=BucketListResponse, response_model_exclude_none=True, tags=["Buckets"])
+async def list_buckets(
+    stats: bool = FastAPIQuery(False, description="Include per-bucket record count, bytes and next expiry"),
+    api_key: str = Security(get_api_key)
+):
     """
     List all existing buckets.
 
+    - **stats**: Also return each bucket's statistics, read from incrementally maintained counters.
+
     Returns a list of bucket names.
     """
-    return {"buckets": list_buckets_helper()}
+    if stats:
+        bucket_stats = [bucket_stats_details(row) for row in await run_storage(list_bucket_stats)]
+        return {"buckets": [row["bucket"] for row in bucket_stats], "stats": bucket_stats}
+    return {"buckets": await run_storage(list_buckets_helper)}
+
+@router.get("/buckets/{bucket}/stats", response_model=BucketStats, response_model_exclude_none=True, tags=["Buckets"])
+async def get_bucket_stats(
+    bucket: str,
+    within: int = FastAPIQuery(3600, ge=0, description="Window in seconds for counting records expiring soon"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    Statistics of a bucket: record count, total bytes, next expiry and records expiring within `within` seconds.
+
+    - Returns 404 if the bucket does not exist.
+    """
+    stats = await run_storage(get_bucket_stats_helper, bucket, expiring_within=within)
+    if stats is None:
+        raise HTTPException(404, detail="Bucket not found")
+    return bucket_stats_details(stats)
 
 @router.delete("/buckets/{bucket}", status_code=status.HTTP_204_NO_CONTENT, tags=["Buckets"])
-def delete_bucket(bucket: str, api_key: str = Security(get_api_key)):
+async def delete_bucket(bucket: str, background_tasks: BackgroundTasks, api_key: str = Security(get_api_key)):
     """
     Delete the specified bucket and all its contents.
 
+    The bucket disappears immediately; its records and files are removed in the background
+    (by the reaper, or right after the response when it is disabled), and its name cannot be
+    reused until that finishes.
+
     - Returns 404 if the bucket does not exist.
     """
     try:
-        delete_bucket_helper(bucket)
+        await run_storage(delete_bucket_helper, bucket)
     except ValueError as e:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail=str(e))
+    if settings.CLEANUP_INTERVAL_SEC <= 0:
+        # There is no reaper to wake up
+        background_tasks.add_task(purge_deleted_bucket, bucket)
     return None
 
+@router.get("/buckets/{bucket}/indexes", response_model=MetadataIndexListResponse, tags=["Buckets"])
+async def list_indexes(bucket: str, api_key: str = Security(get_api_key)):
+    """
+    List the metadata keys declared as indexed for the bucket.
+    """
+    return {"bucket": bucket, "keys": await run_storage(list_metadata_indexes, bucket)}
+
+@router.put("/buckets/{bucket}/indexes/{key}", response_model=StatusResponse, tags=["Buckets"])
+async def create_index(bucket: str, key: str, api_key: str = Security(get_api_key)):
+    """
+    Declare a metadata key as indexed for the bucket.
+
+    - Searches on this key (`GET /buckets/{bucket}/records?key=...`) are served by an index instead of a bucket scan.
+    - Returns 400 if the key cannot be indexed.
+    """
+    try:
+        await run_storage(add_metadata_index, bucket, key)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    return {"status": "success", "message": f"Metadata key '{key}' indexed for bucket '{bucket}'."}
+
+@router.delete("/buckets/{bucket}/indexes/{key}", response_model=StatusResponse, tags=["Buckets"])
+async def delete_index(bucket: str, key: str, api_key: str = Security(get_api_key)):
+    """
+    Remove an indexed metadata key declaration from the bucket.
+
+    - Returns 404 if the key is not indexed for the bucket.
+    """
+    if not await run_storage(remove_metadata_index, bucket, key):
+        raise HTTPException(404, detail="Index not found")
+    return {"status": "success", "message": f"Metadata key '{key}' no longer indexed for bucket '{bucket}'."}
+
 # -------------------------------
 # Records Routes
 # -------------------------------
 
-@router.post("/buckets/{bucket}/records/", response_model=FileUploadResponse, tags=["Records"])
+_RECORD_UPLOAD_FORM = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "ttl_seconds": {"type": "integer"},
+                        "metadata_json": {"type": "string"},
+                    },
+                }
+            }
+        },
+    }
+}
+
+def parse_ttl(value: Optional[str]) -> int:
+    """TTL form value in seconds; defaults to 3600 when omitted or negative."""
+    if value is None or value == "":
+        return 3600
+    try:
+        ttl = int(value)
+    except ValueError:
+        raise HTTPException(400, detail="Invalid ttl_seconds")
+    return ttl if ttl >= 0 else 3600
+
+@router.post("/buckets/{bucket}/records/", response_model=FileUploadResponse, tags=["Records"],
+             openapi_extra=_RECORD_UPLOAD_FORM)
 async def create_record(
     bucket: str,
     request: Request,
-    file: UploadFile = File(...),
-    ttl_seconds: Optional[int] = Form(None),
-    metadata_json: Optional[str] = Form(None),
     api_key: str = Security(get_api_key)
 ):
     """
@@ -136,82 +406,328 @@ async def create_record(
     - **metadata_json**: Optional JSON string with additional metadata for the file.
     - **api_key**: API key for authorization.
 
+    The file is streamed into the bucket's upload directory and renamed into place, so it is written to disk once.
+    Returns 413 if the file exceeds the maximum upload size.
+
     Returns the ID and accessible URL of the uploaded file.
     """
-    create_bucket_helper(bucket, exist_ok=True)
-    ttl = ttl_seconds if ttl_seconds is not None and ttl_seconds >= 0 else 3600
+    try:
+        await run_storage(create_bucket_helper, bucket, exist_ok=True)
+    except BucketDeleting as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
+    try:
+        fields, files = await stream_multipart(request, get_upload_dir(bucket), settings.MAX_FILE_SIZE,
+                                               checksum=settings.CONTENT_ADDRESSED_STORAGE)
+    except UploadError as e:
+        raise HTTPException(e.status_code, detail=str(e))
 
-    file_id = str(uuid.uuid4())
-    safe_filename = validate_filename(file.filename)
-    temp_file = NamedTemporaryFile(delete=False)
-    await save_uploadfile(file, temp_file.name)
+    upload = next((f for f in files if f.field == "file"), None)
+    await discard(f for f in files if f is not upload)
+    if upload is None:
+        raise HTTPException(400, detail="Missing file")
 
-    metadata = None
-    if metadata_json:
-        try:
-            metadata = json.loads(metadata_json)
-        except json.JSONDecodeError:
-            os.remove(temp_file.name)
-            raise HTTPException(400, detail="Invalid JSON metadata")
+    try:
+        ttl = parse_ttl(fields.get("ttl_seconds"))
+        metadata = None
+        if fields.get("metadata_json"):
+            try:
+                metadata = json.loads(fields["metadata_json"])
+            except json.JSONDecodeError:
+                raise HTTPException(400, detail="Invalid JSON metadata")
+    except HTTPException:
+        await discard([upload])
+        raise
 
+    file_id = str(uuid.uuid4())
+    safe_filename = validate_filename(upload.filename)
     try:
-        insert_file_metadata(file_id, safe_filename, bucket, ttl, metadata)
+        stored = await run_storage(store_record, file_id, safe_filename, bucket, ttl, metadata, upload.path,
+                                   upload.size, upload.sha256)
+    except BucketDeleting as e:
+        await discard([upload])
+        raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
     except Exception as e:
-        os.remove(temp_file.name)
+        await discard([upload])
         raise HTTPException(500, detail=f"Failed to save metadata: {str(e)}")
 
-    final_path = os.path.join(settings.STORAGE_DIR, bucket, safe_filename)
-    os.makedirs(os.path.dirname(final_path), exist_ok=True)
-    shutil.move(temp_file.name, final_path)
+    record = {"bucket": bucket, "filename": safe_filename, **stored}
+    return {"id": file_id, "file_url": record_file_url(request, record)}
 
-    return {"id": file_id, "file_url": f"{request.base_url}files/{bucket}/{safe_filename}"}
+_BATCH_UPLOAD_FORM = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["files"],
+                    "properties": {
+                        "files": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                        "ttl_seconds": {"type": "integer"},
+                        "manifest": {"type": "string"},
+                    },
+                }
+            }
+        },
+    }
+}
+
+@router.post("/buckets/{bucket}/records/batch", response_model=BatchUploadResponse, tags=["Records"],
+             openapi_extra=_BATCH_UPLOAD_FORM)
+async def create_records_batch(
+    bucket: str,
+    request: Request,
+    api_key: str = Security(get_api_key)
+):
+    """
+    Upload many files to the specified bucket in one request.
+
+    - **files**: Any number of file parts (up to `BATCH_MAX_FILES`).
+    - **ttl_seconds**: Optional default TTL for every file (same rules as a single upload).
+    - **manifest**: Optional JSON object keyed by filename, giving per-file `metadata` and `ttl_seconds`,
+      e.g. `{"a.png": {"metadata": {"author": "me"}, "ttl_seconds": 0}}`.
+
+    All records are inserted in a single transaction. Files that are too large or have an invalid
+    manifest entry are reported as errors without failing the rest of the batch.
+    Returns 413 if the request contains too many files.
+    """
+    try:
+        await run_storage(create_bucket_helper, bucket, exist_ok=True)
+    except BucketDeleting as e:
+        raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
+    try:
+        fields, files = await stream_multipart(request, get_upload_dir(bucket), settings.MAX_FILE_SIZE,
+                                               checksum=settings.CONTENT_ADDRESSED_STORAGE,
+                                               max_files=settings.BATCH_MAX_FILES)
+    except UploadError as e:
+        raise HTTPException(e.status_code, detail=str(e))
+
+    try:
+        default_ttl = parse_ttl(fields.get("ttl_seconds"))
+        manifest = json.loads(fields["manifest"]) if fields.get("manifest") else {}
+        if not isinstance(manifest, dict):
+            raise HTTPException(400, detail="Manifest must be a JSON object keyed by filename")
+    except json.JSONDecodeError:
+        await discard(files)
+        raise HTTPException(400, detail="Invalid JSON manifest")
+    except HTTPException:
+        await discard(files)
+        raise
+
+    results = []
+    items = []
+    for upload in files:
+        entry = manifest.get(upload.filename) or {}
+        if not upload.error and not isinstance(entry, dict):
+            upload.error = "Manifest entry must be an object"
+        if not upload.error:
+            try:
+                ttl = default_ttl if entry.get("ttl_seconds") is None else parse_ttl(str(entry["ttl_seconds"]))
+            except HTTPException as e:
+                upload.error = e.detail
+        if upload.error:
+            await discard([upload])
+            results.append({"filename": upload.filename, "status": "error", "error": upload.error})
+            continue
+        item = {
+            "id": str(uuid.uuid4()),
+            "filename": validate_filename(upload.filename),
+            "ttl_seconds": ttl,
+            "metadata": entry.get("metadata"),
+            "temp_path": upload.path,
+            "size": upload.size,
+            "sha256": upload.sha256,
+        }
+        items.append(item)
+        results.append(item)
+
+    if items:
+        try:
+            await run_storage(store_records, bucket, items)
+        except BucketDeleting as e:
+            await discard(f for f in files if not f.error)
+            raise HTTPException(status.HTTP_409_CONFLICT, detail=str(e))
+        except Exception as e:
+            await discard(f for f in files if not f.error)
+            raise HTTPException(500, detail=f"Failed to save metadata: {str(e)}")
+
+    response_items = []
+    for result in results:
+        if result.get("status") == "error":
+            response_items.append(result)
+        elif "error" in result:
+            # The file could not be moved into place, so no record was created for it
+            await discard(f for f in files if f.path == result["temp_path"])
+            response_items.append({"filename": result["filename"], "status": "error", "error": result["error"]})
+        else:
+            response_items.append({
+                "filename": result["filename"],
+                "status": "created",
+                "id": result["id"],
+                "file_url": record_file_url(request, {
+                    "bucket": bucket, "filename": result["filename"], "blob": result["blob"], "location": result["location"]
+                }),
+            })
+    created = sum(1 for item in response_items if item["status"] == "created")
+    return {"created": created, "failed": len(results) - created, "items": response_items}
 
 @router.get("/buckets/{bucket}/records/{record_id}", response_model=FileRecord, tags=["Records"])
-def get_record(bucket: str, record_id: str, request: Request, api_key: str = Security(get_api_key)):
+async def get_record(bucket: str, record_id: str, request: Request, api_key: str = Security(get_api_key)):
     """
     Retrieve detailed metadata and info for a single record by its ID in a bucket.
 
     - Returns 404 if the record is not found.
     """
-    record = get_file_metadata_by_id(record_id, bucket)
+    record = await run_storage(get_file_metadata_by_id, record_id, bucket)
     if not record:
         raise HTTPException(404, detail="Record not found")
-    return {
-        "id": record["id"],
-        "file_url": f"{request.base_url}files/{bucket}/{record['filename']}",
-        "metadata": record.get("metadata"),
-        "ttl_seconds": record.get("ttl_seconds"),
-        "upload_time": record.get("upload_time"),
-        "created_at": record.get("created_at"),
-        "updated_at": record.get("updated_at")
+    return record_details(request, record)
+
+class RecordContentResponse(FileResponse):
+    """FileResponse streaming in large fixed chunks when the server has no sendfile/pathsend support."""
+    chunk_size = 1024 * 1024
+
+def record_etag(record: Dict[str, Any], stat_result: os.stat_result) -> str:
+    """Strong ETag: the content digest for blobs, size and mtime for plain files."""
+    if record.get("blob"):
+        return f'"{record["blob"]}"'
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """Evaluate If-None-Match, falling back to If-Modified-Since, against the current representation."""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in candidates or etag in candidates
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def serve_file(path: str, headers: Dict[str, str], filename: str, stat_result: os.stat_result = None,
+               media_type: Optional[str] = None) -> Response:
+    """Stream a file under STORAGE_DIR, or hand it to nginx when X_ACCEL_REDIRECT_PREFIX is configured."""
+    if settings.X_ACCEL_REDIRECT_PREFIX:
+        relative = os.path.relpath(path, settings.STORAGE_DIR)
+        response = RecordContentResponse(path, headers=headers, media_type=media_type, filename=filename,
+                                         content_disposition_type="inline")
+        # nginx serves the bytes (with its own Range support) from the internal location
+        return Response(headers={
+            **headers,
+            "content-type": response.media_type,
+            "content-disposition": response.headers["content-disposition"],
+            "x-accel-redirect": settings.X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(relative),
+        })
+    return RecordContentResponse(path, headers=headers, media_type=media_type, filename=filename,
+                                 stat_result=stat_result, content_disposition_type="inline")
+
+@router.api_route("/buckets/{bucket}/records/{record_id}/content", methods=["GET", "HEAD"],
+                  response_class=RecordContentResponse, tags=["Records"])
+async def get_record_content(
+    bucket: str,
+    record_id: str,
+    request: Request,
+    w: Optional[int] = FastAPIQuery(None, ge=1, le=settings.THUMBNAIL_MAX_DIMENSION,
+                                    description="Scale an image to this width"),
+    h: Optional[int] = FastAPIQuery(None, ge=1, le=settings.THUMBNAIL_MAX_DIMENSION,
+                                    description="Scale an image to this height"),
+    format: str = FastAPIQuery("webp", pattern="^(webp|jpeg|png)$", description="Format of the scaled image"),
+    quality: int = FastAPIQuery(80, ge=1, le=100, description="Quality of a scaled WebP or JPEG image"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    Download the file of a record.
+
+    - Supports `Range` requests (206 Partial Content) so downloads can be resumed.
+    - Returns `ETag` and `Last-Modified`; `If-None-Match` / `If-Modified-Since` yield 304 Not Modified.
+    - When `X_ACCEL_REDIRECT_PREFIX` is configured, the transfer is handed off to nginx.
+    - **w** / **h**: Return the image scaled to fit within this width and/or height instead (never enlarged),
+      as **format** at **quality**. Renders are cached on disk; `X-Source-Width` and `X-Source-Height` give
+      the size of the original. Returns 415 if the file is not an image, 501 if Pillow is not installed.
+    - Returns 404 if the record or its file is not found.
+    """
+    record = await run_storage(get_file_metadata_by_id, record_id, bucket)
+    if not record:
+        raise HTTPException(404, detail="Record not found")
+    path = get_record_path(record)
+    try:
+        stat_result = await run_storage(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(404, detail="File not found")
+
+    etag = record_etag(record, stat_result)
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": "private, no-cache",
     }
+    if w is not None or h is not None:
+        return await get_derivative_content(record, path, stat_result, headers, request, w, h, format, quality)
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return serve_file(path, headers, record["filename"], stat_result)
+
+async def get_derivative_content(
+    record: Dict[str, Any], source: str, stat_result: os.stat_result, headers: Dict[str, str], request: Request,
+    width: Optional[int], height: Optional[int], format: str, quality: int
+) -> Response:
+    """Serve a scaled copy of a record's image, rendering it into the derivative cache on a miss."""
+    if not imaging.available():
+        raise HTTPException(501, detail="Image scaling needs Pillow, which is not installed")
+    quality = quality if format != "png" else None
+    # The key covers the content, so a replaced file never serves a stale render
+    options = [record["id"], headers["etag"], width, height, format, quality]
+    key = hashlib.sha256(json.dumps(options).encode()).hexdigest()
+    _, media_type, extension = imaging.FORMATS[format]
+    headers = {**headers, "etag": f'"{key[:32]}"'}
+    if is_not_modified(request, headers["etag"], stat_result.st_mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    path = get_derivative_path(key, extension)
+    source_size = await run_storage(get_derivative, key)
+    if source_size is not None and not await run_storage(os.path.exists, path):
+        source_size = None  # Removed behind our back; render it again
+    DERIVATIVE_REQUESTS.inc(result="hit" if source_size is not None else "miss")
+    if source_size is None:
+        try:
+            with DERIVATIVE_RENDER_SECONDS.time():
+                source_size = await imaging.render_pool.render(source, path, width, height, format, quality)
+        except imaging.ImagingError as e:
+            raise HTTPException(415, detail=str(e))
+        if not await run_storage(add_derivative, key, record["id"], extension, source_size):
+            raise HTTPException(404, detail="Record not found")
+
+    headers["x-source-width"], headers["x-source-height"] = (str(side) for side in source_size)
+    filename = f"{os.path.splitext(record['filename'])[0]}.{extension}"
+    return serve_file(path, headers, filename, media_type=media_type)
 
 @router.delete("/buckets/{bucket}/records/{record_id}", response_model=StatusResponse, tags=["Records"])
-def delete_record(bucket: str, record_id: str, api_key: str = Security(get_api_key)):
+async def delete_record(bucket: str, record_id: str, api_key: str = Security(get_api_key)):
     """
     Delete a record by ID from the specified bucket along with its file from storage.
 
     - Returns 404 if the record does not exist.
     """
-    record = get_file_metadata_by_id(record_id, bucket)
+    record = await run_storage(delete_record_helper, record_id, bucket)
     if not record:
         raise HTTPException(404, detail="Record not found")
 
-    remove_file_metadata(record_id, bucket)
-    file_path = os.path.join(settings.STORAGE_DIR, bucket, record['filename'])
-    if os.path.exists(file_path):
-        os.remove(file_path)
-
     return {"status": "success", "message": f"File '{record['filename']}' deleted."}
 
 @router.get("/buckets/{bucket}/records", response_model=List[FileRecordSummary], tags=["Records"])
-def list_or_search_records(
+async def list_or_search_records(
     bucket: str,
     request: Request,
+    response: Response,
     key: Optional[str] = FastAPIQuery(None, description="Metadata key to filter by"),
     value: Optional[str] = FastAPIQuery(None, description="Metadata value to filter by"),
-    value_type: str = FastAPIQuery("string", regex="^(string|boolean|number|datetime)$", description="Type of metadata value"),
+    value_type: str = FastAPIQuery("string", pattern="^(string|boolean|number|datetime)$", description="Type of metadata value"),
     limit: int = FastAPIQuery(50, ge=1, le=1000, description="Maximum number of records to return"),
+    cursor: Optional[str] = FastAPIQuery(None, description="Pagination cursor from a previous X-Next-Cursor header"),
+    q: Optional[str] = FastAPIQuery(None, description="Words to find in the filename or metadata values"),
     api_key: str = Security(get_api_key)
 ):
     """
@@ -220,30 +736,139 @@ def list_or_search_records(
     - **bucket**: Name of the bucket to search.
     - **key**: Metadata key to filter on.
     - **value**: Metadata value to match.
-    - **value_type**: Type of the metadata value (string, boolean, number, datetime).
-    - **limit**: Max number of records to return (default 50, max 1000).
-    - Returns a list of file record summaries with ID and URL.
+    - **value_type**: Type of the metadata value (string, boolean, number, datetime). A string search for `5` also finds the number 5, and a boolean search also finds the strings "true"/"false".
+    - **limit**: Max number of records to return per page (default 50, max 1000).
+    - **cursor**: Resume listing after the previous page.
+    - **q**: Full-text search: records whose filename or metadata string values contain every word, best matches first. End a word with `*` to match it as a prefix.
+    - Returns a list of file record summaries with ID and URL, ordered by creation time (by relevance with `q`).
+    - When more records are available, the `X-Next-Cursor` response header holds the cursor for the next page.
+    - Returns 400 if the key, value or cursor is invalid.
     """
-    records = search_metadata(bucket, key, value, value_type, limit)
+    try:
+        if q is not None:
+            records, next_cursor = await run_storage(search_text, bucket, q, key, value, value_type, limit, cursor)
+        else:
+            records, next_cursor = await run_storage(search_metadata, bucket, key, value, value_type, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return [
         FileRecordSummary(
             id=record["id"],
-            file_url=f"{request.base_url}files/{bucket}/{record['filename']}"
+            file_url=record_file_url(request, record)
         ) for record in records
     ]
 
+@router.post("/buckets/{bucket}/records/query", response_model=RecordQueryResponse, response_model_exclude_none=True,
+             tags=["Records"])
+async def query_records_route(bucket: str, query: RecordQuery, request: Request,
+                              api_key: str = Security(get_api_key)):
+    """
+    Find records with a compound filter, evaluated in SQLite.
+
+    - **filter**: A condition `{"key": "<metadata key>", "<op>": value}` (or `"field"`: filename, size,
+      created_at, updated_at, expires_at), or `{"and": [...]}`, `{"or": [...]}`, `{"not": {...}}`.
+      Operators: `eq`, `ne`, `gt`, `gte`, `lt`, `lte`, `between` ([low, high]), `in` ([values]), `exists` (true/false).
+      The value type follows the JSON value; add `"type": "datetime"` to compare metadata dates.
+    - **order_by**: Up to 4 `{"key" | "field": ..., "desc": true}` terms; creation time by default.
+    - **cursor**: `next_cursor` of the previous page.
+    - **explain**: Also return the query plan: the indexes used, whether the bucket is scanned, and metadata keys worth indexing.
+    - Returns 400 if the filter or ordering is invalid.
+    """
+    try:
+        compiled = compile_query(query.filter, query.order_by)
+        records, next_cursor, plan = await run_storage(
+            query_records, bucket, compiled.where, compiled.params, compiled.order_by, query.limit, query.cursor,
+            query.explain
+        )
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    result = {"records": [record_details(request, record) for record in records], "next_cursor": next_cursor}
+    if plan is not None:
+        result["plan"] = describe_plan(plan, compiled.keys, await run_storage(list_metadata_indexes, bucket))
+    return result
+
+# -------------------------------
+# Batch Routes
+# -------------------------------
+
+def selection_args(selection: RecordSelection) -> Dict[str, Any]:
+    """Storage selection arguments for a batch request; 400 unless it selects something."""
+    if selection.ids is None and selection.filter is None:
+        raise HTTPException(400, detail="Provide 'ids', 'filter' or both")
+    if selection.ids is not None and len(selection.ids) > settings.BATCH_MAX_IDS:
+        raise HTTPException(413, detail=f"Too many ids, the maximum is {settings.BATCH_MAX_IDS}")
+    args = {"ids": selection.ids}
+    if selection.filter:
+        args.update(key=selection.filter.key, value=selection.filter.value, value_type=selection.filter.value_type)
+    return args
+
+@router.post("/buckets/{bucket}/records/batch/get", response_model=BatchGetResponse, tags=["Records"])
+async def get_records_batch(
+    bucket: str,
+    selection: RecordSelection,
+    request: Request,
+    limit: int = FastAPIQuery(1000, ge=1, le=1000, description="Maximum number of records to return for a filter"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    Retrieve many records at once, by `ids` and/or a metadata `filter`.
+
+    - Ids that do not exist (or expired) are listed in `missing`.
+    - Returns 400 if neither ids nor filter is given, or the filter is invalid.
+    """
+    args = selection_args(selection)
+    try:
+        records = await run_storage(get_records, bucket, **args, limit=None if selection.ids is not None else limit)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    found = {record["id"] for record in records}
+    return {
+        "records": [record_details(request, record) for record in records],
+        "missing": [record_id for record_id in (selection.ids or []) if record_id not in found],
+    }
+
+@router.post("/buckets/{bucket}/records/batch/delete", response_model=BatchCountResponse, tags=["Records"])
+async def delete_records_batch(bucket: str, selection: RecordSelection, api_key: str = Security(get_api_key)):
+    """
+    Delete many records and their files at once, by `ids` and/or a metadata `filter`.
+
+    - Metadata is removed in a single transaction; files are then deleted in parallel.
+    - Returns the number of deleted records.
+    """
+    args = selection_args(selection)
+    try:
+        return {"count": await run_storage(delete_records, bucket, **args)}
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+@router.patch("/buckets/{bucket}/records/batch/metadata", response_model=BatchCountResponse, tags=["Metadata"])
+async def patch_records_batch(bucket: str, update: BatchPatchRequest, api_key: str = Security(get_api_key)):
+    """
+    Merge fields into the metadata of many records at once, by `ids` and/or a metadata `filter`.
+
+    - **metadata**: Fields to set; a `null` value removes the field (JSON merge patch).
+    - Runs as a single SQL UPDATE; returns the number of updated records.
+    """
+    args = selection_args(update)
+    try:
+        return {"count": await run_storage(patch_records, bucket, update.metadata, **args)}
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
 # -------------------------------
 # Metadata Routes
 # -------------------------------
 
 @router.put("/buckets/{bucket}/records/{record_id}/metadata", response_model=StatusResponse, tags=["Metadata"])
-def update_metadata(bucket: str, record_id: str, metadata: Dict[str, Any], api_key: str = Security(get_api_key)):
+async def update_metadata(bucket: str, record_id: str, metadata: Dict[str, Any], api_key: str = Security(get_api_key)):
     """
     Replace the entire metadata object for a given record.
 
     - Returns 404 if the file does not exist.
     """
-    if not update_metadata_helper(record_id, bucket, metadata):
+    if not await run_storage(update_metadata_helper, record_id, bucket, metadata):
         raise HTTPException(404, detail="File not found")
     return {"status": "success", "message": "Metadata updated."}
 
@@ -259,21 +884,174 @@ async def update_metadata_field(
 
     - **key**: Metadata field name to update.
     - **value**: New value for the field.
+    - The field is set atomically in SQL, so concurrent updates of other fields are never lost.
     - Returns 404 if the file is not found.
     - Returns 403 if API key is invalid.
     """
     if api_key != settings.API_KEY:
         raise HTTPException(status_code=403, detail="Invalid API Key")
 
-    record = get_file_metadata_by_id(record_id, bucket)
-    if not record:
+    try:
+        metadata = await run_storage(set_metadata_fields, record_id, bucket, {update.key: update.value})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if metadata is None:
         raise HTTPException(status_code=404, detail="File not found")
 
-    metadata = record.get("metadata", {})
-    metadata[update.key] = update.value
+    return {"message": "Metadata field updated", "metadata": metadata}
 
-    updated = update_metadata_helper(record_id, bucket, metadata)
-    if not updated:
-        raise HTTPException(status_code=500, detail="Failed to update metadata")
+@router.patch("/buckets/{bucket}/records/{record_id}/metadata/fields", tags=["Metadata"])
+async def update_metadata_fields(
+    bucket: str,
+    record_id: str,
+    update: MetadataFieldsUpdate,
+    api_key: str = Security(get_api_key),
+):
+    """
+    Update several metadata fields of a specific record in one atomic statement.
 
-    return {"message": "Metadata field updated", "metadata": metadata}
+    - **fields**: Object of field names to new values; other fields are left untouched.
+    - Returns the updated metadata.
+    - Returns 404 if the file is not found.
+    """
+    if not update.fields:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    try:
+        metadata = await run_storage(set_metadata_fields, record_id, bucket, update.fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if metadata is None:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    return {"message": "Metadata fields updated", "metadata": metadata}
+
+# -------------------------------
+# Change Feed Routes
+# -------------------------------
+
+def change_details(change: Dict[str, Any]) -> Dict[str, Any]:
+    return {**change, "at": datetime.fromtimestamp(change["at"], timezone.utc)}
+
+async def wait_for_changes(bucket: str, since: Optional[int], limit: int, wait: float):
+    """
+    Poll the feed until it has changes for the bucket or `wait` seconds pass. The
+    feed lives in SQLite and any worker may write to it, so it is polled rather
+    than signalled in-process.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        changes, next_since = await run_storage(get_changes, since, bucket, limit)
+        if changes or time.monotonic() >= deadline:
+            return changes, next_since
+        since = next_since
+        await asyncio.sleep(min(settings.CHANGES_POLL_INTERVAL_MS / 1000, max(0.0, deadline - time.monotonic())))
+
+@router.get("/buckets/{bucket}/changes", response_model=ChangesResponse, response_model_exclude_none=True,
+            tags=["Changes"])
+async def list_changes(
+    bucket: str,
+    since: Optional[int] = FastAPIQuery(None, ge=0, description="Position to resume from: the previous next_since"),
+    limit: int = FastAPIQuery(100, ge=1, le=1000, description="Maximum number of changes to return"),
+    wait: float = FastAPIQuery(0, ge=0, le=60, description="Seconds to wait for a change when there is none yet"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    Changes to the bucket's records, oldest first: create, update (filename, metadata,
+    size or expiry), delete, expire (removed after its TTL) and bucket_delete.
+
+    - **since**: Continue after this position. Without it the feed starts at its current end.
+    - **wait**: Long-poll: hold the request up to this many seconds until a change arrives.
+    - Returns the changes and `next_since`, the `since` of the next request.
+    - Returns 410 if changes after `since` were pruned (see CHANGES_RETENTION_SEC); re-list the bucket and start over.
+    """
+    try:
+        changes, next_since = await wait_for_changes(bucket, since, limit, wait)
+    except ChangesExpired as e:
+        raise HTTPException(410, detail=str(e))
+    return {"changes": [change_details(change) for change in changes], "next_since": next_since}
+
+def sse_event(change: Dict[str, Any]) -> str:
+    data = json.dumps({**change, "at": change_details(change)["at"].isoformat()})
+    return f"id: {change['seq']}\nevent: {change['op']}\ndata: {data}\n\n"
+
+@router.get("/buckets/{bucket}/changes/stream", tags=["Changes"])
+async def stream_changes(
+    bucket: str,
+    request: Request,
+    since: Optional[int] = FastAPIQuery(None, ge=0, description="Position to resume from"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    The bucket's change feed as Server-Sent Events: one event per change, named
+    after its op, with the change as JSON data and its position as the event id.
+
+    - Reconnecting clients resume after their `Last-Event-ID`; otherwise after **since**, or from the current end.
+    - A comment is sent every 15 seconds without changes to keep proxies from closing the stream.
+    - If changes after the position were pruned, a `reset` event is sent and the stream
+      continues from the current end; re-list the bucket to catch up.
+    """
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id is not None:
+        try:
+            since = int(last_event_id)
+        except ValueError:
+            raise HTTPException(400, detail="Invalid Last-Event-ID")
+
+    async def events():
+        position = since
+        # Ask clients to reconnect quickly after a dropped connection
+        yield "retry: 1000\n\n"
+        while not await request.is_disconnected():
+            try:
+                changes, position = await wait_for_changes(bucket, position, 100, 15)
+            except ChangesExpired as e:
+                position = (await run_storage(get_changes, None, bucket))[1]
+                yield f"event: reset\ndata: {json.dumps({'detail': str(e), 'next_since': position})}\n\n"
+                continue
+            if changes:
+                yield "".join(sse_event(change) for change in changes)
+            else:
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# -------------------------------
+# Webhook Routes
+# -------------------------------
+
+@router.post("/buckets/{bucket}/webhooks", response_model=Webhook, response_model_exclude_none=True,
+             status_code=201, tags=["Webhooks"])
+async def create_webhook(bucket: str, webhook: WebhookCreate, api_key: str = Security(get_api_key)):
+    """
+    Subscribe a URL to the bucket's record events.
+
+    Events are POSTed in batches as `{"webhook_id": ..., "events": [{"seq", "event", "bucket", "id", "at", "record"}]}`,
+    where `record` holds the filename, size, metadata and expiry for create and update events. Each request carries
+    `X-Filenest-Timestamp` and `X-Filenest-Signature: sha256=<HMAC-SHA256 of "<timestamp>.<body>" with the secret>`.
+    Failed deliveries are retried with exponential backoff; delivery is at least once, so dedupe on `seq`.
+
+    - Returns the subscription including its `secret`, which is not shown again.
+    - Returns 400 if the URL or an event name is invalid.
+    """
+    try:
+        return await run_storage(create_webhook_helper, bucket, webhook.url, webhook.events, webhook.secret)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+@router.get("/buckets/{bucket}/webhooks", response_model=List[Webhook], response_model_exclude_none=True,
+            tags=["Webhooks"])
+async def list_webhooks(bucket: str, api_key: str = Security(get_api_key)):
+    """List the bucket's webhook subscriptions with their pending and failed event counts and last error."""
+    return await run_storage(list_webhooks_helper, bucket)
+
+@router.delete("/buckets/{bucket}/webhooks/{webhook_id}", response_model=StatusResponse, tags=["Webhooks"])
+async def delete_webhook(bucket: str, webhook_id: str, api_key: str = Security(get_api_key)):
+    """
+    Remove a webhook subscription; events not yet delivered to it are dropped.
+
+    - Returns 404 if the subscription does not exist.
+    """
+    if not await run_storage(delete_webhook_helper, bucket, webhook_id):
+        raise HTTPException(404, detail="Webhook not found")
+    return {"status": "success", "message": f"Webhook '{webhook_id}' deleted."}
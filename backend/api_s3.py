@@ -1,65 +1,363 @@
-from fastapi import APIRouter, Request, Response, HTTPException, Security
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Request, Response, Security, Query
+from fastapi.responses import FileResponse, StreamingResponse
+from email.utils import formatdate
 from typing import Optional
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+import base64
+import binascii
 import os
 import xml.etree.ElementTree as ET
 
 from security import get_api_key
-from storage import get_bucket_path, get_object_path, settings
+from executor import run_storage
+from uploads import stream_body, discard, UploadError, UploadTooLarge
+from storage import (
+    get_upload_dir,
+    get_record_path,
+    get_multipart_path,
+    create_bucket as create_bucket_helper,
+    BucketDeleting,
+    MultipartCompleting,
+    get_object_record,
+    put_object,
+    delete_object,
+    create_multipart_upload,
+    get_multipart_upload,
+    put_part,
+    complete_multipart_upload,
+    abort_multipart_upload,
+    bucket_exists,
+    list_objects,
+    settings,
+)
 
-router = APIRouter(prefix="/s3", tags=["s3 - DRAFT"])
+router = APIRouter(prefix="/s3", tags=["S3"])
 
-def build_xml_list_bucket(bucket_name: str, files: list):
-    root_elem = ET.Element("ListBucketResult", xmlns="http://s3.amazonaws.com/doc/2006-03-01/")
-    ET.SubElement(root_elem, "Name").text = bucket_name
-    ET.SubElement(root_elem, "KeyCount").text = str(len(files))
-    contents_elem = []
-    for key in files:
-        content = ET.SubElement(root_elem, "Contents")
-        ET.SubElement(content, "Key").text = key
-        ET.SubElement(content, "Size").text = str(os.path.getsize(os.path.join(get_bucket_path(bucket_name), key)))
-    return ET.tostring(root_elem, encoding="utf-8", xml_declaration=True)
+S3_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+MAX_PARTS = 10000
+
+# -------------------------------
+# Utilities
+# -------------------------------
+
+def xml_response(root: ET.Element, status_code: int = 200) -> Response:
+    return Response(content=ET.tostring(root, encoding="utf-8", xml_declaration=True), status_code=status_code,
+                    media_type="application/xml")
+
+def s3_error(status_code: int, code: str, message: str, resource: str = "") -> Response:
+    """S3-style XML error body, which SDKs parse into their own exceptions."""
+    root = ET.Element("Error")
+    ET.SubElement(root, "Code").text = code
+    ET.SubElement(root, "Message").text = message
+    ET.SubElement(root, "Resource").text = resource
+    return xml_response(root, status_code)
+
+def key_error(object_key: str) -> Optional[Response]:
+    """Error response for a key that cannot be stored as a path under the bucket, else None."""
+    if len(object_key.encode("utf-8")) > 1024:
+        return s3_error(400, "KeyTooLongError", "Your key is too long", object_key)
+    if object_key.startswith("/") or any(part in ("", ".", "..") for part in object_key.split("/")):
+        return s3_error(400, "InvalidArgument", "Object keys cannot contain empty, '.' or '..' segments", object_key)
+    return None
+
+def object_metadata(request: Request) -> dict:
+    """User metadata from the x-amz-meta-* request headers."""
+    return {
+        name[len("x-amz-meta-"):]: value
+        for name, value in request.headers.items() if name.startswith("x-amz-meta-")
+    }
+
+def content_md5_matches(request: Request, md5_hex: str) -> bool:
+    """Check the optional Content-MD5 header (base64 digest) against the received body."""
+    content_md5 = request.headers.get("content-md5")
+    if not content_md5:
+        return True
+    try:
+        return base64.b64decode(content_md5, validate=True).hex() == md5_hex
+    except (binascii.Error, ValueError):
+        return False
+
+async def receive_body(request: Request, dest_dir: str, resource: str):
+    """Stream the request body to a temp file. Returns (upload, None) or (None, error response)."""
+    try:
+        upload = await stream_body(request, dest_dir, settings.MAX_OBJECT_SIZE)
+    except UploadTooLarge:
+        return None, s3_error(400, "EntityTooLarge", "Your proposed upload exceeds the maximum allowed size",
+                              resource)
+    except UploadError as e:
+        return None, s3_error(400, "IncompleteBody", str(e), resource)
+    if not content_md5_matches(request, upload.md5):
+        await discard([upload])
+        return None, s3_error(400, "BadDigest", "The Content-MD5 you specified did not match what we received",
+                              resource)
+    return upload, None
+
+# -------------------------------
+# Objects
+# -------------------------------
 
 @router.put("/{bucket_name}/{object_key:path}")
-async def s3_put_object(bucket_name: str, object_key: str, request: Request, api_key: str = Security(get_api_key)):
-    content = await request.body()
-    bucket_path = get_bucket_path(bucket_name)
-    os.makedirs(bucket_path, exist_ok=True)
-    file_path = get_object_path(bucket_name, object_key)
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "wb") as f:
-        f.write(content)
-    return Response(status_code=200)
-
-@router.get("/{bucket_name}/{object_key:path}")
+async def s3_put_object(
+    bucket_name: str,
+    object_key: str,
+    request: Request,
+    part_number: Optional[int] = Query(None, alias="partNumber"),
+    upload_id: Optional[str] = Query(None, alias="uploadId"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    PutObject, or UploadPart when `partNumber` and `uploadId` are given.
+
+    The body is streamed to a temp file in the bucket's upload directory and renamed
+    into place, so objects larger than memory are written to disk exactly once.
+    `x-amz-meta-*` headers are stored as the record's metadata.
+    """
+    resource = f"/{bucket_name}/{object_key}"
+    error = key_error(object_key)
+    if error:
+        return error
+    if upload_id is not None:
+        return await s3_upload_part(bucket_name, object_key, request, part_number, upload_id)
+
+    try:
+        await run_storage(create_bucket_helper, bucket_name, exist_ok=True)
+    except BucketDeleting as e:
+        return s3_error(409, "OperationAborted", str(e), resource)
+    upload, error = await receive_body(request, get_upload_dir(bucket_name), resource)
+    if error:
+        return error
+    try:
+        await run_storage(put_object, bucket_name, object_key, upload.path, upload.size, upload.md5,
+                          object_metadata(request))
+    except BucketDeleting as e:
+        await discard([upload])
+        return s3_error(409, "OperationAborted", str(e), resource)
+    except BaseException:
+        await discard([upload])
+        raise
+    return Response(status_code=200, headers={"ETag": f'"{upload.md5}"'})
+
+async def s3_upload_part(bucket_name: str, object_key: str, request: Request, part_number: Optional[int],
+                         upload_id: str) -> Response:
+    resource = f"/{bucket_name}/{object_key}"
+    if part_number is None or not 1 <= part_number <= MAX_PARTS:
+        return s3_error(400, "InvalidArgument", f"Part number must be an integer between 1 and {MAX_PARTS}",
+                        resource)
+    upload = await run_storage(get_multipart_upload, upload_id)
+    if not upload or upload["bucket"] != bucket_name or upload["key"] != object_key:
+        return s3_error(404, "NoSuchUpload", "The specified upload does not exist", resource)
+
+    part, error = await receive_body(request, get_multipart_path(upload_id), resource)
+    if error:
+        return error
+    try:
+        stored = await run_storage(put_part, upload_id, part_number, part.path, part.size, part.md5)
+    except BaseException:
+        await discard([part])
+        raise
+    if not stored:
+        await discard([part])
+        return s3_error(404, "NoSuchUpload", "The specified upload does not exist", resource)
+    return Response(status_code=200, headers={"ETag": f'"{part.md5}"'})
+
+@router.api_route("/{bucket_name}/{object_key:path}", methods=["GET", "HEAD"])
 async def s3_get_object(bucket_name: str, object_key: str, api_key: str = Security(get_api_key)):
-    file_path = get_object_path(bucket_name, object_key)
-    if not os.path.isfile(file_path):
-        raise HTTPException(404)
-    def iterfile():
-        with open(file_path, "rb") as f:
-            yield from f
-    return StreamingResponse(iterfile(), media_type="application/octet-stream")
+    """GetObject / HeadObject, with Range support and the stored ETag and x-amz-meta-* headers."""
+    resource = f"/{bucket_name}/{object_key}"
+    record = await run_storage(get_object_record, bucket_name, object_key)
+    if not record:
+        return s3_error(404, "NoSuchKey", "The specified key does not exist.", resource)
+    path = get_record_path(record)
+    try:
+        stat_result = await run_storage(os.stat, path)
+    except FileNotFoundError:
+        return s3_error(404, "NoSuchKey", "The specified key does not exist.", resource)
+
+    headers = {"last-modified": formatdate(stat_result.st_mtime, usegmt=True)}
+    if record.get("etag"):
+        headers["etag"] = f'"{record["etag"]}"'
+    for name, value in (record.get("metadata") or {}).items():
+        headers[f"x-amz-meta-{name}"] = value if isinstance(value, str) else str(value)
+    return FileResponse(path, headers=headers, stat_result=stat_result)
 
 @router.delete("/{bucket_name}/{object_key:path}")
-async def s3_delete_object(bucket_name: str, object_key: str, api_key: str = Security(get_api_key)):
-    file_path = get_object_path(bucket_name, object_key)
-    if os.path.isfile(file_path):
-        os.remove(file_path)
+async def s3_delete_object(
+    bucket_name: str,
+    object_key: str,
+    upload_id: Optional[str] = Query(None, alias="uploadId"),
+    api_key: str = Security(get_api_key)
+):
+    """DeleteObject, or AbortMultipartUpload when `uploadId` is given."""
+    if upload_id is not None:
+        upload = await run_storage(get_multipart_upload, upload_id)
+        if not upload or upload["bucket"] != bucket_name or upload["key"] != object_key \
+                or not await run_storage(abort_multipart_upload, upload_id):
+            return s3_error(404, "NoSuchUpload", "The specified upload does not exist",
+                            f"/{bucket_name}/{object_key}")
         return Response(status_code=204)
-    raise HTTPException(404)
+    # Like S3, deleting a key that does not exist succeeds
+    await run_storage(delete_object, bucket_name, object_key)
+    return Response(status_code=204)
+
+# -------------------------------
+# Multipart Uploads
+# -------------------------------
+
+def parse_complete_parts(body: bytes):
+    """(part number, ETag) pairs of a CompleteMultipartUpload body; raises ValueError if malformed."""
+    try:
+        root = ET.fromstring(body)
+    except ET.ParseError as e:
+        raise ValueError(f"Malformed XML: {e}")
+    parts = []
+    for element in root:
+        if element.tag.rsplit("}", 1)[-1] != "Part":
+            continue
+        fields = {child.tag.rsplit("}", 1)[-1]: (child.text or "").strip() for child in element}
+        try:
+            parts.append((int(fields["PartNumber"]), fields["ETag"]))
+        except (KeyError, ValueError):
+            raise ValueError("Each Part needs a PartNumber and an ETag")
+    return parts
+
+@router.post("/{bucket_name}/{object_key:path}")
+async def s3_post_object(
+    bucket_name: str,
+    object_key: str,
+    request: Request,
+    upload_id: Optional[str] = Query(None, alias="uploadId"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    CreateMultipartUpload (`?uploads`) or CompleteMultipartUpload (`?uploadId=...`).
+
+    Parts can be uploaded in parallel; completing assembles them in the kernel with
+    copy_file_range onto the first part, without reading them back into the process.
+    """
+    resource = f"/{bucket_name}/{object_key}"
+    error = key_error(object_key)
+    if error:
+        return error
+
+    if "uploads" in request.query_params:
+        try:
+            await run_storage(create_bucket_helper, bucket_name, exist_ok=True)
+            new_upload_id = await run_storage(create_multipart_upload, bucket_name, object_key,
+                                              object_metadata(request))
+        except BucketDeleting as e:
+            return s3_error(409, "OperationAborted", str(e), resource)
+        root = ET.Element("InitiateMultipartUploadResult", xmlns=S3_XMLNS)
+        ET.SubElement(root, "Bucket").text = bucket_name
+        ET.SubElement(root, "Key").text = object_key
+        ET.SubElement(root, "UploadId").text = new_upload_id
+        return xml_response(root)
+
+    if upload_id is None:
+        return s3_error(400, "InvalidRequest", "Expected the 'uploads' or 'uploadId' query parameter", resource)
+
+    upload = await run_storage(get_multipart_upload, upload_id)
+    if not upload or upload["bucket"] != bucket_name or upload["key"] != object_key:
+        return s3_error(404, "NoSuchUpload", "The specified upload does not exist", resource)
+    body = await request.body()
+    try:
+        parts = parse_complete_parts(body)
+    except ValueError as e:
+        return s3_error(400, "MalformedXML", str(e), resource)
+    if len(parts) > MAX_PARTS:
+        return s3_error(400, "MalformedXML", f"At most {MAX_PARTS} parts are allowed", resource)
+    try:
+        result = await run_storage(complete_multipart_upload, upload_id, parts)
+    except (BucketDeleting, MultipartCompleting) as e:
+        return s3_error(409, "OperationAborted", str(e), resource)
+    except ValueError as e:
+        return s3_error(400, "InvalidPart", str(e), resource)
+    if result is None:
+        return s3_error(404, "NoSuchUpload", "The specified upload does not exist", resource)
+
+    _, _, etag = result
+    root = ET.Element("CompleteMultipartUploadResult", xmlns=S3_XMLNS)
+    ET.SubElement(root, "Location").text = str(request.url.replace(query=""))
+    ET.SubElement(root, "Bucket").text = bucket_name
+    ET.SubElement(root, "Key").text = object_key
+    ET.SubElement(root, "ETag").text = f'"{etag}"'
+    return xml_response(root)
+
+# -------------------------------
+# Buckets
+# -------------------------------
+
+def _iso8601(timestamp: str) -> str:
+    """S3 LastModified format from a stored naive-UTC isoformat timestamp."""
+    return timestamp[:23] + "Z" if "." in timestamp else timestamp + ".000Z"
+
+def list_objects_xml(bucket_name: str, page: dict, prefix: str, delimiter: str, max_keys: int,
+                     encode_keys: bool, v2: bool, marker: str, start_after: str, continuation_token: Optional[str]):
+    """Serialize a list_objects page as a ListBucketResult, one element at a time."""
+    encode = (lambda key: quote(key, safe="/")) if encode_keys else escape
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<ListBucketResult xmlns="{S3_XMLNS}"><Name>{escape(bucket_name)}</Name>'
+    yield f"<Prefix>{encode(prefix)}</Prefix>"
+    if delimiter:
+        yield f"<Delimiter>{encode(delimiter)}</Delimiter>"
+    yield f"<MaxKeys>{max_keys}</MaxKeys>"
+    if encode_keys:
+        yield "<EncodingType>url</EncodingType>"
+    yield f"<IsTruncated>{'true' if page['is_truncated'] else 'false'}</IsTruncated>"
+    if v2:
+        yield f"<KeyCount>{len(page['objects']) + len(page['common_prefixes'])}</KeyCount>"
+        if continuation_token:
+            yield f"<ContinuationToken>{escape(continuation_token)}</ContinuationToken>"
+        if page["next_token"]:
+            yield f"<NextContinuationToken>{page['next_token']}</NextContinuationToken>"
+        if start_after:
+            yield f"<StartAfter>{encode(start_after)}</StartAfter>"
+    else:
+        yield f"<Marker>{encode(marker)}</Marker>"
+        if page["is_truncated"] and delimiter:
+            last = max(page["objects"][-1]["key"] if page["objects"] else "",
+                       page["common_prefixes"][-1] if page["common_prefixes"] else "")
+            yield f"<NextMarker>{encode(last)}</NextMarker>"
+    for obj in page["objects"]:
+        etag = f"<ETag>&quot;{obj['etag']}&quot;</ETag>" if obj["etag"] else ""
+        yield (f"<Contents><Key>{encode(obj['key'])}</Key><LastModified>{_iso8601(obj['last_modified'])}</LastModified>"
+               f"{etag}<Size>{obj['size'] or 0}</Size><StorageClass>STANDARD</StorageClass></Contents>")
+    for common_prefix in page["common_prefixes"]:
+        yield f"<CommonPrefixes><Prefix>{encode(common_prefix)}</Prefix></CommonPrefixes>"
+    yield "</ListBucketResult>"
 
 @router.get("/{bucket_name}")
-async def s3_list_objects(bucket_name: str, prefix: Optional[str] = None, api_key: str = Security(get_api_key)):
-    bucket_path = get_bucket_path(bucket_name)
-    if not os.path.isdir(bucket_path):
-        raise HTTPException(404)
-    files_list = []
-    for root, dirs, files in os.walk(bucket_path):
-        for file in files:
-            rel_path = os.path.relpath(os.path.join(root, file), bucket_path)
-            if prefix and not rel_path.startswith(prefix):
-                continue
-            files_list.append(rel_path)
-    xml_resp = build_xml_list_bucket(bucket_name, files_list)
-    return Response(content=xml_resp, media_type="application/xml")
+async def s3_list_objects(
+    bucket_name: str,
+    list_type: Optional[int] = Query(None, alias="list-type"),
+    prefix: str = Query(""),
+    delimiter: str = Query(""),
+    max_keys: int = Query(1000, alias="max-keys", ge=0),
+    continuation_token: Optional[str] = Query(None, alias="continuation-token"),
+    start_after: str = Query("", alias="start-after"),
+    marker: str = Query(""),
+    encoding_type: Optional[str] = Query(None, alias="encoding-type"),
+    api_key: str = Security(get_api_key)
+):
+    """
+    ListObjectsV2 (`list-type=2`), or ListObjects v1 with `marker`.
+
+    Served from the (bucket, filename) index: a page costs time proportional to
+    `max-keys` (capped at 1000), not to the size of the bucket, and the XML is
+    streamed as it is serialized.
+    """
+    resource = f"/{bucket_name}"
+    if not await run_storage(bucket_exists, bucket_name):
+        return s3_error(404, "NoSuchBucket", "The specified bucket does not exist", resource)
+    v2 = list_type == 2
+    max_keys = min(max_keys, 1000)
+    try:
+        page = await run_storage(list_objects, bucket_name, prefix, delimiter, max_keys,
+                                 start_after if v2 else marker, continuation_token if v2 else None)
+    except ValueError as e:
+        return s3_error(400, "InvalidArgument", str(e), resource)
+    return StreamingResponse(
+        list_objects_xml(bucket_name, page, prefix, delimiter, max_keys, encoding_type == "url", v2, marker,
+                         start_after, continuation_token),
+        media_type="application/xml"
+    )
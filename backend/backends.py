@@ -0,0 +1,86 @@
+import hashlib
+import os
+import posixpath
+
+from settings import settings
+
+# -----------------------------
+# Storage Backends
+# -----------------------------
+
+class StorageBackend:
+    """
+    Decides where the bytes of new records are written under a storage root.
+
+    A record stores the location it was written to, a path relative to the root,
+    so changing STORAGE_LAYOUT only affects new records and migrate_storage.py
+    moves the existing ones. A backend striping data over several mount points
+    fits the same interface: it encodes the volume in location(), resolves it in
+    path(), and returns directories on the right volume from temp_dir() and
+    bucket_dirs().
+    """
+    name = None
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def location(self, bucket: str, record_id: str, filename: str) -> str:
+        """Where a new record's file goes, relative to the root."""
+        raise NotImplementedError
+
+    def blob_location(self, sha256: str) -> str:
+        """Where a content-addressed blob goes, relative to the root."""
+        return posixpath.join(".blobs", sha256[:2], sha256[2:4], sha256)
+
+    def path(self, location: str) -> str:
+        """Absolute path of a stored location."""
+        return os.path.join(self.root, location)
+
+    def temp_dir(self, bucket: str) -> str:
+        """Directory for upload temp files, on the filesystem they are renamed into."""
+        return os.path.join(self.root, bucket)
+
+    def bucket_dirs(self, bucket: str) -> list[str]:
+        """Directories holding only this bucket's files, removed once it is purged."""
+        return [os.path.join(self.root, bucket)]
+
+class FlatBackend(StorageBackend):
+    """The original layout, STORAGE_DIR/bucket/filename. Records with the same filename share a file."""
+    name = "flat"
+
+    def location(self, bucket: str, record_id: str, filename: str) -> str:
+        return posixpath.join(bucket, filename)
+
+class ShardedBackend(StorageBackend):
+    """
+    STORAGE_DIR/bucket/.shards/ab/cd/<record id><ext>, where ab/cd come from a hash
+    of the record id: 65536 leaf directories per bucket keep every directory small
+    even with hundreds of millions of records, and no two records share a file.
+    """
+    name = "sharded"
+    shard_dir = ".shards"
+
+    def location(self, bucket: str, record_id: str, filename: str) -> str:
+        digest = hashlib.sha1(record_id.encode("utf-8")).hexdigest()
+        # Keep a short extension so static serving can still guess the content type
+        ext = os.path.splitext(filename)[1]
+        if len(ext) > 16 or not ext[1:].isalnum():
+            ext = ""
+        return posixpath.join(bucket, self.shard_dir, digest[:2], digest[2:4], record_id + ext)
+
+BACKENDS = {backend.name: backend for backend in (FlatBackend, ShardedBackend)}
+
+def make_backend(layout: str, root: str = None) -> StorageBackend:
+    """Backend for a layout name; raises ValueError for an unknown one."""
+    if layout not in BACKENDS:
+        raise ValueError(f"Unknown storage layout '{layout}', expected one of {sorted(BACKENDS)}")
+    return BACKENDS[layout](root or settings.STORAGE_DIR)
+
+_backend = None
+
+def get_backend() -> StorageBackend:
+    """The backend configured by STORAGE_LAYOUT and STORAGE_DIR."""
+    global _backend
+    if _backend is None or _backend.name != settings.STORAGE_LAYOUT or _backend.root != settings.STORAGE_DIR:
+        _backend = make_backend(settings.STORAGE_LAYOUT)
+    return _backend
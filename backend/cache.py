@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+
+from settings import settings
+
+# -----------------------------
+# Record Cache
+# -----------------------------
+
+class RecordCache:
+    """
+    In-process LRU of record rows keyed by id, bounded by entry count and bytes.
+
+    Each worker process has its own cache. Triggers append the id of every updated
+    or deleted record, and the name of every bucket being deleted, to the
+    record_invalidations table, and sync() applies the entries added since the
+    last call. sync() only reads that table when `PRAGMA data_version` or the
+    connection's own change count moved, so a hit usually costs one pragma. An
+    entry never outlives its record's expires_at, nor CACHE_TTL_SEC.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # record id -> (row, deadline, size)
+        self._bytes = 0
+        self._seq = None  # Last record_invalidations entry applied
+        self._local = threading.local()  # Connection of this thread and its (data_version, total_changes)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def sync(self, conn) -> int:
+        """
+        Apply the invalidations committed since the last sync. Returns the log
+        position to pass to put() for rows read with `conn` after this call.
+        """
+        version = (conn.execute("PRAGMA data_version").fetchone()[0], conn.total_changes)
+        with self._lock:
+            unchanged = getattr(self._local, "conn", None) is conn and self._local.version == version
+            if unchanged and self._seq is not None:
+                return self._seq
+            base = self._seq
+
+        if base is None:
+            rows = []
+            seen = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM record_invalidations").fetchone()[0]
+        else:
+            rows = conn.execute(
+                "SELECT seq, record_id, bucket FROM record_invalidations WHERE seq > ? ORDER BY seq", (base,)
+            ).fetchall()
+            seen = rows[-1][0] if rows else base
+
+        with self._lock:
+            if self._seq is None:
+                self._seq = seen
+            elif rows and rows[0][0] != base + 1:
+                # Entries we never saw were pruned: anything cached may be stale
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._bytes = 0
+                self._seq = max(self._seq, seen)
+            else:
+                for seq, record_id, bucket in rows:
+                    if seq > self._seq:
+                        self._invalidate(record_id, bucket)
+                self._seq = max(self._seq, seen)
+            self._local.conn, self._local.version = conn, version
+        return seen
+
+    def _invalidate(self, record_id, bucket):
+        if record_id is not None:
+            entry = self._entries.pop(record_id, None)
+            if entry:
+                self._bytes -= entry[2]
+                self.invalidations += 1
+            return
+        for key in [key for key, (row, _, _) in self._entries.items() if row[1] == bucket]:
+            self._bytes -= self._entries.pop(key)[2]
+            self.invalidations += 1
+
+    def get(self, record_id: str):
+        """The cached row of a record, or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(record_id)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(record_id)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[record_id]
+                self._bytes -= entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, row, seen: int, expires_at=None):
+        """
+        Cache a row read after sync() returned `seen`. Ignored if newer invalidations
+        were applied in the meantime, since they may concern this row.
+        """
+        now = time.time()
+        deadline = now + self.ttl_seconds
+        if expires_at is not None:
+            deadline = min(deadline, expires_at)
+        size = 128 + sum(len(value) for value in row if isinstance(value, str))
+        if deadline <= now or size > self.max_bytes:
+            return
+        record_id = row[0]
+        with self._lock:
+            if self._seq != seen:
+                return
+            old = self._entries.pop(record_id, None)
+            if old:
+                self._bytes -= old[2]
+            self._entries[record_id] = (row, deadline, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._seq = None
+            self._local = threading.local()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+record_cache = RecordCache(settings.CACHE_MAX_ENTRIES, settings.CACHE_MAX_BYTES, settings.CACHE_TTL_SEC)
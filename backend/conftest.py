@@ -0,0 +1,32 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# The backend modules import each other by name, and storage opens its database
+# on import, so point it at a scratch directory before importing anything
+_SCRATCH = tempfile.mkdtemp(prefix="filenest-test-")
+atexit.register(shutil.rmtree, _SCRATCH, ignore_errors=True)
+os.environ.setdefault("DB_PATH", os.path.join(_SCRATCH, "db.sqlite"))
+os.environ.setdefault("STORAGE_DIR", os.path.join(_SCRATCH, "storage"))
+os.environ.setdefault("CLEANUP_INTERVAL_SEC", "0")
+os.makedirs(os.environ["STORAGE_DIR"], exist_ok=True)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import storage  # noqa: E402
+from settings import settings  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def isolate_db_and_storage(tmp_path, monkeypatch):
+    # Every test gets its own database and storage directory
+    monkeypatch.setattr(settings, "STORAGE_DIR", str(tmp_path / "storage"))
+    monkeypatch.setattr(settings, "DB_PATH", str(tmp_path / "db.sqlite"))
+    os.makedirs(settings.STORAGE_DIR)
+    storage.close_db()
+    storage.initialize_database()
+    yield
+    storage.close_db()
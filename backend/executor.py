@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import settings
+
+# -----------------------------
+# Storage Executor
+# -----------------------------
+
+class StorageExecutor:
+    """
+    Bounded thread pool for blocking storage work (SQLite queries, renames, unlinks, fsyncs).
+
+    Routes await run_storage() instead of calling storage functions directly, so a
+    slow disk or a busy database stalls only the calls queued behind it, never the
+    event loop. Queue depth and per-call wait/run times are tracked for sizing.
+    """
+
+    def __init__(self, max_workers: int, window: int = 1024):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_queued = 0
+        self._wait_times = deque(maxlen=window)
+        self._run_times = deque(maxlen=window)
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="filenest-storage")
+        return self._executor
+
+    def _call(self, submitted, fn, args, kwargs):
+        started = time.perf_counter()
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self._wait_times.append(started - submitted)
+        failed = False
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+                self.failed += failed
+                self._run_times.append(time.perf_counter() - started)
+
+    def _dequeue_cancelled(self, future):
+        # A call cancelled before a worker picked it up never runs _call
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the pool and await its result."""
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        future = self._pool().submit(self._call, time.perf_counter(), fn, args, kwargs)
+        future.add_done_callback(self._dequeue_cancelled)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        """Current queue depth and latency percentiles (ms) over the most recent calls."""
+        with self._lock:
+            wait_times, run_times = sorted(self._wait_times), sorted(self._run_times)
+            return {
+                "workers": self.max_workers,
+                "queued": self.queued,
+                "max_queued": self.max_queued,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait_ms": _percentiles(wait_times),
+                "run_ms": _percentiles(run_times),
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+def _percentiles(samples) -> dict:
+    if not samples:
+        return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+    pick = lambda q: samples[min(len(samples) - 1, int(len(samples) * q))]
+    return {"p50": round(pick(0.5) * 1000, 3), "p99": round(pick(0.99) * 1000, 3), "max": round(samples[-1] * 1000, 3)}
+
+storage_executor = StorageExecutor(settings.STORAGE_WORKERS)
+
+async def run_storage(fn, *args, **kwargs):
+    """Await a blocking storage call on the shared storage executor."""
+    return await storage_executor.run(fn, *args, **kwargs)
@@ -0,0 +1,124 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps
+except ModuleNotFoundError:
+    Image = None
+
+from settings import settings
+from executor import run_storage
+
+# -----------------------------
+# Rendering
+# -----------------------------
+
+# Output format -> (Pillow format, media type, file extension)
+FORMATS = {
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "png": ("PNG", "image/png", "png"),
+}
+
+class ImagingError(ValueError):
+    """The source is not an image Pillow can read, or is too large to render."""
+
+def available() -> bool:
+    return Image is not None
+
+def render(source: str, destination: str, width, height, format: str, quality: int, max_pixels: int):
+    """
+    Write a copy of the image at `source`, scaled to fit within width x height
+    (either may be None) and never enlarged, to `destination`. Runs in a worker
+    process. Returns the source's (width, height).
+    """
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    try:
+        with Image.open(source) as image:
+            source_size = image.size
+            if source_size[0] * source_size[1] > max_pixels:
+                raise ImagingError(f"Image has more than {max_pixels} pixels")
+            # Let JPEG decode at a reduced scale right away instead of decoding full size first;
+            # both sides stay at least the larger requested one, whatever the EXIF orientation
+            side = max(width or 0, height or 0)
+            image.draft("RGB", (side, side))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width or image.width, height or image.height), Image.LANCZOS)
+            pillow_format = FORMATS[format][0]
+            if pillow_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+                image = image.convert("RGBA")
+            options = {"optimize": True} if pillow_format == "PNG" else {"quality": quality}
+            image.save(destination, pillow_format, **options)
+    except (OSError, Image.DecompressionBombError):
+        raise ImagingError("The file is not an image that can be scaled")
+    return source_size
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# -----------------------------
+# Render Pool
+# -----------------------------
+
+class RenderPool:
+    """
+    Process pool for rendering derivatives: decoding and resampling are CPU bound
+    and would hold the GIL in a thread. Concurrent requests for the same output
+    share one render.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = {}  # destination -> future of the render writing it
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process that runs threads can deadlock the child, so workers are spawned
+                self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    async def render(self, source: str, destination: str, width, height, format: str, quality: int):
+        """Render into `destination` (atomically, via a temp file) and return the source's size."""
+        pending = self._pending.get(destination)
+        if pending is None:
+            pending = asyncio.ensure_future(self._render(source, destination, width, height, format, quality))
+            self._pending[destination] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(destination, None))
+        return await asyncio.shield(pending)
+
+    async def _render(self, source, destination, width, height, format, quality):
+        await run_storage(os.makedirs, os.path.dirname(destination), exist_ok=True)
+        temp_path = f"{destination}.{os.getpid()}.tmp"
+        loop = asyncio.get_running_loop()
+        args = (render, source, temp_path, width, height, format, quality, settings.THUMBNAIL_MAX_SOURCE_PIXELS)
+        try:
+            try:
+                size = await loop.run_in_executor(self._pool(), *args)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for memory); start a fresh pool and try once more
+                self.shutdown()
+                size = await loop.run_in_executor(self._pool(), *args)
+            await run_storage(os.replace, temp_path, destination)
+        finally:
+            await run_storage(_remove_if_exists, temp_path)
+        return size
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+render_pool = RenderPool(settings.THUMBNAIL_WORKERS)
@@ -1,14 +1,36 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
+from contextlib import asynccontextmanager, suppress
+import asyncio
 import os
 
 
 from settings import settings
 from api_filnest import router as filenest_router
 from api_s3 import router as s3_router
+from storage import cleanup_all_buckets, run_reaper, close_db
+from executor import run_storage, storage_executor
+from cache import record_cache
+from metrics import MetricsMiddleware, render_metrics
+from webhooks import webhook_dispatcher
+from imaging import render_pool
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    reaper = asyncio.create_task(run_reaper()) if settings.CLEANUP_INTERVAL_SEC > 0 else None
+    dispatcher = asyncio.create_task(webhook_dispatcher.run()) if settings.WEBHOOKS_ENABLED else None
+    yield
+    for task in (reaper, dispatcher):
+        if task:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+    storage_executor.shutdown()
+    render_pool.shutdown()
+    close_db()
 
 app = FastAPI(
     title="Filenest: File and Metadata Storage API",
@@ -21,7 +43,8 @@ Designed for developers and technical users as well as non-technical admins usin
 
               docs_url='/api/docs',
               redoc_url='/api/redoc',
-              openapi_url='/api/openapi.json'
+              openapi_url='/api/openapi.json',
+              lifespan=lifespan
 )
 
 
@@ -31,14 +54,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Source-Width", "X-Source-Height"],
 )
 
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 app.include_router(filenest_router)
-# app.include_router(s3_router, prefix="/api")
+app.include_router(s3_router, prefix="/api")
 
 @app.get("/health", include_in_schema=False)
 async def health_check():
-    return {"status": "ok"}
+    return {"status": "ok", "storage_executor": storage_executor.stats(), "record_cache": record_cache.stats()}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(404)
+    # Some metrics are read from SQLite at scrape time
+    body = await run_storage(render_metrics)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
 
 @app.post("/cleanup-expired", include_in_schema=False)
 async def trigger_full_cleanup(request: Request):
@@ -47,8 +82,8 @@ async def trigger_full_cleanup(request: Request):
     if api_key != settings.API_KEY:
         raise HTTPException(status_code=403, detail="Forbidden")
     '''
-    await cleanup_all_buckets()
-    return {"detail": "All expired files cleaned up."}
+    removed = await cleanup_all_buckets()
+    return {"detail": "All expired files cleaned up.", "removed": removed}
 
 # Serve frontend only in development
 if settings.ENV.lower() == "dev":
@@ -0,0 +1,283 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ModuleNotFoundError:
+    psutil = None
+
+from cache import record_cache
+from executor import storage_executor
+
+# -----------------------------
+# Metric Types
+# -----------------------------
+
+# Covers both quick metadata reads and multi-second uploads
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_METRICS = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """A named family of samples, one per combination of label values, rendered in Prometheus text format."""
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, labels, value) triples for rendering."""
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield "", dict(zip(self.labelnames, key)), value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with-block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in values:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                yield "_bucket", {**labels, "le": _format_value(float(bound))}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+class Sampled(Metric):
+    """
+    A metric read from elsewhere at scrape time: `fn` returns a number, or a dict
+    mapping a label value tuple to a number. Returning None skips the metric.
+    """
+
+    def __init__(self, name: str, help: str, fn, kind: str = "gauge", labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if value is None:
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for key, sample in value.items():
+            yield "", dict(zip(self.labelnames, key)), sample
+
+    def render(self) -> list[str]:
+        try:
+            samples = list(self.samples())
+        except Exception as e:
+            # One failing source must not take the whole scrape down
+            return [f"# {self.name} unavailable: {_escape(e)}"]
+        if not samples:
+            return []
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in samples:
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+def render_metrics() -> str:
+    """Every registered metric in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# -----------------------------
+# HTTP Metrics
+# -----------------------------
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "filenest_http_request_duration_seconds", "Time to handle a request, until its response is fully sent",
+    ("method", "route", "status"))
+HTTP_RECEIVED_BYTES = Counter(
+    "filenest_http_received_bytes_total", "Request body bytes received", ("method", "route"))
+HTTP_SENT_BYTES = Counter(
+    "filenest_http_sent_bytes_total", "Response body bytes sent", ("method", "route"))
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency and body bytes per route template, so
+    /buckets/{bucket}/records/{record_id} is one series however many ids there are.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        received = sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope["method"]
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method, route=route, status=status)
+            if received:
+                HTTP_RECEIVED_BYTES.inc(received, method=method, route=route)
+            if sent:
+                HTTP_SENT_BYTES.inc(sent, method=method, route=route)
+
+# -----------------------------
+# Storage Metrics
+# -----------------------------
+
+UPLOAD_STAGE_SECONDS = Histogram(
+    "filenest_upload_stage_seconds",
+    "Time per stage of storing an upload: receive (awaiting body chunks), write (parsing and writing the temp"
+    " file), db_insert and move",
+    ("stage",))
+DB_TRANSACTION_SECONDS = Histogram(
+    "filenest_db_transaction_seconds",
+    "Time inside a get_db() transaction, including waits for the SQLite write lock (up to DB_BUSY_TIMEOUT_MS)")
+DB_COMMIT_SECONDS = Histogram("filenest_db_commit_seconds", "Time to commit a transaction")
+DB_LOCKED_ERRORS = Counter(
+    "filenest_db_locked_errors_total", "Transactions that gave up waiting for the SQLite write lock")
+REAPER_REMOVED = Counter("filenest_reaper_removed_total", "Records deleted by the reaper", ("reason",))
+REAPER_PASS_SECONDS = Histogram("filenest_reaper_pass_seconds", "Duration of a reaper cleanup pass")
+
+WEBHOOK_EVENTS_SENT = Counter(
+    "filenest_webhook_events_total", "Webhook events by delivery outcome: delivered, retry or failed", ("result",))
+WEBHOOK_REQUEST_SECONDS = Histogram("filenest_webhook_request_seconds", "Duration of webhook requests")
+
+DERIVATIVE_REQUESTS = Counter(
+    "filenest_derivative_requests_total", "Image derivative requests by cache result: hit or miss", ("result",))
+DERIVATIVE_RENDER_SECONDS = Histogram("filenest_derivative_render_seconds", "Time to render an image derivative")
+DERIVATIVE_EVICTIONS = Counter(
+    "filenest_derivative_evictions_total", "Cached image derivatives evicted to stay within the cache size")
+
+# -----------------------------
+# Process & Executor Metrics
+# -----------------------------
+
+def _executor_stats(field):
+    return lambda: storage_executor.stats()[field]
+
+Sampled("filenest_storage_executor_queued", "Storage calls waiting for a worker thread", _executor_stats("queued"))
+Sampled("filenest_storage_executor_active", "Storage calls running", _executor_stats("active"))
+Sampled("filenest_storage_executor_calls_total", "Storage calls finished", _executor_stats("completed"), "counter")
+Sampled("filenest_storage_executor_failures_total", "Storage calls that raised", _executor_stats("failed"), "counter")
+Sampled("filenest_storage_executor_wait_p99_seconds", "p99 queue wait over the recent storage calls",
+        lambda: storage_executor.stats()["wait_ms"]["p99"] / 1000)
+
+def _cache_stats(field):
+    return lambda: record_cache.stats()[field]
+
+Sampled("filenest_record_cache_hits_total", "Record lookups served from the cache", _cache_stats("hits"), "counter")
+Sampled("filenest_record_cache_misses_total", "Record lookups that read SQLite", _cache_stats("misses"), "counter")
+Sampled("filenest_record_cache_hit_ratio", "Share of record lookups served from the cache", _cache_stats("hit_ratio"))
+Sampled("filenest_record_cache_entries", "Records in the cache", _cache_stats("entries"))
+Sampled("filenest_record_cache_bytes", "Approximate size of the cached records", _cache_stats("bytes"))
+Sampled("filenest_record_cache_evictions_total", "Records evicted to stay within the cache bounds",
+        _cache_stats("evictions"), "counter")
+Sampled("filenest_record_cache_invalidations_total", "Records dropped because they changed",
+        _cache_stats("invalidations"), "counter")
+
+_process = psutil.Process(os.getpid()) if psutil else None
+
+def _process_stat(read):
+    # Without psutil the process metrics are simply left out
+    return lambda: read(_process) if _process is not None else None
+
+Sampled("process_resident_memory_bytes", "Resident memory size in bytes",
+        _process_stat(lambda p: p.memory_info().rss))
+Sampled("process_cpu_seconds_total", "Total user and system CPU time spent in seconds",
+        _process_stat(lambda p: sum(p.cpu_times()[:2])), "counter")
+Sampled("process_open_fds", "Number of open file descriptors",
+        _process_stat(lambda p: p.num_fds() if hasattr(p, "num_fds") else None))
+Sampled("process_threads", "Number of OS threads", _process_stat(lambda p: p.num_threads()))
+Sampled("process_start_time_seconds", "Start time of the process since the epoch in seconds",
+        _process_stat(lambda p: p.create_time()))
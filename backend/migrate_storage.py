@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Move the files of existing records to another storage layout.
+
+New records are written with STORAGE_LAYOUT; this moves the older ones, a batch
+of records per transaction, and can run while the API is serving. Each file is
+hard-linked (or copied across filesystems) to its new location before the record
+is updated, and the old file is unlinked once no record refers to it any more.
+Content-addressed blobs are left where they are.
+
+In the flat layout records with the same filename share one file, so moving a
+record onto a path that already holds different content is refused: the record
+keeps its current location and is reported as skipped.
+
+Usage (from backend/): python migrate_storage.py --to sharded [--batch-size 1000] [--dry-run]
+"""
+import argparse
+import filecmp
+import os
+import shutil
+
+from backends import BACKENDS, make_backend
+from storage import get_db, get_record_path, remove_files
+
+
+def _same_content(src: str, dst: str) -> bool:
+    return os.path.samefile(src, dst) or filecmp.cmp(src, dst, shallow=False)
+
+
+def _link_or_copy(src: str, dst: str) -> bool:
+    """Put src's content at dst. Returns False, leaving dst alone, if it already holds other content."""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        # Left by an interrupted run, or another record's file when filenames collide
+        return _same_content(src, dst)
+    except OSError:
+        if os.path.exists(dst):
+            return _same_content(src, dst)
+        shutil.copy2(src, dst)
+    return True
+
+
+def _is_flat(record) -> bool:
+    return not record["location"] or record["location"] == f"{record['bucket']}/{record['filename']}"
+
+
+def migrate(layout: str, batch_size: int = 1000, dry_run: bool = False):
+    """Move every record not yet in `layout`. Returns (moved, missing, skipped) counts."""
+    target = make_backend(layout)
+    moved = missing = skipped = 0
+    last_rowid = 0
+    while True:
+        stale_paths = []
+        with get_db() as conn:
+            rows = conn.execute(
+                "SELECT rowid, id, bucket, filename, location FROM files WHERE rowid > ? AND blob IS NULL "
+                "ORDER BY rowid LIMIT ?", (last_rowid, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            for _, file_id, bucket, filename, location in rows:
+                record = {"id": file_id, "bucket": bucket, "filename": filename, "location": location}
+                new_location = target.location(bucket, file_id, filename)
+                src, dst = get_record_path(record), target.path(new_location)
+                if location == new_location or src == dst:
+                    continue
+                if dry_run:
+                    print(f"{src} -> {dst}")
+                    moved += 1
+                    continue
+                try:
+                    if not _link_or_copy(src, dst):
+                        print(f"[MIGRATE] Skipped record {file_id}: {dst} already holds another file")
+                        skipped += 1
+                        continue
+                except FileNotFoundError:
+                    missing += 1
+                    continue
+                conn.execute("UPDATE files SET location = ? WHERE id = ?", (new_location, file_id))
+                stale_paths.append((record, src))
+                moved += 1
+
+            # Flat files can be shared by several records with the same filename
+            stale_paths = [
+                src for record, src in stale_paths
+                if not _is_flat(record) or not conn.execute(
+                    "SELECT 1 FROM files WHERE bucket = ? AND filename = ? AND blob IS NULL "
+                    "AND (location IS NULL OR location = ?) LIMIT 1",
+                    (record["bucket"], record["filename"], f"{record['bucket']}/{record['filename']}")
+                ).fetchone()
+            ]
+        remove_files(set(stale_paths))
+        print(f"[MIGRATE] {moved} files moved so far")
+    return moved, missing, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--to", required=True, choices=sorted(BACKENDS), help="Target storage layout")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Records per transaction")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the moves")
+    args = parser.parse_args()
+
+    moved, missing, skipped = migrate(args.to, args.batch_size, args.dry_run)
+    print(f"[MIGRATE] Done: {moved} files moved, {missing} records without a file, "
+          f"{skipped} skipped because another file has their name")
+    if not args.dry_run:
+        print(f"[MIGRATE] Set STORAGE_LAYOUT={args.to} so new uploads use the same layout")
+
+
+if __name__ == "__main__":
+    main()
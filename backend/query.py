@@ -0,0 +1,224 @@
+import json
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from storage import _metadata_expr, _metadata_index_name, _metadata_path
+
+# -----------------------------
+# Query Language
+# -----------------------------
+
+# A filter is a condition or a combination of them:
+#   {"and": [...]}, {"or": [...]}, {"not": {...}}
+#   {"key": "<metadata key>" | "field": "<record column>", "<op>": <value>, "type": "<value type>"}
+# with op one of eq, ne, gt, gte, lt, lte, between ([low, high]), in ([values]) or exists (true/false).
+# The value type defaults to the JSON type of the value; datetimes must say "type": "datetime".
+
+class QueryError(ValueError):
+    """The filter or ordering is not valid."""
+
+_COMPARISONS = {"eq": "=", "ne": "!=", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+OPERATORS = tuple(_COMPARISONS) + ("between", "in", "exists")
+VALUE_TYPES = ("string", "number", "boolean", "datetime")
+
+# Record columns a condition or ordering may use instead of a metadata key, with their value type
+FIELDS = {
+    "filename": "string",
+    "size": "number",
+    "created_at": "datetime",
+    "updated_at": "datetime",
+    "expires_at": "datetime",
+}
+
+# json_type values accepted for each value type, so 5 never matches "5" and ranges stay within a type
+_JSON_TYPES = {"string": "'text'", "number": "'integer', 'real'", "boolean": "'true', 'false'"}
+
+MAX_DEPTH = 8
+MAX_CONDITIONS = 64
+MAX_IN_VALUES = 1000
+MAX_ORDER_TERMS = 4
+
+@dataclass
+class CompiledQuery:
+    """Parameterized WHERE clause and ORDER BY list for query_records()."""
+    where: str = "1"
+    params: list = field(default_factory=list)
+    order_by: str = "created_at, id"
+    keys: list = field(default_factory=list)  # Metadata keys the filter and ordering use
+
+def _infer_type(value) -> str:
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    return "string"
+
+def _coerce(value, value_type, column=None):
+    """Convert a filter value to what the SQL expression compares against."""
+    if value_type == "number":
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise QueryError(f"Expected a number, got {value!r}")
+        return value
+    if value_type == "boolean":
+        if not isinstance(value, bool):
+            raise QueryError(f"Expected true or false, got {value!r}")
+        return int(value)
+    if value_type == "datetime":
+        try:
+            moment = datetime.fromisoformat(str(value))
+        except ValueError:
+            raise QueryError(f"Invalid datetime value: {value!r}")
+        if column == "expires_at":
+            if moment.tzinfo is None:
+                moment = moment.replace(tzinfo=timezone.utc)
+            return int(moment.timestamp())
+        if column is not None and moment.tzinfo is not None:
+            # created_at/updated_at are naive UTC ISO strings, which order like the times they hold
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        return moment.isoformat()
+    if not isinstance(value, str):
+        raise QueryError(f"Expected a string, got {value!r}")
+    return value
+
+class _Compiler:
+    def __init__(self):
+        self.params = []
+        self.keys = []
+        self.conditions = 0
+
+    def node(self, node, depth=0) -> str:
+        if depth > MAX_DEPTH:
+            raise QueryError(f"Filter is nested deeper than {MAX_DEPTH} levels")
+        if not isinstance(node, dict):
+            raise QueryError(f"Expected a condition object, got {node!r}")
+        for combinator, joiner in (("and", " AND "), ("or", " OR ")):
+            if combinator in node:
+                children = node[combinator]
+                if len(node) != 1 or not isinstance(children, list) or not children:
+                    raise QueryError(f'"{combinator}" takes a non-empty list of conditions and nothing else')
+                return "(" + joiner.join(self.node(child, depth + 1) for child in children) + ")"
+        if "not" in node:
+            if len(node) != 1:
+                raise QueryError('"not" takes a single condition and nothing else')
+            # A condition on a missing key is NULL rather than false; its negation should match
+            return f"NOT COALESCE({self.node(node['not'], depth + 1)}, 0)"
+        return self.condition(node)
+
+    def target(self, node):
+        """SQL expression of the key or field a condition/ordering refers to, and its metadata key if any."""
+        if ("key" in node) == ("field" in node):
+            raise QueryError(f"Give either \"key\" or \"field\": {node!r}")
+        if "field" in node:
+            if node["field"] not in FIELDS:
+                raise QueryError(f"Unknown field {node['field']!r}, expected one of {sorted(FIELDS)}")
+            return node["field"], None
+        key = node["key"]
+        if not isinstance(key, str):
+            raise QueryError(f"Invalid metadata key: {key!r}")
+        _metadata_path(key)
+        if key not in self.keys:
+            self.keys.append(key)
+        return _metadata_expr(key), key
+
+    def condition(self, node) -> str:
+        self.conditions += 1
+        if self.conditions > MAX_CONDITIONS:
+            raise QueryError(f"Filter has more than {MAX_CONDITIONS} conditions")
+        expr, key = self.target(node)
+        ops = [op for op in OPERATORS if op in node]
+        unknown = set(node) - set(OPERATORS) - {"key", "field", "type"}
+        if len(ops) != 1 or unknown:
+            raise QueryError(f"A condition needs exactly one of {', '.join(OPERATORS)}: {node!r}")
+        op, value = ops[0], node[ops[0]]
+
+        if op == "exists":
+            if not isinstance(value, bool):
+                raise QueryError('"exists" takes true or false')
+            if key is None:
+                return f"{expr} IS {'NOT ' if value else ''}NULL"
+            # An explicit JSON null counts as present
+            return f"{_metadata_expr(key, 'json_type')} IS {'NOT ' if value else ''}NULL"
+
+        column = None if key is not None else node["field"]
+        if column is not None:
+            value_type = FIELDS[column]
+        else:
+            sample = value[0] if op in ("between", "in") and isinstance(value, list) and value else value
+            value_type = node.get("type") or _infer_type(sample)
+        if value_type not in VALUE_TYPES:
+            raise QueryError(f"Unsupported value type {value_type!r}, expected one of {', '.join(VALUE_TYPES)}")
+
+        # Metadata datetimes may be written in any ISO format, so they are compared as julian days
+        placeholder = "?"
+        if key is not None and value_type == "datetime":
+            expr, placeholder = f"julianday({expr})", "julianday(?)"
+        guard = ""
+        if key is not None and value_type in _JSON_TYPES and (op != "eq" or value_type == "boolean"):
+            guard = f" AND {_metadata_expr(key, 'json_type')} IN ({_JSON_TYPES[value_type]})"
+
+        if op in _COMPARISONS:
+            self.params.append(_coerce(value, value_type, column))
+            return f"({expr} {_COMPARISONS[op]} {placeholder}{guard})"
+        if op == "between":
+            if not isinstance(value, list) or len(value) != 2:
+                raise QueryError('"between" takes [low, high]')
+            self.params += [_coerce(v, value_type, column) for v in value]
+            return f"({expr} BETWEEN {placeholder} AND {placeholder}{guard})"
+        if not isinstance(value, list) or not value or len(value) > MAX_IN_VALUES:
+            raise QueryError(f'"in" takes a list of 1 to {MAX_IN_VALUES} values')
+        # The list is bound as one JSON array, so it is not limited by SQLite's parameter count
+        self.params.append(json.dumps([_coerce(v, value_type, column) for v in value]))
+        values = "julianday(value)" if placeholder != "?" else "value"
+        return f"({expr} IN (SELECT {values} FROM json_each(?)){guard})"
+
+    def order_by(self, terms) -> str:
+        if not isinstance(terms, list) or len(terms) > MAX_ORDER_TERMS:
+            raise QueryError(f'"order_by" takes a list of at most {MAX_ORDER_TERMS} terms')
+        parts = []
+        for term in terms:
+            if not isinstance(term, dict) or set(term) - {"key", "field", "desc"}:
+                raise QueryError(f'Order terms look like {{"key": ..., "desc": true}}: {term!r}')
+            expr, _ = self.target(term)
+            parts.append(f"{expr} DESC" if term.get("desc") else expr)
+        # id breaks ties, so offsets page through a stable order
+        return ", ".join(parts + ["id"]) if parts else "created_at, id"
+
+def compile_query(filter=None, order_by=None) -> CompiledQuery:
+    """Compile a filter and ordering into SQL; raises QueryError if either is invalid."""
+    compiler = _Compiler()
+    where = compiler.node(filter) if filter else "1"
+    order = compiler.order_by(order_by) if order_by else "created_at, id"
+    return CompiledQuery(where, compiler.params, order, compiler.keys)
+
+# -----------------------------
+# Query Plans
+# -----------------------------
+
+_INDEX_RE = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+def describe_plan(plan: list[str], keys: list[str], indexed_keys: list[str]) -> dict:
+    """
+    Summarize EXPLAIN QUERY PLAN lines: the indexes used, whether every record of
+    the bucket is read, and which metadata keys of the query could be indexed for it.
+    """
+    indexes = []
+    for line in plan:
+        for name in _INDEX_RE.findall(line):
+            if name not in indexes:
+                indexes.append(name)
+    names = {_metadata_index_name(key): key for key in keys}
+    return {
+        "indexes": [f"{name} (metadata key {names[name]!r})" if name in names else name for name in indexes],
+        # Either the whole table, or every record of the bucket through a bucket-only index
+        "full_scan": any(
+            line.startswith("SCAN files") or (line.startswith("SEARCH files") and line.endswith("(bucket=?)"))
+            for line in plan
+        ),
+        "sorts_in_temp_btree": any("USE TEMP B-TREE" in line for line in plan),
+        "suggestions": [
+            f"PUT /api/v1/buckets/{{bucket}}/indexes/{key} to index metadata key {key!r}"
+            for key in keys if key not in indexed_keys
+        ],
+        "details": plan,
+    }
@@ -8,8 +8,46 @@ class Settings(BaseSettings):
     API_KEY_NAME: str = "x-api-key"
     MAX_FILE_SIZE: int = 10 * 1024 * 1024  # 10MB
     STORAGE_DIR: str = "storage"
+    MAX_OBJECT_SIZE: int = 5 * 1024 * 1024 * 1024  # 5GB, per S3 object and per multipart part
+    S3_DEFAULT_TTL_SECONDS: int = 0  # TTL of objects stored through the S3 API, 0 keeps them forever
+    S3_MULTIPART_EXPIRY_SEC: int = 7 * 24 * 3600  # Unfinished multipart uploads are aborted after this
+    STORAGE_LAYOUT: str = "flat"  # "flat" (bucket/filename) or "sharded" (bucket/.shards/ab/cd/<id>)
+    CONTENT_ADDRESSED_STORAGE: bool = False  # Deduplicate uploads into SHA-256 keyed blobs
+    STORAGE_WORKERS: int = 16  # Threads running blocking SQLite and filesystem calls for the routes
+    FILE_WORKERS: int = 8  # Threads moving and unlinking files in bulk operations
+    BATCH_MAX_FILES: int = 1000  # Files accepted by one batch upload
+    BATCH_MAX_IDS: int = 10000  # Record ids accepted by one batch get/delete/patch
     DB_PATH: str = "./data/records_metadata.sqlite"
+    DB_POOL: bool = True  # Reuse one connection per thread instead of connecting per call
+    DB_BUSY_TIMEOUT_MS: int = 5000
+    DB_CACHE_SIZE_KB: int = 16384
+    DB_MMAP_SIZE: int = 256 * 1024 * 1024
+    DB_STATEMENT_CACHE_SIZE: int = 256
+    CACHE_MAX_ENTRIES: int = 10000  # Records kept by each worker's metadata cache, 0 disables it
+    CACHE_MAX_BYTES: int = 32 * 1024 * 1024  # Approximate memory bound of the metadata cache
+    CACHE_TTL_SEC: int = 300  # Longest a record stays cached; records also leave the cache when they expire
+    CACHE_INVALIDATION_RETENTION_SEC: int = 3600  # How long the cross-worker invalidation log is kept
+    METRICS_ENABLED: bool = True  # Serve Prometheus metrics on /metrics and time every request
+    CHANGE_FEED: bool = True  # Log record changes for the /changes endpoints
+    CHANGES_RETENTION_SEC: int = 7 * 24 * 3600  # How long change feed entries are kept
+    CHANGES_POLL_INTERVAL_MS: int = 500  # How often waiting change feed requests look for new entries
+    WEBHOOKS_ENABLED: bool = True  # Run the webhook dispatcher; needs CHANGE_FEED
+    WEBHOOK_WORKERS: int = 4  # Webhook requests in flight per worker process
+    WEBHOOK_BATCH_SIZE: int = 100  # Events sent to a webhook in one request
+    WEBHOOK_QUEUE_SIZE: int = 64  # Batches claimed ahead of the dispatcher's HTTP workers
+    WEBHOOK_TIMEOUT_SEC: int = 10  # Timeout of one webhook request
+    WEBHOOK_MAX_ATTEMPTS: int = 10  # Attempts before an event is marked failed
+    WEBHOOK_RETRY_BASE_SEC: int = 5  # Delay before the first retry, doubled on each further attempt
+    WEBHOOK_RETRY_MAX_SEC: int = 3600  # Longest delay between attempts
+    WEBHOOK_POLL_INTERVAL_MS: int = 1000  # How often the dispatcher looks for new events
+    THUMBNAIL_WORKERS: int = 2  # Processes rendering image derivatives (needs Pillow)
+    THUMBNAIL_MAX_DIMENSION: int = 4096  # Largest width or height a derivative may be requested at
+    THUMBNAIL_MAX_SOURCE_PIXELS: int = 50_000_000  # Larger images are refused rather than decoded
+    DERIVATIVE_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024  # Disk space for rendered derivatives, LRU evicted
     CORS_ORIGINS: list[str] = ["http://localhost:8000"]
+    X_ACCEL_REDIRECT_PREFIX: str = ""  # e.g. "/_protected_files/" to let nginx serve record content
+    CLEANUP_INTERVAL_SEC: int = 60  # Background reaper interval, 0 disables it (deleted buckets are then purged by their delete request)
+    CLEANUP_BATCH_SIZE: int = 1000  # Expired records deleted per transaction
     ENV: str = ENV  # Include ENV if you want to access it from settings later
     class Config:
         env_file = "../.env" if ENV == "dev" else ".env"
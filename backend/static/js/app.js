@@ -11,6 +11,7 @@ function fileNestApp() {
     jsonEditor: null,
     fileSize: '',
     textPreview: '',
+    previewObjectUrl: null,
 
     init() {
       if (this.darkMode) {
@@ -138,14 +139,10 @@ if (this.selectedRecordIsText()) {
   this.textPreview = '';  // Clear if not text file
 }
 
-        // Image preview info (if image)
+        // Image preview info (if image): a scaled copy is enough for the preview, and its
+        // X-Source-* headers give the original dimensions without downloading the full image
         if (fileUrl?.match(/\.(jpg|jpeg|png|gif|bmp|webp)$/i)) {
-          const img = new Image();
-          img.onload = () => {
-            this.imageInfo = `Dimensions: ${img.naturalWidth}x${img.naturalHeight}px`;
-            if (this.fileSize) this.imageInfo += ` | Size: ${this.fileSize}`;
-          };
-          img.src = authFileUrl;
+          this.loadImagePreview(bucket, record_id, authFileUrl);
         }
       } catch (err) {
         alert(err.message);
@@ -153,6 +150,29 @@ if (this.selectedRecordIsText()) {
     },
 
 
+    async loadImagePreview(bucket, record_id, authFileUrl) {
+      const showInfo = (width, height) => {
+        this.imageInfo = `Dimensions: ${width}x${height}px`;
+        if (this.fileSize) this.imageInfo += ` | Size: ${this.fileSize}`;
+      };
+      try {
+        const resp = await fetch(`/api/v1/buckets/${bucket}/records/${record_id}/content?w=640`, {
+          headers: { 'x-api-key': this.apiKey }
+        });
+        if (!resp.ok) throw new Error('No preview rendition');
+        if (this.previewObjectUrl) URL.revokeObjectURL(this.previewObjectUrl);
+        this.previewObjectUrl = URL.createObjectURL(await resp.blob());
+        this.selectedRecord.preview_url = this.previewObjectUrl;
+        showInfo(resp.headers.get('x-source-width'), resp.headers.get('x-source-height'));
+      } catch {
+        // Scaling unavailable (e.g. Pillow not installed): fall back to the original file
+        this.selectedRecord.preview_url = authFileUrl;
+        const img = new Image();
+        img.onload = () => showInfo(img.naturalWidth, img.naturalHeight);
+        img.src = authFileUrl;
+      }
+    },
+
     async updateMetadata() {
       if (!this.selectedRecord || !this.selectedBucket || !this.jsonEditor) {
         alert("No file selected or JSON editor missing");
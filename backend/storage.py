@@ -1,12 +1,27 @@
 import os
 import shutil
-import aiofiles
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 from settings import settings
+from executor import run_storage
+from backends import get_backend
+from cache import record_cache
+from metrics import (
+    DB_COMMIT_SECONDS, DB_LOCKED_ERRORS, DB_TRANSACTION_SECONDS, REAPER_PASS_SECONDS, REAPER_REMOVED,
+    UPLOAD_STAGE_SECONDS, DERIVATIVE_EVICTIONS, Sampled
+)
 import asyncio
 import json
+import base64
+import errno
+import hashlib
+import secrets
+import socket
+import threading
+import time
+import uuid
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------------------------------
 # DB Initialization & Connection
@@ -15,6 +30,282 @@ from contextlib import contextmanager
 os.makedirs(settings.STORAGE_DIR, exist_ok=True)
 os.makedirs(os.path.dirname(settings.DB_PATH), exist_ok=True)
 
+def _ensure_column(conn, table, column, declaration):
+    """Add `column` to `table` if missing. Returns True when the column was added."""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    return True
+
+def _table_exists(conn, name) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def _initialize_bucket_stats(conn):
+    """
+    Per-bucket counters kept in step with `files` by triggers, so they change in
+    the same transaction as every insert, delete and expiry, whatever the code path.
+    """
+    created = not _table_exists(conn, "bucket_stats")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS bucket_stats (
+            bucket TEXT PRIMARY KEY,
+            record_count INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER NOT NULL DEFAULT 0,
+            min_expires_at INTEGER
+        )
+    ''')
+    if created:
+        conn.execute('''
+            INSERT INTO bucket_stats (bucket, record_count, total_bytes, min_expires_at)
+            SELECT bucket, COUNT(*), COALESCE(SUM(size), 0), MIN(expires_at) FROM files GROUP BY bucket
+        ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_bucket_stats_insert AFTER INSERT ON files BEGIN
+            INSERT INTO bucket_stats (bucket, record_count, total_bytes, min_expires_at)
+            VALUES (NEW.bucket, 1, COALESCE(NEW.size, 0), NEW.expires_at)
+            ON CONFLICT (bucket) DO UPDATE SET
+                record_count = record_count + 1,
+                total_bytes = total_bytes + excluded.total_bytes,
+                min_expires_at = MIN(COALESCE(min_expires_at, excluded.min_expires_at),
+                                     COALESCE(excluded.min_expires_at, min_expires_at));
+        END
+    ''')
+    # Only the bucket's earliest expiry needs a lookup, served by idx_bucket_expires_at
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_bucket_stats_delete AFTER DELETE ON files BEGIN
+            UPDATE bucket_stats SET
+                record_count = record_count - 1,
+                total_bytes = total_bytes - COALESCE(OLD.size, 0),
+                min_expires_at = CASE WHEN OLD.expires_at <= min_expires_at
+                    THEN (SELECT MIN(expires_at) FROM files WHERE bucket = OLD.bucket AND expires_at IS NOT NULL)
+                    ELSE min_expires_at END
+            WHERE bucket = OLD.bucket;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_bucket_stats_update AFTER UPDATE OF bucket, size, expires_at ON files BEGIN
+            UPDATE bucket_stats SET
+                record_count = record_count - 1,
+                total_bytes = total_bytes - COALESCE(OLD.size, 0),
+                min_expires_at = (SELECT MIN(expires_at) FROM files WHERE bucket = OLD.bucket AND expires_at IS NOT NULL)
+            WHERE bucket = OLD.bucket;
+            INSERT INTO bucket_stats (bucket, record_count, total_bytes, min_expires_at)
+            VALUES (NEW.bucket, 1, COALESCE(NEW.size, 0), NEW.expires_at)
+            ON CONFLICT (bucket) DO UPDATE SET
+                record_count = record_count + 1,
+                total_bytes = total_bytes + excluded.total_bytes,
+                min_expires_at = (SELECT MIN(expires_at) FROM files WHERE bucket = NEW.bucket AND expires_at IS NOT NULL);
+        END
+    ''')
+
+def _initialize_buckets(conn):
+    """
+    One row per bucket, so empty buckets exist and listing never touches `files`.
+    A non-null deleted_at is a tombstone: the bucket is hidden while the reaper
+    deletes its records in the background.
+    """
+    created = not _table_exists(conn, "buckets")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS buckets (
+            name TEXT PRIMARY KEY,
+            created_at TEXT,
+            deleted_at INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_buckets_deleted_at ON buckets (deleted_at) WHERE deleted_at IS NOT NULL')
+    if created:
+        now = datetime.now(timezone.utc).isoformat()
+        conn.execute("INSERT OR IGNORE INTO buckets (name, created_at) SELECT bucket, ? FROM bucket_stats", (now,))
+        conn.executemany(
+            "INSERT OR IGNORE INTO buckets (name, created_at) VALUES (?, ?)",
+            [(entry.name, now) for entry in os.scandir(settings.STORAGE_DIR)
+             if entry.is_dir() and not entry.name.startswith(".")]
+        )
+
+def _initialize_record_invalidations(conn):
+    """
+    Append-only log of changed record ids, filled by triggers, that each worker's
+    record cache reads to drop stale entries. Expired records and records of a
+    deleted bucket are not logged: their cache entries are already unreachable.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS record_invalidations (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            record_id TEXT,
+            bucket TEXT,
+            created_at INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_record_invalidations_update AFTER UPDATE ON files BEGIN
+            INSERT INTO record_invalidations (record_id, bucket, created_at)
+            VALUES (OLD.id, OLD.bucket, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_record_invalidations_delete AFTER DELETE ON files
+        WHEN (OLD.expires_at IS NULL OR OLD.expires_at > CAST(strftime('%s', 'now') AS INTEGER))
+            AND OLD.bucket NOT IN (SELECT name FROM buckets WHERE deleted_at IS NOT NULL)
+        BEGIN
+            INSERT INTO record_invalidations (record_id, bucket, created_at)
+            VALUES (OLD.id, OLD.bucket, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_record_invalidations_bucket AFTER UPDATE OF deleted_at ON buckets
+        WHEN NEW.deleted_at IS NOT NULL BEGIN
+            INSERT INTO record_invalidations (record_id, bucket, created_at)
+            VALUES (NULL, NEW.name, CAST(strftime('%s', 'now') AS INTEGER));
+        END
+    ''')
+
+# String values of a metadata document, nested ones included, as one text for the search index
+_METADATA_TEXT_SQL = "(SELECT group_concat(value, ' ') FROM json_tree({}) WHERE type = 'text')"
+
+def _initialize_search_index(conn):
+    """
+    FTS5 index over each record's filename and metadata string values, kept in
+    step with `files` by triggers. Its rowid is the rowid of the record, so a
+    VACUUM (which may renumber `files`) must be followed by rebuild_search_index().
+    """
+    created = not _table_exists(conn, "files_fts")
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+            filename_text, metadata_text, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )
+    ''')
+    if created:
+        # Filename hits rank above metadata hits
+        conn.execute("INSERT INTO files_fts (files_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')")
+        _fill_search_index(conn)
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_files_fts_insert AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, filename_text, metadata_text)
+            VALUES (NEW.rowid, NEW.filename, {_METADATA_TEXT_SQL.format("NEW.metadata")});
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_files_fts_delete AFTER DELETE ON files BEGIN
+            DELETE FROM files_fts WHERE rowid = OLD.rowid;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_files_fts_update AFTER UPDATE OF filename, metadata ON files BEGIN
+            UPDATE files_fts
+            SET filename_text = NEW.filename, metadata_text = {_METADATA_TEXT_SQL.format("NEW.metadata")}
+            WHERE rowid = NEW.rowid;
+        END
+    ''')
+
+def _fill_search_index(conn):
+    conn.execute(f'''
+        INSERT INTO files_fts (rowid, filename_text, metadata_text)
+        SELECT rowid, filename, {_METADATA_TEXT_SQL.format("metadata")} FROM files
+    ''')
+
+_CHANGE_TRIGGERS = ("trg_changes_insert", "trg_changes_update", "trg_changes_delete", "trg_changes_bucket")
+
+def _initialize_changes(conn):
+    """
+    Append-only feed of record changes, written by triggers in the same transaction
+    as the change itself. A record deleted after its expiry is logged as "expire";
+    records of a deleted bucket are covered by one "bucket_delete" entry.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            bucket TEXT NOT NULL,
+            record_id TEXT,
+            op TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_changes_bucket_seq ON changes (bucket, seq)')
+    if not settings.CHANGE_FEED:
+        for trigger in _CHANGE_TRIGGERS:
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        return
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_changes_insert AFTER INSERT ON files BEGIN
+            INSERT INTO changes (bucket, record_id, op, created_at) VALUES (NEW.bucket, NEW.id, 'create', {now});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_changes_update AFTER UPDATE OF filename, metadata, size, expires_at ON files
+        BEGIN
+            INSERT INTO changes (bucket, record_id, op, created_at) VALUES (NEW.bucket, NEW.id, 'update', {now});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_changes_delete AFTER DELETE ON files
+        WHEN OLD.bucket NOT IN (SELECT name FROM buckets WHERE deleted_at IS NOT NULL)
+        BEGIN
+            INSERT INTO changes (bucket, record_id, op, created_at)
+            VALUES (OLD.bucket, OLD.id, CASE WHEN OLD.expires_at <= {now} THEN 'expire' ELSE 'delete' END, {now});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_changes_bucket AFTER UPDATE OF deleted_at ON buckets
+        WHEN NEW.deleted_at IS NOT NULL BEGIN
+            INSERT INTO changes (bucket, record_id, op, created_at) VALUES (NEW.name, NULL, 'bucket_delete', {now});
+        END
+    ''')
+
+WEBHOOK_EVENTS = ("create", "update", "delete", "expire", "bucket_delete")
+
+def _initialize_webhooks(conn):
+    """
+    Webhook subscriptions and their outbox. A trigger on the change feed queues one
+    outbox row per matching subscription in the transaction that made the change,
+    with a snapshot of the record when it still exists.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS webhooks (
+            id TEXT PRIMARY KEY,
+            bucket TEXT NOT NULL,
+            url TEXT NOT NULL,
+            secret TEXT NOT NULL,
+            events TEXT NOT NULL,
+            created_at TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_webhooks_bucket ON webhooks (bucket)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            webhook_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            bucket TEXT NOT NULL,
+            record_id TEXT,
+            op TEXT NOT NULL,
+            record TEXT,
+            created_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            last_error TEXT,
+            failed_at INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_webhook_outbox_due ON webhook_outbox (webhook_id, next_attempt_at)
+        WHERE failed_at IS NULL
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_webhook_outbox_webhook ON webhook_outbox (webhook_id)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_webhook_outbox AFTER INSERT ON changes BEGIN
+            INSERT INTO webhook_outbox (webhook_id, seq, bucket, record_id, op, record, created_at, next_attempt_at)
+            SELECT w.id, NEW.seq, NEW.bucket, NEW.record_id, NEW.op, (
+                SELECT json_object('filename', filename, 'size', size, 'metadata', json(metadata),
+                                   'expires_at', expires_at)
+                FROM files WHERE id = NEW.record_id
+            ), NEW.created_at, NEW.created_at
+            FROM webhooks w
+            WHERE w.bucket = NEW.bucket AND EXISTS (SELECT 1 FROM json_each(w.events) WHERE value = NEW.op);
+        END
+    ''')
+
 def initialize_database():
     with sqlite3.connect(settings.DB_PATH) as conn:
         conn.execute("PRAGMA journal_mode=WAL")
@@ -30,27 +321,194 @@ def initialize_database():
                 ttl_seconds INTEGER,
                 metadata TEXT,
                 created_at TEXT,
-                updated_at TEXT
+                updated_at TEXT,
+                expires_at INTEGER,
+                size INTEGER,
+                blob TEXT,
+                etag TEXT,
+                location TEXT
             )
         ''')
+        _ensure_column(conn, "files", "size", "INTEGER")
+        _ensure_column(conn, "files", "blob", "TEXT")
+        _ensure_column(conn, "files", "etag", "TEXT")
+        _ensure_column(conn, "files", "location", "TEXT")
+        if _ensure_column(conn, "files", "expires_at", "INTEGER"):
+            # Databases created before expires_at existed: derive it once from upload_time + ttl
+            conn.execute('''
+                UPDATE files SET expires_at = CAST(strftime('%s', upload_time) AS INTEGER) + ttl_seconds
+                WHERE ttl_seconds > 0
+            ''')
         conn.execute('CREATE INDEX IF NOT EXISTS idx_id ON files (id)')
         conn.execute('CREATE INDEX IF NOT EXISTS idx_bucket ON files (bucket)')
         conn.execute('CREATE INDEX IF NOT EXISTS idx_bucket_id ON files (bucket, id)')
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_ttl ON files (ttl_seconds)')
-        conn.execute('CREATE INDEX IF NOT EXISTS idx_ttl_upload_time ON files (ttl_seconds, upload_time);')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_bucket_created_id ON files (bucket, created_at, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_bucket_filename ON files (bucket, filename)')
+        conn.execute('DROP INDEX IF EXISTS idx_ttl')
+        conn.execute('DROP INDEX IF EXISTS idx_ttl_upload_time')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_expires_at ON files (expires_at) WHERE expires_at IS NOT NULL')
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_bucket_expires_at ON files (bucket, expires_at)
+            WHERE expires_at IS NOT NULL
+        ''')
+
+        _initialize_bucket_stats(conn)
+        _initialize_buckets(conn)
+        _initialize_record_invalidations(conn)
+        _initialize_search_index(conn)
+        _initialize_changes(conn)
+        _initialize_webhooks(conn)
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER,
+                refcount INTEGER NOT NULL,
+                created_at TEXT
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                expires_at INTEGER
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS multipart_uploads (
+                upload_id TEXT PRIMARY KEY,
+                bucket TEXT,
+                key TEXT,
+                metadata TEXT,
+                created_at INTEGER
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS multipart_parts (
+                upload_id TEXT,
+                part_number INTEGER,
+                size INTEGER,
+                etag TEXT,
+                PRIMARY KEY (upload_id, part_number)
+            )
+        ''')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS derivatives (
+                key TEXT PRIMARY KEY,
+                record_id TEXT NOT NULL,
+                extension TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                source_width INTEGER,
+                source_height INTEGER,
+                last_access INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_derivatives_record ON derivatives (record_id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_derivatives_last_access ON derivatives (last_access)')
+
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS metadata_indexes (
+                bucket TEXT,
+                key TEXT,
+                created_at TEXT,
+                PRIMARY KEY (bucket, key)
+            )
+        ''')
         conn.commit()
 
+_local = threading.local()
+_pool = []
+_pool_lock = threading.Lock()
+_pool_generation = 0
+
+def _connect():
+    """Open a connection configured with the per-connection pragmas."""
+    conn = sqlite3.connect(
+        settings.DB_PATH,
+        check_same_thread=False,
+        timeout=settings.DB_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=settings.DB_STATEMENT_CACHE_SIZE,
+    )
+    # Only journal_mode is persisted in the database file; everything else is per connection
+    conn.execute(f"PRAGMA busy_timeout={int(settings.DB_BUSY_TIMEOUT_MS)}")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{int(settings.DB_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size={int(settings.DB_MMAP_SIZE)}")
+    return conn
+
+def _pooled_connection():
+    """Return this thread's long-lived connection, opening it on first use."""
+    key = (settings.DB_PATH, os.getpid(), _pool_generation)
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.key != key:
+        conn = _connect()
+        _local.conn, _local.key, _local.depth = conn, key, 0
+        with _pool_lock:
+            _pool.append(conn)
+    return conn
+
+def close_db():
+    """Close every pooled connection; threads reconnect on their next get_db()."""
+    global _pool_generation
+    with _pool_lock:
+        _pool_generation += 1
+        for conn in _pool:
+            conn.close()
+        _pool.clear()
+    record_cache.clear()
+
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(settings.DB_PATH, check_same_thread=False)
+    """
+    Yield a connection inside a transaction that commits on success.
+
+    With DB_POOL enabled the connection is the calling thread's pooled one, so
+    nested get_db() blocks share the outermost transaction.
+    """
+    if not settings.DB_POOL:
+        conn = _connect()
+        started = time.perf_counter()
+        try:
+            yield conn
+            _commit(conn)
+        except Exception as e:
+            conn.rollback()
+            _count_locked(e)
+            raise
+        finally:
+            conn.close()
+            DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started)
+        return
+
+    conn = _pooled_connection()
+    _local.depth += 1
+    outermost = _local.depth == 1
+    started = time.perf_counter()
     try:
         yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
+        if outermost:
+            _commit(conn)
+    except Exception as e:
+        if outermost:
+            conn.rollback()
+            _count_locked(e)
         raise
     finally:
-        conn.close()
+        _local.depth -= 1
+        if outermost:
+            DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started)
+
+def _commit(conn):
+    with DB_COMMIT_SECONDS.time():
+        conn.commit()
+
+def _count_locked(error):
+    if isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+        DB_LOCKED_ERRORS.inc()
 
 initialize_database()
 
@@ -64,82 +522,405 @@ def get_bucket_path(bucket_name: str) -> str:
 def get_object_path(bucket_name: str, object_key: str) -> str:
     return os.path.join(get_bucket_path(bucket_name), object_key)
 
+def get_blob_path(sha256: str) -> str:
+    backend = get_backend()
+    return backend.path(backend.blob_location(sha256))
+
+def get_multipart_path(upload_id: str) -> str:
+    return get_backend().path(os.path.join(".multipart", upload_id))
+
+def get_derivative_path(key: str, extension: str) -> str:
+    return get_backend().path(os.path.join(".derivatives", key[:2], f"{key}.{extension}"))
+
+def get_upload_dir(bucket_name: str) -> str:
+    """Directory where uploads to a bucket are streamed before being renamed into place."""
+    return get_backend().temp_dir(bucket_name)
+
+def get_part_path(upload_id: str, part_number: int) -> str:
+    return os.path.join(get_multipart_path(upload_id), f"part-{part_number:05d}")
+
+def get_record_path(record) -> str:
+    """
+    Where the bytes of a record live: its blob when content-addressed, else the
+    location it was written to, or bucket/filename for records older than locations.
+    """
+    if record.get("blob"):
+        return get_blob_path(record["blob"])
+    if record.get("location"):
+        return get_backend().path(record["location"])
+    return get_object_path(record["bucket"], record["filename"])
+
 # -----------------------------
 # Bucket Utilities
 # -----------------------------
 
+class BucketDeleting(FileExistsError):
+    """The bucket has been deleted and its contents are still being removed."""
+
+def _claim_bucket(conn, bucket_name: str) -> bool:
+    """
+    Make sure a live bucket row exists. Returns True if it was just created.
+    Raises BucketDeleting if the bucket is tombstoned, so nothing is written into it.
+    """
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO buckets (name, created_at) VALUES (?, ?)",
+        (bucket_name, datetime.now(timezone.utc).isoformat())
+    )
+    if cur.rowcount:
+        return True
+    if conn.execute("SELECT deleted_at FROM buckets WHERE name = ?", (bucket_name,)).fetchone()[0] is not None:
+        raise BucketDeleting(f"Bucket '{bucket_name}' is being deleted")
+    return False
+
 def create_bucket(bucket_name: str, exist_ok: bool = False):
-    os.makedirs(get_bucket_path(bucket_name), exist_ok=exist_ok)
+    """
+    Register a bucket and create its directory.
+
+    Raises FileExistsError if it exists (unless `exist_ok`), and BucketDeleting
+    while a previous bucket of that name is still being purged.
+    """
+    with get_db() as conn:
+        if not _claim_bucket(conn, bucket_name) and not exist_ok:
+            raise FileExistsError(f"Bucket '{bucket_name}' already exists")
+    os.makedirs(get_upload_dir(bucket_name), exist_ok=True)
 
 def delete_bucket(bucket_name: str):
-    bucket_path = get_bucket_path(bucket_name)
-    if os.path.exists(bucket_path):
-        shutil.rmtree(bucket_path)
+    """
+    Tombstone a bucket: it disappears at once, and purge_deleted_buckets() removes
+    its records and files later in bounded batches.
+
+    Raises ValueError if the bucket does not exist.
+    """
     with get_db() as conn:
-        conn.execute("DELETE FROM files WHERE bucket = ?", (bucket_name,))
+        cur = conn.execute(
+            "UPDATE buckets SET deleted_at = ? WHERE name = ? AND deleted_at IS NULL", (_now_epoch(), bucket_name)
+        )
+        if not cur.rowcount:
+            raise ValueError(f"Bucket '{bucket_name}' not found")
+    wake_reaper()
+
+def _purge_bucket(bucket_name: str, batch_size: int) -> int:
+    """Delete a tombstoned bucket batch by batch, then drop its directory and row."""
+    removed = 0
+    while True:
+        with get_db() as conn:
+            batch = [
+                {"id": file_id, "bucket": bucket_name, "filename": filename, "blob": blob, "location": location}
+                for file_id, filename, blob, location in conn.execute(
+                    "SELECT id, filename, blob, location FROM files WHERE bucket = ? LIMIT ?",
+                    (bucket_name, batch_size)
+                )
+            ]
+            if batch:
+                conn.executemany("DELETE FROM files WHERE id = ?", [(record["id"],) for record in batch])
+                paths = _release_files(conn, batch)
+        if not batch:
+            break
+        remove_files(paths)
+        removed += len(batch)
+
+    # Anything left on disk is not referenced by a record
+    for path in get_backend().bucket_dirs(bucket_name):
+        shutil.rmtree(path, ignore_errors=True)
+    with get_db() as conn:
+        conn.execute("DELETE FROM bucket_stats WHERE bucket = ?", (bucket_name,))
+        conn.execute("DELETE FROM metadata_indexes WHERE bucket = ?", (bucket_name,))
+        conn.execute("DELETE FROM buckets WHERE name = ? AND deleted_at IS NOT NULL", (bucket_name,))
+    return removed
+
+def purge_deleted_buckets(batch_size: int = None) -> int:
+    """Finish deleting every tombstoned bucket. Returns the number of records removed."""
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    with get_db() as conn:
+        names = [row[0] for row in conn.execute("SELECT name FROM buckets WHERE deleted_at IS NOT NULL")]
+    return sum(_purge_bucket(name, batch_size) for name in names)
+
+async def purge_deleted_bucket(bucket_name: str) -> int:
+    """
+    Finish deleting one tombstoned bucket now, for deployments running without the
+    reaper. A failure is logged and leaves the bucket to the next /cleanup-expired.
+    """
+    try:
+        purged = await run_storage(_purge_bucket, bucket_name, settings.CLEANUP_BATCH_SIZE)
+    except Exception as e:
+        print(f"[ERROR] Purging deleted bucket '{bucket_name}' failed: {e}")
+        return 0
+    REAPER_REMOVED.inc(purged, reason="bucket_deleted")
+    return purged
 
 def list_buckets() -> list[str]:
     with get_db() as conn:
-        cursor = conn.execute("SELECT DISTINCT bucket FROM files")
+        cursor = conn.execute("SELECT name FROM buckets WHERE deleted_at IS NULL ORDER BY name")
         return [row[0] for row in cursor.fetchall()]
 
+def _stats_to_dict(row):
+    return {"bucket": row[0], "record_count": row[1], "total_bytes": row[2], "min_expires_at": row[3]}
+
+_BUCKET_STATS_SQL = '''
+    SELECT b.name, COALESCE(s.record_count, 0), COALESCE(s.total_bytes, 0), s.min_expires_at
+    FROM buckets b LEFT JOIN bucket_stats s ON s.bucket = b.name
+    WHERE b.deleted_at IS NULL
+'''
+
+def list_bucket_stats() -> list[dict]:
+    """Counters of every bucket; reads only the buckets and bucket_stats tables."""
+    with get_db() as conn:
+        cursor = conn.execute(f"{_BUCKET_STATS_SQL} ORDER BY b.name")
+        return [_stats_to_dict(row) for row in cursor.fetchall()]
+
+def get_bucket_stats(bucket_name: str, expiring_within: int = None):
+    """
+    Counters of one bucket, or None if it does not exist. With `expiring_within`
+    (seconds), also counts records expiring in that window with an index range scan.
+    Records past their TTL but not yet reaped are still counted.
+    """
+    with get_db() as conn:
+        row = conn.execute(f"{_BUCKET_STATS_SQL} AND b.name = ?", (bucket_name,)).fetchone()
+        if not row:
+            return None
+        stats = _stats_to_dict(row)
+        if expiring_within is not None:
+            stats["expiring_soon"] = conn.execute(
+                "SELECT COUNT(*) FROM files WHERE bucket = ? AND expires_at <= ?",
+                (bucket_name, _now_epoch() + expiring_within)
+            ).fetchone()[0]
+        return stats
+
 # -----------------------------
 # File Utilities
 # -----------------------------
 
-async def save_file_bytes(file_path: str, file_bytes: bytes):
-    if len(file_bytes) > settings.MAX_FILE_SIZE:
-        raise ValueError("File too large")
+_file_pool = None
 
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    async with aiofiles.open(file_path, "wb") as out:
-        await out.write(file_bytes)
-    os.chmod(file_path, 0o644)
+def file_pool() -> ThreadPoolExecutor:
+    """Thread pool for parallel file moves and unlinks."""
+    global _file_pool
+    if _file_pool is None:
+        _file_pool = ThreadPoolExecutor(max_workers=settings.FILE_WORKERS, thread_name_prefix="filenest-files")
+    return _file_pool
 
-async def save_uploadfile(file, file_path: str):
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    size = 0
-    await file.seek(0)
-    async with aiofiles.open(file_path, "wb") as out:
-        while True:
-            chunk = await file.read(1024 * 1024)
-            if not chunk:
-                break
-            size += len(chunk)
-            if size > settings.MAX_FILE_SIZE:
-                raise ValueError("File too large")
-            await out.write(chunk)
-    os.chmod(file_path, 0o644)
+def _remove_file(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError as e:
+        print(f"[ERROR] Failed to delete {path}: {e}")
+        return False
+
+def remove_files(paths) -> int:
+    """Unlink files in parallel on the file pool. Returns how many were removed."""
+    paths = list(paths)
+    if not paths:
+        return 0
+    return sum(file_pool().map(_remove_file, paths))
+
+def _move_into_place(temp_path: str, final_path: str):
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    try:
+        os.replace(temp_path, final_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # The backend placed the file on another filesystem than the upload directory
+        shutil.move(temp_path, final_path)
 
 # -----------------------------
 # Metadata Operations
 # -----------------------------
 
-def insert_file_metadata(file_id, filename, bucket, ttl_seconds, metadata):
-    now = datetime.utcnow().isoformat()
+_RECORD_COLUMNS = (
+    "id, bucket, filename, upload_time, ttl_seconds, metadata, created_at, updated_at, expires_at, size, blob, etag,"
+    " location"
+)
+
+# Not expired, and not in a bucket whose deletion is in progress
+_VISIBLE_SQL = (
+    "(expires_at IS NULL OR expires_at > ?)"
+    " AND bucket NOT IN (SELECT name FROM buckets WHERE deleted_at IS NOT NULL)"
+)
+
+def _now_epoch() -> int:
+    return int(time.time())
+
+def _expires_at(now: datetime, ttl_seconds):
+    """Epoch second at which a record uploaded at `now` (UTC) expires, or None if it never does."""
+    if not ttl_seconds or ttl_seconds <= 0:
+        return None
+    return int(now.replace(tzinfo=timezone.utc).timestamp()) + ttl_seconds
+
+_INSERT_RECORD_SQL = '''
+    INSERT INTO files (id, bucket, filename, upload_time, ttl_seconds, metadata, created_at, updated_at,
+                       expires_at, size, blob, etag, location)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def _record_row(file_id, filename, bucket, ttl_seconds, metadata, size=None, blob=None, etag=None, location=None):
+    now = datetime.utcnow()
+    now_iso = now.isoformat()
+    return (file_id, bucket, filename, now_iso, ttl_seconds, json.dumps(metadata or {}), now_iso, now_iso,
+            _expires_at(now, ttl_seconds), size, blob, etag, location)
+
+def _insert_record(conn, file_id, filename, bucket, ttl_seconds, metadata, size=None, blob=None, etag=None,
+                   location=None):
+    _claim_bucket(conn, bucket)
+    conn.execute(_INSERT_RECORD_SQL,
+                 _record_row(file_id, filename, bucket, ttl_seconds, metadata, size, blob, etag, location))
+
+def insert_file_metadata(file_id, filename, bucket, ttl_seconds, metadata, size=None, blob=None, location=None):
     with get_db() as conn:
-        conn.execute('''
-            INSERT INTO files (id, bucket, filename, upload_time, ttl_seconds, metadata, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (file_id, bucket, filename, now, ttl_seconds, json.dumps(metadata or {}), now, now))
+        _insert_record(conn, file_id, filename, bucket, ttl_seconds, metadata, size, blob, location=location)
+
+def store_record(file_id, filename, bucket, ttl_seconds, metadata, temp_path, size, sha256=None):
+    """
+    Insert a record and move its uploaded temp file into place.
+
+    With CONTENT_ADDRESSED_STORAGE and a checksum, the file becomes (or joins) the
+    blob for its SHA-256: a duplicate costs one metadata insert and its temp file
+    is dropped. Otherwise it is renamed to the location chosen by the storage backend.
+
+    Returns the stored record's blob and location, for building its URL.
+    """
+    if settings.CONTENT_ADDRESSED_STORAGE and sha256:
+        # The blob is moved into place inside the transaction
+        with UPLOAD_STAGE_SECONDS.time(stage="db_insert"), get_db() as conn:
+            _insert_record(conn, file_id, filename, bucket, ttl_seconds, metadata, size, sha256)
+            _acquire_blob(conn, sha256, size, temp_path)
+        return {"blob": sha256, "location": None}
+
+    backend = get_backend()
+    location = backend.location(bucket, file_id, filename)
+    final_path = backend.path(location)
+    moved = False
+    try:
+        # The file is moved inside the transaction, so a failed move rolls the record back
+        with get_db() as conn:
+            with UPLOAD_STAGE_SECONDS.time(stage="db_insert"):
+                _insert_record(conn, file_id, filename, bucket, ttl_seconds, metadata, size, location=location)
+            with UPLOAD_STAGE_SECONDS.time(stage="move"):
+                _move_into_place(temp_path, final_path)
+            moved = True
+    except Exception:
+        if moved:
+            # The commit failed: hand the file back to the caller as its temp file
+            _move_into_place(final_path, temp_path)
+        raise
+    return {"blob": None, "location": location}
+
+def store_records(bucket, items):
+    """
+    Batch version of store_record: the files are moved into place in parallel, then
+    the rows of those that arrived are inserted with one executemany, all inside a
+    single transaction.
+
+    `items` are dicts with id, filename, ttl_seconds, metadata, temp_path, size and
+    sha256; each gets the "blob" and "location" it was stored with, or an "error"
+    if its file could not be moved (it then has no record and keeps its temp file).
+    """
+    content_addressed = settings.CONTENT_ADDRESSED_STORAGE
+    backend = get_backend()
+    for item in items:
+        item["blob"] = item["sha256"] if content_addressed else None
+        item["location"] = None if content_addressed else backend.location(bucket, item["id"], item["filename"])
+
+    def move(item):
+        try:
+            _move_into_place(item["temp_path"], backend.path(item["location"]))
+        except OSError as e:
+            item["error"] = f"Failed to store file: {e.strerror or e}"
+
+    moved = []
+    try:
+        with get_db() as conn:
+            _claim_bucket(conn, bucket)
+            if not content_addressed:
+                list(file_pool().map(move, items))
+                moved = [item for item in items if "error" not in item]
+            conn.executemany(_INSERT_RECORD_SQL, [
+                _record_row(item["id"], item["filename"], bucket, item["ttl_seconds"], item["metadata"],
+                            item["size"], item["blob"], location=item["location"])
+                for item in items if "error" not in item
+            ])
+            if content_addressed:
+                for item in items:
+                    _acquire_blob(conn, item["sha256"], item["size"], item["temp_path"])
+    except Exception:
+        # The transaction rolled back: hand the moved files back to the caller as temp files
+        for item in moved:
+            _move_into_place(backend.path(item["location"]), item["temp_path"])
+        raise
 
 def get_file_metadata_by_id(file_id, bucket):
+    """The live record `file_id` of `bucket`, or None. Served from the record cache when enabled."""
     with get_db() as conn:
-        row = conn.execute("SELECT * FROM files WHERE id = ? AND bucket = ?", (file_id, bucket)).fetchone()
-        return _row_to_dict(row) if row else None
+        if not record_cache.enabled:
+            row = conn.execute(
+                f"SELECT {_RECORD_COLUMNS} FROM files WHERE id = ? AND bucket = ? AND {_VISIBLE_SQL}",
+                (file_id, bucket, _now_epoch())
+            ).fetchone()
+            return _row_to_dict(row) if row else None
+
+        seen = record_cache.sync(conn)
+        row = record_cache.get(file_id)
+        if row is None:
+            # Cache by id alone so the entry serves whichever bucket is asked for
+            row = conn.execute(
+                f"SELECT {_RECORD_COLUMNS} FROM files WHERE id = ? AND {_VISIBLE_SQL}", (file_id, _now_epoch())
+            ).fetchone()
+            if row is None:
+                return None
+            record_cache.put(row, seen, row[8])
+        return _row_to_dict(row) if row[1] == bucket else None
 
 def remove_file_metadata(file_id, bucket):
     with get_db() as conn:
         conn.execute("DELETE FROM files WHERE id = ? AND bucket = ?", (file_id, bucket))
 
+def delete_record(file_id, bucket):
+    """
+    Delete a live record and its bytes. Returns the deleted record, or None if not found.
+    """
+    with get_db() as conn:
+        row = conn.execute(
+            f"SELECT {_RECORD_COLUMNS} FROM files WHERE id = ? AND bucket = ? AND {_VISIBLE_SQL}",
+            (file_id, bucket, _now_epoch())
+        ).fetchone()
+        if not row:
+            return None
+        record = _row_to_dict(row)
+        conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        paths = _release_files(conn, [record])
+    remove_files(paths)
+    return record
+
 def update_metadata(file_id, bucket, metadata):
     now = datetime.utcnow().isoformat()
     with get_db() as conn:
-        cur = conn.execute('''
-            UPDATE files SET metadata = ?, updated_at = ? WHERE id = ? AND bucket = ?
-        ''', (json.dumps(metadata), now, file_id, bucket))
+        cur = conn.execute(f'''
+            UPDATE files SET metadata = ?, updated_at = ? WHERE id = ? AND bucket = ? AND {_VISIBLE_SQL}
+        ''', (json.dumps(metadata), now, file_id, bucket, _now_epoch()))
         return cur.rowcount > 0
 
+def set_metadata_fields(file_id, bucket, fields):
+    """
+    Set top-level metadata fields of a live record with a single json_set UPDATE,
+    so concurrent writers of other fields never lose each other's changes.
+    Returns the new metadata, or None if the record was not found.
+    """
+    assignments = ", ".join("?, json(?)" for _ in fields)
+    params = []
+    for key, value in fields.items():
+        params += [_metadata_path(key), json.dumps(value)]
+    now = datetime.utcnow().isoformat()
+    with get_db() as conn:
+        row = conn.execute(f'''
+            UPDATE files SET metadata = json_set(COALESCE(metadata, '{{}}'), {assignments}), updated_at = ?
+            WHERE id = ? AND bucket = ? AND {_VISIBLE_SQL}
+            RETURNING metadata
+        ''', params + [now, file_id, bucket, _now_epoch()]).fetchone()
+        return json.loads(row[0]) if row else None
+
 def _row_to_dict(row):
     return {
         "id": row[0],
@@ -150,80 +931,1040 @@ def _row_to_dict(row):
         "metadata": json.loads(row[5]) if row[5] else {},
         "created_at": row[6],
         "updated_at": row[7],
+        "expires_at": row[8],
+        "size": row[9],
+        "blob": row[10],
+        "etag": row[11],
+        "location": row[12],
     }
 
-def is_expired(record):
+# -----------------------------
+# Content-Addressed Blobs
+# -----------------------------
+
+# Blob files are only created and unlinked while the transaction that changed their
+# refcount holds the SQLite write lock, so a concurrent upload of the same content
+# can never see a blob row whose file is about to disappear.
+
+def _acquire_blob(conn, sha256, size, temp_path):
+    """Take a reference on a blob inside `conn`'s transaction, installing temp_path if it is new."""
+    now = datetime.utcnow().isoformat()
+    conn.execute('''
+        INSERT INTO blobs (sha256, size, refcount, created_at) VALUES (?, ?, 1, ?)
+        ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1
+    ''', (sha256, size, now))
+    blob_path = get_blob_path(sha256)
+    if os.path.exists(blob_path):
+        os.remove(temp_path)
+    else:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(temp_path, blob_path)
+
+def _release_blobs(conn, blob_refs):
+    """Drop (sha256, count) references inside `conn`'s transaction, unlinking unreferenced blobs."""
+    if not blob_refs:
+        return
+    conn.executemany("UPDATE blobs SET refcount = refcount - ? WHERE sha256 = ?",
+                     [(count, sha256) for sha256, count in blob_refs])
+    for (sha256,) in conn.execute("DELETE FROM blobs WHERE refcount <= 0 RETURNING sha256").fetchall():
+        _remove_file(get_blob_path(sha256))
+
+def _release_files(conn, records) -> list[str]:
+    """
+    Release the bytes of records just deleted in `conn`'s transaction.
+
+    Blob references are dropped right away; the returned plain file paths are
+    for the caller to unlink once the transaction has committed.
+    """
+    blob_refs = {}
+    paths = []
+    for record in records:
+        if record.get("blob"):
+            blob_refs[record["blob"]] = blob_refs.get(record["blob"], 0) + 1
+        else:
+            paths.append(get_record_path(record))
+    _release_blobs(conn, list(blob_refs.items()))
+    return paths + _release_derivatives(conn, [record["id"] for record in records])
+
+# -----------------------------
+# Derivatives
+# -----------------------------
+
+# Cached renders (thumbnails) of record content live under .derivatives, named
+# after a key derived from the record, its content ETag and the render options.
+# The table tracks their size and last use for the LRU bound; the rows go away
+# in the transaction deleting their record, and the files right after it.
+
+def _release_derivatives(conn, record_ids) -> list[str]:
+    rows = conn.execute(
+        "DELETE FROM derivatives WHERE record_id IN (SELECT value FROM json_each(?)) RETURNING key, extension",
+        (json.dumps(record_ids),)
+    ).fetchall()
+    return [get_derivative_path(key, extension) for key, extension in rows]
+
+def get_derivative(key: str):
+    """(source_width, source_height) of a cached derivative, marking it used; None if not cached."""
+    now = _now_epoch()
+    with get_db() as conn:
+        row = conn.execute("SELECT source_width, source_height, last_access FROM derivatives WHERE key = ?",
+                           (key,)).fetchone()
+        # Recording each use would make every hit a write; a minute's precision is plenty for LRU
+        if row and row[2] < now - 60:
+            conn.execute("UPDATE derivatives SET last_access = ? WHERE key = ?", (now, key))
+    return row[:2] if row else None
+
+def add_derivative(key: str, record_id: str, extension: str, source_size, max_bytes: int = None) -> bool:
+    """
+    Record a freshly rendered derivative, then evict the least recently used
+    others until the cache fits in `max_bytes`. Returns False (and removes the
+    file) if the record was deleted while it was being rendered.
+    """
+    max_bytes = max_bytes if max_bytes is not None else settings.DERIVATIVE_CACHE_MAX_BYTES
+    path = get_derivative_path(key, extension)
+    size = os.path.getsize(path)
+    stale_paths = []
+    with get_db() as conn:
+        added = conn.execute('''
+            INSERT OR REPLACE INTO derivatives
+                (key, record_id, extension, size, source_width, source_height, last_access)
+            SELECT ?, ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM files WHERE id = ?)
+        ''', (key, record_id, extension, size, *source_size, _now_epoch(), record_id)).rowcount
+        if not added:
+            stale_paths.append(path)
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM derivatives").fetchone()[0] - max_bytes
+        evicted = []
+        if excess > 0:
+            for old_key, old_extension, old_size in conn.execute(
+                "SELECT key, extension, size FROM derivatives WHERE key != ? ORDER BY last_access, key", (key,)
+            ):
+                evicted.append(old_key)
+                stale_paths.append(get_derivative_path(old_key, old_extension))
+                excess -= old_size
+                if excess <= 0:
+                    break
+            conn.execute("DELETE FROM derivatives WHERE key IN (SELECT value FROM json_each(?))",
+                         (json.dumps(evicted),))
+    for stale_path in stale_paths:
+        _remove_file(stale_path)
+    if evicted:
+        DERIVATIVE_EVICTIONS.inc(len(evicted))
+    return bool(added)
+
+def derivative_cache_usage() -> dict:
+    with get_db() as conn:
+        count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM derivatives").fetchone()
+    return {"entries": count, "bytes": size}
+
+Sampled("filenest_derivative_cache_bytes", "Size of the cached image derivatives",
+        lambda: derivative_cache_usage()["bytes"])
+
+# -----------------------------
+# Metadata Search & Indexes
+# -----------------------------
+
+def _metadata_path(key: str) -> str:
+    """JSON path literal selecting a top-level metadata key."""
+    if not key or '"' in key or "\\" in key:
+        raise ValueError(f"Unsupported metadata key: {key!r}")
+    return f'$."{key}"'
+
+def _metadata_expr(key: str, func: str = "json_extract") -> str:
+    # The path is inlined rather than bound so the expression is identical to
+    # the one used by the expression index and the query planner can match it.
+    path = _metadata_path(key).replace("'", "''")
+    return f"{func}(metadata, '{path}')"
+
+def _metadata_index_name(key: str) -> str:
+    return "idx_meta_" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(number) if number.is_integer() else number
+
+def _metadata_predicate(key, value, value_type="string"):
+    """
+    Build an SQL predicate (and its parameters) matching metadata[key] == value.
+
+    Matching is as loose as the original Python cast-and-compare: a string search
+    for "5" also finds the number 5, a number search also finds the string "5",
+    and a boolean search also finds the strings "true"/"false" in any case. The
+    string and number forms stay a plain IN over the metadata expression, so an
+    indexed key is still searched through its index; json_extract() reports JSON
+    booleans as 1/0, so those forms also exclude them by json_type().
+    """
+    expr = _metadata_expr(key)
+    json_type = _metadata_expr(key, 'json_type')
+    if value_type == "string":
+        number = _number(value)
+        if number is None:
+            return f"{expr} = ?", [str(value)]
+        return f"{expr} IN (?, ?) AND {json_type} NOT IN ('true', 'false')", [str(value), number]
+    if value_type == "number":
+        number = _number(value)
+        if number is None:
+            raise ValueError(f"Invalid number value: {value!r}")
+        return f"{expr} IN (?, ?) AND {json_type} NOT IN ('true', 'false')", [number, str(value)]
+    if value_type == "boolean":
+        flag = str(value).lower() == "true"
+        return (
+            f"(({expr} = ? AND {json_type} IN ('true', 'false')) OR ({json_type} = 'text' AND lower({expr}) = ?))",
+            [int(flag), "true" if flag else "false"]
+        )
+    if value_type == "datetime":
+        try:
+            moment = datetime.fromisoformat(str(value))
+        except ValueError:
+            raise ValueError(f"Invalid datetime value: {value!r}")
+        return f"julianday({expr}) = julianday(?)", [moment.isoformat()]
+    raise ValueError(f"Unsupported value type: {value_type!r}")
+
+def encode_cursor(record) -> str:
+    """Opaque pagination cursor pointing just after `record` in (created_at, id) order."""
+    raw = json.dumps([record["created_at"], record["id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+        return str(created_at), str(record_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+def search_metadata(bucket, key=None, value=None, value_type="string", limit=50, cursor=None):
+    """
+    Return one page of live records in `bucket`, ordered by (created_at, id).
+
+    Pages are keyset-paginated over idx_bucket_created_id, so every page costs the
+    same however deep it is. Returns (records, next_cursor); next_cursor is None on
+    the last page.
+    """
+    sql = f"SELECT {_RECORD_COLUMNS} FROM files WHERE bucket = ? AND {_VISIBLE_SQL}"
+    params = [bucket, _now_epoch()]
+    if key and value is not None:
+        predicate, predicate_params = _metadata_predicate(key, value, value_type)
+        sql += f" AND {predicate}"
+        params += predicate_params
+    if cursor:
+        sql += " AND (created_at, id) > (?, ?)"
+        params += decode_cursor(cursor)
+    sql += " ORDER BY created_at, id LIMIT ?"
+    params.append(limit + 1)
+
+    with get_db() as conn:
+        records = [_row_to_dict(row) for row in conn.execute(sql, params).fetchall()]
+    if len(records) > limit:
+        records = records[:limit]
+        return records, encode_cursor(records[-1])
+    return records, None
+
+def _fts_query(text: str) -> str:
+    """
+    FTS5 query requiring every word of `text`, each quoted so punctuation is just a
+    separator rather than query syntax. A trailing * keeps the word a prefix match.
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    if not terms:
+        raise ValueError("Empty search query")
+    return " ".join(terms)
+
+def encode_search_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_search_cursor(cursor: str) -> int:
     try:
-        ttl = record.get("ttl_seconds")
-        if ttl == 0 or not ttl:
+        offset = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))["offset"]
+        if not isinstance(offset, int) or offset < 0:
+            raise ValueError
+        return offset
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Invalid cursor")
+
+def search_text(bucket, query, key=None, value=None, value_type="string", limit=50, cursor=None):
+    """
+    Return one page of live records in `bucket` whose filename or metadata string
+    values contain every word of `query`, best matches (bm25) first.
+
+    Matching is an FTS5 index lookup; the metadata key/value filter, if any, only
+    applies to the matches. The ranking shifts as records change, so pages are
+    offsets into it rather than keyset cursors. Returns (records, next_cursor).
+    """
+    sql = f'''
+        SELECT {_RECORD_COLUMNS} FROM files_fts JOIN files ON files.rowid = files_fts.rowid
+        WHERE files_fts MATCH ? AND bucket = ? AND {_VISIBLE_SQL}
+    '''
+    params = [_fts_query(query), bucket, _now_epoch()]
+    if key and value is not None:
+        predicate, predicate_params = _metadata_predicate(key, value, value_type)
+        sql += f" AND {predicate}"
+        params += predicate_params
+    offset = decode_search_cursor(cursor) if cursor else 0
+    sql += " ORDER BY rank LIMIT ? OFFSET ?"
+    params += [limit + 1, offset]
+
+    with get_db() as conn:
+        records = [_row_to_dict(row) for row in conn.execute(sql, params).fetchall()]
+    if len(records) > limit:
+        return records[:limit], encode_search_cursor(offset + limit)
+    return records, None
+
+def query_records(bucket, where="1", params=(), order_by="created_at, id", limit=50, cursor=None, explain=False):
+    """
+    Return one page of live records in `bucket` matching a WHERE clause compiled by
+    query.compile_query(), in `order_by` order. Pages are offsets, as in search_text().
+
+    Returns (records, next_cursor, plan), where plan holds the EXPLAIN QUERY PLAN
+    lines of the query when `explain` is set and is None otherwise.
+    """
+    sql = f'''
+        SELECT {_RECORD_COLUMNS} FROM files WHERE bucket = ? AND {_VISIBLE_SQL} AND ({where})
+        ORDER BY {order_by} LIMIT ? OFFSET ?
+    '''
+    offset = decode_search_cursor(cursor) if cursor else 0
+    params = [bucket, _now_epoch(), *params, limit + 1, offset]
+
+    with get_db() as conn:
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)] if explain else None
+        records = [_row_to_dict(row) for row in conn.execute(sql, params).fetchall()]
+    if len(records) > limit:
+        return records[:limit], encode_search_cursor(offset + limit), plan
+    return records, None, plan
+
+def rebuild_search_index():
+    """Re-create every entry of the full-text index from `files`."""
+    with get_db() as conn:
+        conn.execute("DELETE FROM files_fts")
+        _fill_search_index(conn)
+
+def add_metadata_index(bucket, key):
+    """
+    Declare `key` as an indexed metadata key for `bucket`.
+
+    The backing expression index is shared by every bucket declaring the same key
+    and only covers rows that actually carry it.
+    """
+    expr = _metadata_expr(key)
+    now = datetime.utcnow().isoformat()
+    with get_db() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO metadata_indexes (bucket, key, created_at) VALUES (?, ?, ?)",
+            (bucket, key, now)
+        )
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {_metadata_index_name(key)} "
+            f"ON files (bucket, {expr}) WHERE {expr} IS NOT NULL"
+        )
+
+def remove_metadata_index(bucket, key):
+    with get_db() as conn:
+        cur = conn.execute("DELETE FROM metadata_indexes WHERE bucket = ? AND key = ?", (bucket, key))
+        if cur.rowcount == 0:
             return False
-        upload_dt = datetime.fromisoformat(record.get("upload_time"))
-        return datetime.utcnow() > (upload_dt + timedelta(seconds=ttl))
-    except:
-        return False
+        still_used = conn.execute("SELECT 1 FROM metadata_indexes WHERE key = ? LIMIT 1", (key,)).fetchone()
+        if not still_used:
+            conn.execute(f"DROP INDEX IF EXISTS {_metadata_index_name(key)}")
+        return True
 
-def search_metadata(bucket, key=None, value=None, value_type="string", limit=50):
+def list_metadata_indexes(bucket) -> list[str]:
     with get_db() as conn:
-        cursor = conn.execute("SELECT * FROM files WHERE bucket = ?", (bucket,))
-        results = []
+        cursor = conn.execute("SELECT key FROM metadata_indexes WHERE bucket = ? ORDER BY key", (bucket,))
+        return [row[0] for row in cursor.fetchall()]
 
-        def cast(v, t):
-            try:
-                if t == "string": return str(v)
-                if t == "boolean": return str(v).lower() == "true"
-                if t == "number": return float(v) if '.' in str(v) else int(v)
-                if t == "datetime": return datetime.fromisoformat(str(v))
-            except: return v
-
-        for row in cursor.fetchall():
-            record = _row_to_dict(row)
-            if is_expired(record): continue
-            if key and value is not None:
-                meta = record.get("metadata", {})
-                if meta.get(key) is None: continue
-                if cast(meta[key], value_type) != cast(value, value_type): continue
-            results.append(record)
-            if len(results) >= limit:
+# -----------------------------
+# Bulk Operations
+# -----------------------------
+
+def _selection_sql(bucket, ids=None, key=None, value=None, value_type="string"):
+    """
+    WHERE clause (and parameters) selecting live records of `bucket` by an id list
+    and/or a metadata filter. The id list is bound as one JSON array, so it is not
+    limited by SQLite's maximum number of parameters.
+    """
+    sql = f"bucket = ? AND {_VISIBLE_SQL}"
+    params = [bucket, _now_epoch()]
+    if ids is not None:
+        sql += " AND id IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(ids)))
+    if key and value is not None:
+        predicate, predicate_params = _metadata_predicate(key, value, value_type)
+        sql += f" AND {predicate}"
+        params += predicate_params
+    return sql, params
+
+def get_records(bucket, ids=None, key=None, value=None, value_type="string", limit=None):
+    where, params = _selection_sql(bucket, ids, key, value, value_type)
+    sql = f"SELECT {_RECORD_COLUMNS} FROM files WHERE {where} ORDER BY created_at, id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    with get_db() as conn:
+        return [_row_to_dict(row) for row in conn.execute(sql, params).fetchall()]
+
+def delete_records(bucket, ids=None, key=None, value=None, value_type="string") -> int:
+    """Delete the selected records in one transaction, then unlink their files in parallel."""
+    where, params = _selection_sql(bucket, ids, key, value, value_type)
+    with get_db() as conn:
+        deleted = [
+            {"id": file_id, "bucket": bucket, "filename": filename, "blob": blob, "location": location}
+            for file_id, filename, blob, location in conn.execute(
+                f"DELETE FROM files WHERE {where} RETURNING id, filename, blob, location", params
+            ).fetchall()
+        ]
+        paths = _release_files(conn, deleted)
+    remove_files(paths)
+    return len(deleted)
+
+def patch_records(bucket, patch, ids=None, key=None, value=None, value_type="string") -> int:
+    """
+    Merge `patch` into the metadata of the selected records with one json_patch
+    UPDATE (RFC 7396: a null value removes the key). Returns the number of records changed.
+    """
+    where, params = _selection_sql(bucket, ids, key, value, value_type)
+    now = datetime.utcnow().isoformat()
+    with get_db() as conn:
+        cur = conn.execute(
+            f"UPDATE files SET metadata = json_patch(metadata, ?), updated_at = ? WHERE {where}",
+            [json.dumps(patch), now] + params
+        )
+        return cur.rowcount
+
+# -----------------------------
+# S3 Objects
+# -----------------------------
+
+# An S3 object is a record whose filename is the object key; putting a key again
+# replaces every record of that key, so a key maps to at most one live record.
+
+def get_object_record(bucket, key):
+    """The live record stored under an object key, or None."""
+    with get_db() as conn:
+        row = conn.execute(
+            f"""SELECT {_RECORD_COLUMNS} FROM files WHERE bucket = ? AND filename = ? AND {_VISIBLE_SQL}
+                ORDER BY created_at DESC LIMIT 1""",
+            (bucket, key, _now_epoch())
+        ).fetchone()
+        return _row_to_dict(row) if row else None
+
+def _replace_object(conn, bucket, key, temp_path, size, etag, metadata, ttl_seconds):
+    """
+    Swap in a new record and file for `key` inside `conn`'s transaction.
+    Returns the record id and the replaced files to unlink once committed.
+    """
+    replaced = [
+        {"id": file_id, "bucket": bucket, "filename": key, "blob": blob, "location": location}
+        for file_id, blob, location in conn.execute(
+            "DELETE FROM files WHERE bucket = ? AND filename = ? RETURNING id, blob, location", (bucket, key)
+        ).fetchall()
+    ]
+    stale_paths = set(_release_files(conn, replaced))
+    file_id = str(uuid.uuid4())
+    backend = get_backend()
+    location = backend.location(bucket, file_id, key)
+    _insert_record(conn, file_id, key, bucket, ttl_seconds, metadata, size, etag=etag, location=location)
+    # Renaming while holding the write lock keeps the file of concurrent PUTs in commit order
+    final_path = backend.path(location)
+    _move_into_place(temp_path, final_path)
+    # In the flat layout the new file overwrote the old one at the same path
+    stale_paths.discard(final_path)
+    return file_id, stale_paths
+
+def put_object(bucket, key, temp_path, size, etag, metadata=None, ttl_seconds=None) -> str:
+    """
+    Store an uploaded temp file as object `key`, replacing any previous version.
+    Raises BucketDeleting if the bucket is being deleted. Returns the record id.
+    """
+    ttl_seconds = settings.S3_DEFAULT_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+    with get_db() as conn:
+        file_id, stale_paths = _replace_object(conn, bucket, key, temp_path, size, etag, metadata, ttl_seconds)
+    remove_files(stale_paths)
+    return file_id
+
+def delete_object(bucket, key) -> int:
+    """Delete object `key` and its file. Returns the number of records removed."""
+    with get_db() as conn:
+        deleted = [
+            {"id": file_id, "bucket": bucket, "filename": key, "blob": blob, "location": location}
+            for file_id, blob, location in conn.execute(
+                f"""DELETE FROM files WHERE bucket = ? AND filename = ? AND {_VISIBLE_SQL}
+                    RETURNING id, blob, location""",
+                (bucket, key, _now_epoch())
+            ).fetchall()
+        ]
+        paths = _release_files(conn, deleted)
+    remove_files(set(paths))
+    return len(deleted)
+
+def create_multipart_upload(bucket, key, metadata=None) -> str:
+    """Start a multipart upload of `key`. Returns its upload id."""
+    upload_id = uuid.uuid4().hex
+    with get_db() as conn:
+        _claim_bucket(conn, bucket)
+        conn.execute(
+            "INSERT INTO multipart_uploads (upload_id, bucket, key, metadata, created_at) VALUES (?, ?, ?, ?, ?)",
+            (upload_id, bucket, key, json.dumps(metadata or {}), _now_epoch())
+        )
+    os.makedirs(get_multipart_path(upload_id), exist_ok=True)
+    return upload_id
+
+def get_multipart_upload(upload_id):
+    with get_db() as conn:
+        row = conn.execute(
+            "SELECT upload_id, bucket, key, metadata, created_at FROM multipart_uploads WHERE upload_id = ?",
+            (upload_id,)
+        ).fetchone()
+    if not row:
+        return None
+    return {"upload_id": row[0], "bucket": row[1], "key": row[2], "metadata": json.loads(row[3] or "{}"),
+            "created_at": row[4]}
+
+def put_part(upload_id, part_number, temp_path, size, etag) -> bool:
+    """
+    Store an uploaded temp file as part `part_number`, replacing an earlier upload
+    of the same part. Returns False if the upload does not exist.
+    """
+    with get_db() as conn:
+        if not conn.execute("SELECT 1 FROM multipart_uploads WHERE upload_id = ?", (upload_id,)).fetchone():
+            return False
+        conn.execute('''
+            INSERT INTO multipart_parts (upload_id, part_number, size, etag) VALUES (?, ?, ?, ?)
+            ON CONFLICT (upload_id, part_number) DO UPDATE SET size = excluded.size, etag = excluded.etag
+        ''', (upload_id, part_number, size, etag))
+        os.replace(temp_path, get_part_path(upload_id, part_number))
+    return True
+
+def _append_file(out, path):
+    """Append the file at `path` to the open file `out`, copying inside the kernel when possible."""
+    with open(path, "rb") as src:
+        remaining = os.fstat(src.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), out.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        except (AttributeError, OSError):
+            # No copy_file_range (not Linux, or unsupported by the filesystem): buffered copy of the rest
+            src.seek(-remaining, os.SEEK_END)
+            out.seek(0, os.SEEK_END)
+        shutil.copyfileobj(src, out, 1024 * 1024)
+
+class MultipartCompleting(Exception):
+    """Another request is already completing this multipart upload."""
+
+# Longest a completion may hold an upload before another request can take it over
+_ASSEMBLY_LEASE_SEC = 3600
+
+def complete_multipart_upload(upload_id, parts, ttl_seconds=None):
+    """
+    Assemble the listed parts, (part number, ETag) pairs in ascending order, into
+    the upload's object. The other parts are appended onto the first part's file,
+    which is then renamed into place, so a single-part upload is just a rename.
+
+    Returns (upload, record id, etag), or None if the upload does not exist.
+    Raises ValueError if the list does not match the uploaded parts or the object
+    would exceed MAX_OBJECT_SIZE, and MultipartCompleting while another request
+    is completing the same upload.
+    """
+    lock, owner = f"multipart:{upload_id}", uuid.uuid4().hex
+    if not acquire_lock(lock, _ASSEMBLY_LEASE_SEC, owner):
+        raise MultipartCompleting("The upload is already being completed")
+    try:
+        return _complete_multipart_upload(upload_id, parts, ttl_seconds)
+    finally:
+        release_lock(lock, owner)
+
+def _complete_multipart_upload(upload_id, parts, ttl_seconds):
+    upload = get_multipart_upload(upload_id)
+    if upload is None:
+        return None
+    with get_db() as conn:
+        stored = {
+            number: (size, etag) for number, size, etag in conn.execute(
+                "SELECT part_number, size, etag FROM multipart_parts WHERE upload_id = ?", (upload_id,)
+            )
+        }
+    numbers = [number for number, _ in parts]
+    if not numbers:
+        raise ValueError("The part list is empty")
+    if numbers != sorted(set(numbers)):
+        raise ValueError("Parts must be listed in ascending order without duplicates")
+    for number, etag in parts:
+        if number not in stored or stored[number][1] != etag.strip('"'):
+            raise ValueError(f"Part {number} was not uploaded or its ETag does not match")
+    size = sum(stored[number][0] for number in numbers)
+    if size > settings.MAX_OBJECT_SIZE:
+        raise ValueError(f"The object would exceed the maximum size of {settings.MAX_OBJECT_SIZE} bytes")
+
+    # S3 multipart ETag: MD5 of the concatenated part digests, suffixed with the part count
+    digest = hashlib.md5(b"".join(bytes.fromhex(stored[number][1]) for number in numbers)).hexdigest()
+    etag = f"{digest}-{len(numbers)}"
+
+    assembled = get_part_path(upload_id, numbers[0])
+    with open(assembled, "r+b") as out:
+        # An earlier attempt may have appended to the first part before failing
+        out.truncate(stored[numbers[0]][0])
+        out.seek(0, os.SEEK_END)
+        for number in numbers[1:]:
+            _append_file(out, get_part_path(upload_id, number))
+        out.flush()
+        os.fsync(out.fileno())
+
+    ttl_seconds = settings.S3_DEFAULT_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+    with get_db() as conn:
+        if not conn.execute("DELETE FROM multipart_uploads WHERE upload_id = ? RETURNING upload_id",
+                            (upload_id,)).fetchone():
+            return None
+        conn.execute("DELETE FROM multipart_parts WHERE upload_id = ?", (upload_id,))
+        file_id, stale_paths = _replace_object(conn, upload["bucket"], upload["key"], assembled, size, etag,
+                                               upload["metadata"], ttl_seconds)
+    remove_files(stale_paths)
+    shutil.rmtree(get_multipart_path(upload_id), ignore_errors=True)
+    return upload, file_id, etag
+
+def abort_multipart_upload(upload_id) -> bool:
+    """Discard a multipart upload and its parts. Returns False if it does not exist."""
+    with get_db() as conn:
+        if not conn.execute("DELETE FROM multipart_uploads WHERE upload_id = ? RETURNING upload_id",
+                            (upload_id,)).fetchone():
+            return False
+        conn.execute("DELETE FROM multipart_parts WHERE upload_id = ?", (upload_id,))
+    shutil.rmtree(get_multipart_path(upload_id), ignore_errors=True)
+    return True
+
+def purge_stale_multipart_uploads(max_age: int = None) -> int:
+    """Abort multipart uploads started more than `max_age` seconds ago. Returns how many."""
+    max_age = settings.S3_MULTIPART_EXPIRY_SEC if max_age is None else max_age
+    with get_db() as conn:
+        stale = [row[0] for row in conn.execute(
+            "SELECT upload_id FROM multipart_uploads WHERE created_at <= ?", (_now_epoch() - max_age,)
+        )]
+    return sum(abort_multipart_upload(upload_id) for upload_id in stale)
+
+# -----------------------------
+# Object Listing
+# -----------------------------
+
+def bucket_exists(bucket) -> bool:
+    with get_db() as conn:
+        return conn.execute(
+            "SELECT 1 FROM buckets WHERE name = ? AND deleted_at IS NULL", (bucket,)
+        ).fetchone() is not None
+
+def _key_successor(key: str):
+    """Smallest string greater than every string starting with `key`, or None if there is none."""
+    while key:
+        last = ord(key[-1])
+        if last < 0x10FFFF:
+            return key[:-1] + chr(last + 1)
+        key = key[:-1]
+    return None
+
+def encode_list_token(bound: str, inclusive: bool) -> str:
+    raw = json.dumps([bound, inclusive]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_list_token(token: str):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        bound, inclusive = json.loads(raw)
+        return str(bound), bool(inclusive)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid continuation token")
+
+def list_objects(bucket, prefix="", delimiter="", max_keys=1000, start_after="", continuation_token=None):
+    """
+    One page of object keys in key order, as in S3 ListObjectsV2.
+
+    Keys are read from the (bucket, filename) index as a range scan bounded by the
+    prefix, and each common prefix (keys grouped by `delimiter`) costs one seek past
+    the whole group, so a page costs O(max_keys) index reads whatever the bucket size.
+
+    Returns a dict with `objects` (key, size, etag, last_modified), `common_prefixes`,
+    `is_truncated` and `next_token`. Raises ValueError for a bad continuation token.
+    """
+    if continuation_token:
+        bound, inclusive = decode_list_token(continuation_token)
+    else:
+        bound, inclusive = max(prefix, start_after), start_after < prefix
+        if delimiter and start_after > prefix and start_after.endswith(delimiter):
+            # A common prefix given back as the v1 NextMarker: resume after every key it groups
+            bound, inclusive = _key_successor(start_after), True
+    upper = _key_successor(prefix) if prefix else None
+    objects, common_prefixes = [], []
+    last_key = None
+    truncated = False
+    now = _now_epoch()
+
+    with get_db() as conn:
+        while max_keys > 0:
+            limit = max_keys + 1 - len(objects) - len(common_prefixes)
+            sql = "SELECT filename, size, etag, created_at FROM files WHERE bucket = ? AND filename "
+            sql += ">= ?" if inclusive else "> ?"
+            params = [bucket, bound]
+            if upper is not None:
+                sql += " AND filename < ?"
+                params.append(upper)
+            sql += f" AND {_VISIBLE_SQL} ORDER BY filename LIMIT ?"
+            rows = conn.execute(sql, params + [now, limit]).fetchall()
+
+            next_bound = None
+            for key, size, etag, created_at in rows:
+                if key == last_key:
+                    # Several records uploaded under one filename list as one key
+                    continue
+                if len(objects) + len(common_prefixes) == max_keys:
+                    truncated = True
+                    break
+                group_end = key.find(delimiter, len(prefix)) if delimiter else -1
+                if group_end >= 0:
+                    last_key = key[:group_end + len(delimiter)]
+                    common_prefixes.append(last_key)
+                    # Seek past every key of the group instead of reading them
+                    next_bound = (_key_successor(last_key), True)
+                    break
+                objects.append({"key": key, "size": size, "etag": etag, "last_modified": created_at})
+                last_key = key
+            if truncated:
                 break
-        return results
+            if next_bound is None:
+                if len(rows) < limit:
+                    break
+                next_bound = (last_key, False)
+            if next_bound[0] is None:
+                break
+            bound, inclusive = next_bound
+
+    next_token = None
+    if truncated:
+        if common_prefixes and last_key == common_prefixes[-1]:
+            next_token = encode_list_token(_key_successor(last_key), True)
+        else:
+            next_token = encode_list_token(last_key, False)
+    return {"objects": objects, "common_prefixes": common_prefixes, "is_truncated": truncated,
+            "next_token": next_token}
+
+# -----------------------------
+# Change Feed
+# -----------------------------
+
+class ChangesExpired(LookupError):
+    """Changes after the requested position were pruned; the consumer has to re-list."""
+
+    def __init__(self, oldest: int):
+        super().__init__(
+            f"Changes before {oldest} are no longer retained; re-list the bucket and follow the feed from its end"
+        )
+        self.oldest = oldest
+
+def get_changes(since=None, bucket=None, limit: int = 100) -> tuple[list[dict], int]:
+    """
+    Changes after position `since` (the current end of the feed if None), oldest
+    first, optionally of one bucket. Each is {seq, bucket, id, op, at}, where op
+    is create, update, delete, expire or bucket_delete.
+
+    Returns the changes and the position to resume from. Raises ChangesExpired if
+    entries after `since` may have been pruned.
+    """
+    with get_db() as conn:
+        # Writers are serialized, so every entry up to the head read first is committed
+        head, oldest = conn.execute("SELECT COALESCE(MAX(seq), 0), MIN(seq) FROM changes").fetchone()
+        if since is None:
+            return [], head
+        # Pruning always keeps the newest entry, so a gap before the oldest one means entries were lost
+        if oldest is not None and since < oldest - 1:
+            raise ChangesExpired(oldest)
+        sql = "SELECT seq, bucket, record_id, op, created_at FROM changes WHERE seq > ? AND seq <= ?"
+        params = [since, head]
+        if bucket is not None:
+            sql += " AND bucket = ?"
+            params.append(bucket)
+        rows = conn.execute(sql + " ORDER BY seq LIMIT ?", params + [limit]).fetchall()
+    changes = [{"seq": seq, "bucket": bucket, "id": record_id, "op": op, "at": at}
+               for seq, bucket, record_id, op, at in rows]
+    # A short page means nothing else up to the head concerns this consumer, so it can skip ahead
+    return changes, (rows[-1][0] if len(rows) == limit else max(since, head))
+
+def purge_changes(max_age: int = None) -> int:
+    """Trim the change feed to the last `max_age` seconds, keeping its newest entry."""
+    cutoff = _now_epoch() - (max_age if max_age is not None else settings.CHANGES_RETENTION_SEC)
+    with get_db() as conn:
+        return conn.execute('''
+            DELETE FROM changes WHERE seq < COALESCE(
+                (SELECT seq FROM changes WHERE created_at >= ? ORDER BY seq LIMIT 1),
+                (SELECT MAX(seq) FROM changes)
+            )
+        ''', (cutoff,)).rowcount
+
+# -----------------------------
+# Webhooks
+# -----------------------------
+
+def create_webhook(bucket: str, url: str, events=None, secret: str = None) -> dict:
+    """
+    Subscribe `url` to the bucket's change events (all of WEBHOOK_EVENTS by default).
+    Deliveries are signed with `secret`, generated when not given.
+    """
+    events = list(dict.fromkeys(events or WEBHOOK_EVENTS))
+    unknown = [event for event in events if event not in WEBHOOK_EVENTS]
+    if unknown:
+        raise ValueError(f"Unknown events {unknown}, expected some of {', '.join(WEBHOOK_EVENTS)}")
+    if not url.startswith(("http://", "https://")):
+        raise ValueError("Webhook URL must start with http:// or https://")
+    webhook = {
+        "id": str(uuid.uuid4()),
+        "bucket": bucket,
+        "url": url,
+        "secret": secret or secrets.token_hex(32),
+        "events": events,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO webhooks (id, bucket, url, secret, events, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (webhook["id"], bucket, url, webhook["secret"], json.dumps(events), webhook["created_at"])
+        )
+    return webhook
+
+def list_webhooks(bucket: str) -> list[dict]:
+    """The bucket's subscriptions, without secrets, with their pending and failed delivery counts."""
+    with get_db() as conn:
+        rows = conn.execute('''
+            SELECT w.id, w.url, w.events, w.created_at,
+                   COUNT(o.id) FILTER (WHERE o.failed_at IS NULL),
+                   COUNT(o.failed_at),
+                   (SELECT last_error FROM webhook_outbox WHERE webhook_id = w.id AND last_error IS NOT NULL
+                    ORDER BY id DESC LIMIT 1)
+            FROM webhooks w LEFT JOIN webhook_outbox o ON o.webhook_id = w.id
+            WHERE w.bucket = ? GROUP BY w.id ORDER BY w.created_at
+        ''', (bucket,)).fetchall()
+    return [
+        {"id": id, "bucket": bucket, "url": url, "events": json.loads(events), "created_at": created_at,
+         "pending": pending, "failed": failed, "last_error": last_error}
+        for id, url, events, created_at, pending, failed, last_error in rows
+    ]
+
+def delete_webhook(bucket: str, webhook_id: str) -> bool:
+    """Remove a subscription and drop its undelivered events."""
+    with get_db() as conn:
+        if not conn.execute("DELETE FROM webhooks WHERE id = ? AND bucket = ?", (webhook_id, bucket)).rowcount:
+            return False
+        conn.execute("DELETE FROM webhook_outbox WHERE webhook_id = ?", (webhook_id,))
+    return True
+
+def claim_webhook_deliveries(max_batches: int, batch_size: int, lease_seconds: int, exclude=()) -> list[list[dict]]:
+    """
+    Claim due outbox rows as up to `max_batches` batches, one per webhook (except
+    those in `exclude`), of its `batch_size` oldest rows. Claiming pushes the next
+    attempt `lease_seconds` ahead: other workers skip the rows, and if this one
+    dies before settling them they are sent again once the lease runs out.
+    """
+    now = _now_epoch()
+    batches = []
+    with get_db() as conn:
+        # Webhooks whose oldest due event waited longest go first
+        hooks = conn.execute('''
+            SELECT w.id, w.url, w.secret, (
+                SELECT MIN(next_attempt_at) FROM webhook_outbox
+                WHERE webhook_id = w.id AND failed_at IS NULL AND next_attempt_at <= ?
+            ) AS due
+            FROM webhooks w WHERE due IS NOT NULL AND w.id NOT IN (SELECT value FROM json_each(?))
+            ORDER BY due LIMIT ?
+        ''', (now, json.dumps(list(exclude)), max_batches)).fetchall()
+        for webhook_id, url, secret, _ in hooks:
+            rows = conn.execute('''
+                UPDATE webhook_outbox SET next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM webhook_outbox
+                    WHERE webhook_id = ? AND failed_at IS NULL AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id LIMIT ?
+                )
+                RETURNING id, seq, bucket, record_id, op, record, created_at, attempts
+            ''', (now + lease_seconds, webhook_id, now, batch_size)).fetchall()
+            batches.append([
+                {"id": id, "webhook_id": webhook_id, "url": url, "secret": secret, "attempts": attempts,
+                 "event": {"seq": seq, "event": op, "bucket": bucket, "id": record_id,
+                           "at": datetime.fromtimestamp(created_at, timezone.utc).isoformat(),
+                           "record": json.loads(record) if record else None}}
+                for id, seq, bucket, record_id, op, record, created_at, attempts in sorted(rows)
+            ])
+    return batches
+
+def finish_webhook_deliveries(ids: list[int]):
+    """Drop delivered outbox rows."""
+    with get_db() as conn:
+        conn.execute("DELETE FROM webhook_outbox WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(ids),))
+
+def retry_webhook_deliveries(ids: list[int], error: str, delay_seconds: int, max_attempts: int):
+    """Schedule failed outbox rows for another attempt, or mark them failed after `max_attempts`."""
+    now = _now_epoch()
+    with get_db() as conn:
+        conn.execute('''
+            UPDATE webhook_outbox
+            SET attempts = attempts + 1, last_error = ?, next_attempt_at = ?,
+                failed_at = CASE WHEN attempts + 1 >= ? THEN ? END
+            WHERE id IN (SELECT value FROM json_each(?))
+        ''', (error[:1000], now + delay_seconds, max_attempts, now, json.dumps(ids)))
+
+def purge_webhook_outbox(max_age: int = None) -> int:
+    """Forget deliveries that failed for good more than `max_age` seconds ago."""
+    cutoff = _now_epoch() - (max_age if max_age is not None else settings.CHANGES_RETENTION_SEC)
+    with get_db() as conn:
+        return conn.execute("DELETE FROM webhook_outbox WHERE failed_at <= ?", (cutoff,)).rowcount
+
+def webhook_backlog() -> dict:
+    with get_db() as conn:
+        pending, failed = conn.execute(
+            "SELECT COUNT(*) FILTER (WHERE failed_at IS NULL), COUNT(failed_at) FROM webhook_outbox"
+        ).fetchone()
+    return {("pending",): pending, ("failed",): failed}
+
+Sampled("filenest_webhook_outbox_events", "Webhook events waiting for delivery, and those given up on",
+        webhook_backlog, labelnames=("state",))
 
 # -----------------------------
 # Cleanup
 # -----------------------------
 
-async def cleanup_all_buckets():
-    print("[CLEANUP] Starting cleanup for expired files...")
+_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
 
-    now_iso = datetime.utcnow().isoformat()
+def acquire_lock(name: str, lease_seconds: int, owner: str = _WORKER_ID) -> bool:
+    """
+    Take or renew the lease on a named lock shared by all workers using the database.
 
-    # SQL to find expired records where ttl is not 0 and expiration < now
-    cursor.execute('''
-        SELECT id, bucket, filename FROM files
-        WHERE ttl_seconds > 0
-        AND DATETIME(upload_time, '+' || ttl_seconds || ' seconds') <= ?
-    ''', (now_iso,))
+    Succeeds if the lock is free, expired, or already held by `owner`.
+    """
+    now = _now_epoch()
+    with get_db() as conn:
+        cur = conn.execute('''
+            INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            WHERE locks.owner = excluded.owner OR locks.expires_at <= ?
+        ''', (name, owner, now + lease_seconds, now))
+        return cur.rowcount > 0
 
-    expired_records = cursor.fetchall()
+def release_lock(name: str, owner: str = _WORKER_ID):
+    with get_db() as conn:
+        conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
 
-    for file_id, bucket, filename in expired_records:
-        file_path = get_object_path(bucket, filename)
+def purge_expired(batch_size: int = None) -> int:
+    """
+    Delete every expired record and its file, one bounded batch per transaction.
 
-        if os.path.isfile(file_path):
-            try:
-                os.remove(file_path)
-                print(f"[CLEANUP] Deleted file: {file_path}")
-            except Exception as e:
-                print(f"[ERROR] Failed to delete {file_path}: {e}")
-        else:
-            print(f"[SKIP] File not found: {file_path}")
+    Metadata is deleted first so a failed unlink leaves an orphan file rather than
+    a record pointing at nothing. Returns the number of records removed.
+    """
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    removed = 0
+    while True:
+        now = _now_epoch()
+        with get_db() as conn:
+            # Range scan over the partial expires_at index
+            batch = [
+                {"id": file_id, "bucket": bucket, "filename": filename, "blob": blob, "location": location}
+                for file_id, bucket, filename, blob, location in conn.execute(
+                    "SELECT id, bucket, filename, blob, location FROM files WHERE expires_at <= ? LIMIT ?",
+                    (now, batch_size)
+                )
+            ]
+            if not batch:
+                break
+            conn.executemany("DELETE FROM files WHERE id = ?", [(record["id"],) for record in batch])
+            paths = _release_files(conn, batch)
 
-        # Delete metadata
-        try:
-            with conn:
-                conn.execute("DELETE FROM files WHERE id = ? AND bucket = ?", (file_id, bucket))
-            print(f"[CLEANUP] Removed metadata for ID: {file_id}")
-        except Exception as e:
-            print(f"[ERROR] Failed to remove metadata for ID {file_id}: {e}")
+        remove_files(paths)
+        removed += len(batch)
+        if len(batch) < batch_size:
+            break
+    return removed
+
+def purge_record_invalidations(max_age: int = None) -> int:
+    """
+    Trim the record cache invalidation log to the last `max_age` seconds, keeping
+    its newest entry so workers can tell when they missed pruned ones.
+    """
+    cutoff = _now_epoch() - (max_age if max_age is not None else settings.CACHE_INVALIDATION_RETENTION_SEC)
+    with get_db() as conn:
+        # The log is in seq order, so this only walks the entries being deleted
+        return conn.execute('''
+            DELETE FROM record_invalidations WHERE seq < COALESCE(
+                (SELECT seq FROM record_invalidations WHERE created_at >= ? ORDER BY seq LIMIT 1),
+                (SELECT MAX(seq) FROM record_invalidations)
+            )
+        ''', (cutoff,)).rowcount
+
+async def cleanup_all_buckets() -> int:
+    with REAPER_PASS_SECONDS.time():
+        started = time.monotonic()
+        removed = await run_storage(purge_expired)
+        REAPER_REMOVED.inc(removed, reason="expired")
+        if removed:
+            print(f"[CLEANUP] Removed {removed} expired records in {time.monotonic() - started:.2f}s")
+        started = time.monotonic()
+        purged = await run_storage(purge_deleted_buckets)
+        REAPER_REMOVED.inc(purged, reason="bucket_deleted")
+        if purged:
+            print(f"[CLEANUP] Removed {purged} records of deleted buckets in {time.monotonic() - started:.2f}s")
+        aborted = await run_storage(purge_stale_multipart_uploads)
+        if aborted:
+            print(f"[CLEANUP] Aborted {aborted} stale multipart uploads")
+        await run_storage(purge_record_invalidations)
+        await run_storage(purge_changes)
+        await run_storage(purge_webhook_outbox)
+    return removed + purged
+
+def reaper_backlog() -> dict:
+    """Work waiting for the reaper: expired records, and records of deleted buckets."""
+    with get_db() as conn:
+        expired = conn.execute("SELECT COUNT(*) FROM files WHERE expires_at <= ?", (_now_epoch(),)).fetchone()[0]
+        deleted = conn.execute('''
+            SELECT COALESCE(SUM(record_count), 0) FROM bucket_stats
+            WHERE bucket IN (SELECT name FROM buckets WHERE deleted_at IS NOT NULL)
+        ''').fetchone()[0]
+    return {("expired",): expired, ("bucket_deleted",): deleted}
 
-    print("[CLEANUP] Cleanup completed.")
+Sampled("filenest_reaper_backlog_records", "Records waiting to be deleted by the reaper", reaper_backlog,
+        labelnames=("reason",))
 
+_reaper_wakeup = None
+_reaper_loop = None
+
+def wake_reaper():
+    """Start the next reaper pass now instead of after the interval. Safe from any thread."""
+    if _reaper_wakeup is not None:
+        _reaper_loop.call_soon_threadsafe(_reaper_wakeup.set)
+
+async def run_reaper():
+    """
+    Periodically purge expired records for the lifetime of the app.
+
+    Every worker runs this loop, but only the holder of the "reaper" lock does the
+    work; the lease outlives a couple of intervals so a dead worker is replaced.
+    """
+    global _reaper_wakeup, _reaper_loop
+    interval = settings.CLEANUP_INTERVAL_SEC
+    lease = max(2 * interval, 30)
+    _reaper_loop, _reaper_wakeup = asyncio.get_running_loop(), asyncio.Event()
+    try:
+        while True:
+            try:
+                if await run_storage(acquire_lock, "reaper", lease):
+                    await cleanup_all_buckets()
+            except Exception as e:
+                print(f"[ERROR] Cleanup pass failed: {e}")
+            try:
+                await asyncio.wait_for(_reaper_wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            _reaper_wakeup.clear()
+    finally:
+        _reaper_wakeup = None
+        await run_storage(release_lock, "reaper")
@@ -0,0 +1,335 @@
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api_filnest
+import main
+import storage
+import uploads
+from settings import settings
+
+HEADERS = {settings.API_KEY_NAME: settings.API_KEY}
+
+
+@pytest.fixture
+def client():
+    with TestClient(main.app) as client:
+        yield client
+
+
+def temp_files():
+    return [name for _, _, names in os.walk(settings.STORAGE_DIR) for name in names if name.startswith(".upload-")]
+
+
+def create(client, content, filename="file.txt", bucket="docs"):
+    response = client.post(f"/api/v1/buckets/{bucket}/records/", headers=HEADERS, files={"file": (filename, content)})
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def test_upload_streams_file_into_place(client):
+    response = client.post("/api/v1/buckets/docs/records/", headers=HEADERS,
+                           files={"file": ("report.txt", b"quarterly numbers")},
+                           data={"ttl_seconds": "0", "metadata_json": '{"author": "ann"}'})
+    assert response.status_code == 200
+    record_id = response.json()["id"]
+
+    record = client.get(f"/api/v1/buckets/docs/records/{record_id}", headers=HEADERS).json()
+    assert record["file_url"].endswith("report.txt")
+    assert record["metadata"] == {"author": "ann"}
+    content = client.get(f"/api/v1/buckets/docs/records/{record_id}/content", headers=HEADERS)
+    assert content.content == b"quarterly numbers"
+    assert temp_files() == []
+
+
+def test_upload_over_size_limit_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_FILE_SIZE", 10)
+    response = client.post("/api/v1/buckets/docs/records/", headers=HEADERS, files={"file": ("big.bin", b"x" * 11)})
+    assert response.status_code == 413
+    assert client.get("/api/v1/buckets/docs/records", headers=HEADERS).json() == []
+    assert temp_files() == []
+
+
+def test_upload_with_oversized_form_field_is_rejected(client):
+    response = client.post("/api/v1/buckets/docs/records/", headers=HEADERS, files={"file": ("a.txt", b"a")},
+                           data={"metadata_json": "x" * (uploads.MAX_FIELD_SIZE + 1)})
+    assert response.status_code == 413
+    assert "metadata_json" in response.json()["detail"]
+    assert temp_files() == []
+
+
+def test_upload_filesystem_work_runs_on_storage_executor(client, monkeypatch):
+    threads = []
+    for module, name in ((uploads, "_create_temp_file"), (uploads, "_remove_files"), (api_filnest, "store_record")):
+        def spy(*args, _original=getattr(module, name), **kwargs):
+            threads.append(threading.current_thread().name)
+            return _original(*args, **kwargs)
+        monkeypatch.setattr(module, name, spy)
+
+    # The stray file part is discarded, so every stage of an upload is exercised
+    response = client.post("/api/v1/buckets/docs/records/", headers=HEADERS,
+                           files={"file": ("a.txt", b"a"), "extra": ("b.txt", b"b")})
+    assert response.status_code == 200
+    assert len(threads) == 4
+    assert all(name.startswith("filenest-storage") for name in threads)
+
+
+def test_identical_uploads_share_one_blob_until_both_are_deleted(client, monkeypatch):
+    monkeypatch.setattr(settings, "CONTENT_ADDRESSED_STORAGE", True)
+    first = create(client, b"same bytes", filename="a.txt")
+    second = create(client, b"same bytes", filename="b.txt")
+    records = [storage.get_file_metadata_by_id(record_id, "docs") for record_id in (first, second)]
+    assert records[0]["blob"] == records[1]["blob"] == hashlib.sha256(b"same bytes").hexdigest()
+    path = storage.get_record_path(records[0])
+    assert storage.get_record_path(records[1]) == path
+
+    assert client.delete(f"/api/v1/buckets/docs/records/{first}", headers=HEADERS).status_code == 200
+    with open(path, "rb") as f:
+        assert f.read() == b"same bytes"
+    assert client.delete(f"/api/v1/buckets/docs/records/{second}", headers=HEADERS).status_code == 200
+    assert not os.path.exists(path)
+
+
+def test_content_supports_ranges_and_conditional_requests(client):
+    record_id = create(client, b"0123456789")
+    url = f"/api/v1/buckets/docs/records/{record_id}/content"
+
+    full = client.get(url, headers=HEADERS)
+    assert full.status_code == 200
+    assert full.headers["accept-ranges"] == "bytes"
+    etag, last_modified = full.headers["etag"], full.headers["last-modified"]
+
+    partial = client.get(url, headers={**HEADERS, "range": "bytes=2-5"})
+    assert partial.status_code == 206
+    assert partial.content == b"2345"
+    assert partial.headers["content-range"] == "bytes 2-5/10"
+
+    assert client.get(url, headers={**HEADERS, "if-none-match": etag}).status_code == 304
+    assert client.get(url, headers={**HEADERS, "if-none-match": '"other"'}).status_code == 200
+    assert client.get(url, headers={**HEADERS, "if-modified-since": last_modified}).status_code == 304
+    assert client.head(url, headers=HEADERS).headers["content-length"] == "10"
+
+
+def test_content_is_handed_to_nginx_with_x_accel_redirect(client, monkeypatch):
+    monkeypatch.setattr(settings, "X_ACCEL_REDIRECT_PREFIX", "/_protected_files/")
+    record_id = create(client, b"hello", filename="my file.txt")
+    response = client.get(f"/api/v1/buckets/docs/records/{record_id}/content", headers=HEADERS)
+
+    assert response.status_code == 200
+    assert response.content == b""
+    assert response.headers["x-accel-redirect"] == "/_protected_files/docs/my%20file.txt"
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "etag" in response.headers
+
+
+def test_batch_upload_reports_each_file(client, monkeypatch):
+    monkeypatch.setattr(settings, "MAX_FILE_SIZE", 10)
+    move = storage._move_into_place
+    def fail_one(temp_path, final_path):
+        if final_path.endswith("full.txt"):
+            raise OSError(28, "No space left on device")
+        move(temp_path, final_path)
+    monkeypatch.setattr(storage, "_move_into_place", fail_one)
+
+    manifest = {"a.txt": {"metadata": {"n": 1}}, "b.txt": {"ttl_seconds": "soon"}}
+    response = client.post("/api/v1/buckets/docs/records/batch", headers=HEADERS,
+                           files=[("files", ("a.txt", b"a")), ("files", ("b.txt", b"b")),
+                                  ("files", ("big.txt", b"x" * 11)), ("files", ("full.txt", b"f"))],
+                           data={"manifest": json.dumps(manifest), "ttl_seconds": "0"})
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (1, 3)
+    assert [item["status"] for item in body["items"]] == ["created", "error", "error", "error"]
+    assert "No space left" in body["items"][3]["error"]
+
+    record = client.get(f"/api/v1/buckets/docs/records/{body['items'][0]['id']}", headers=HEADERS).json()
+    assert record["metadata"] == {"n": 1}
+    assert len(client.get("/api/v1/buckets/docs/records", headers=HEADERS).json()) == 1
+    assert temp_files() == []
+
+
+def test_batch_upload_rejects_too_many_files(client, monkeypatch):
+    monkeypatch.setattr(settings, "BATCH_MAX_FILES", 1)
+    response = client.post("/api/v1/buckets/docs/records/batch", headers=HEADERS,
+                           files=[("files", ("a.txt", b"a")), ("files", ("b.txt", b"b"))])
+    assert response.status_code == 413
+    assert temp_files() == []
+
+
+def test_batch_routes_select_records_by_ids_and_filter(client):
+    ids = [create(client, b"x", filename=f"{n}.txt") for n in range(3)]
+    url = "/api/v1/buckets/docs/records/batch"
+
+    patched = client.patch(f"{url}/metadata", headers=HEADERS, json={"ids": ids[:2], "metadata": {"tag": "old"}})
+    assert patched.json() == {"count": 2}
+    got = client.post(f"{url}/get", headers=HEADERS, json={"filter": {"key": "tag", "value": "old"}}).json()
+    assert sorted(record["id"] for record in got["records"]) == sorted(ids[:2])
+    got = client.post(f"{url}/get", headers=HEADERS, json={"ids": [ids[2], "missing-id"]}).json()
+    assert [record["id"] for record in got["records"]] == [ids[2]]
+    assert got["missing"] == ["missing-id"]
+
+    path = storage.get_record_path(storage.get_file_metadata_by_id(ids[0], "docs"))
+    deleted = client.post(f"{url}/delete", headers=HEADERS, json={"filter": {"key": "tag", "value": "old"}})
+    assert deleted.json() == {"count": 2}
+    assert not os.path.exists(path)
+    assert [record["id"] for record in client.get("/api/v1/buckets/docs/records", headers=HEADERS).json()] == [ids[2]]
+    assert client.post(f"{url}/delete", headers=HEADERS, json={}).status_code == 400
+
+
+def test_deleted_bucket_disappears_before_it_is_purged(client, monkeypatch):
+    monkeypatch.setattr(settings, "CLEANUP_INTERVAL_SEC", 60)
+    record_id = create(client, b"hello")
+    path = storage.get_record_path(storage.get_file_metadata_by_id(record_id, "docs"))
+
+    assert client.delete("/api/v1/buckets/docs", headers=HEADERS).status_code == 204
+    assert "docs" not in client.get("/api/v1/buckets", headers=HEADERS).json()["buckets"]
+    assert client.get(f"/api/v1/buckets/docs/records/{record_id}", headers=HEADERS).status_code == 404
+    # Until the reaper has purged it, the name cannot be reused
+    assert client.post("/api/v1/buckets/docs", headers=HEADERS).status_code == 409
+    assert os.path.exists(path)
+
+    assert client.post("/cleanup-expired").json()["removed"] == 1
+    assert not os.path.exists(path)
+    assert client.post("/api/v1/buckets/docs", headers=HEADERS).status_code == 200
+
+
+def test_deleted_bucket_is_purged_without_the_reaper(client):
+    assert settings.CLEANUP_INTERVAL_SEC == 0
+    record_id = create(client, b"hello")
+    path = storage.get_record_path(storage.get_file_metadata_by_id(record_id, "docs"))
+
+    assert client.delete("/api/v1/buckets/docs", headers=HEADERS).status_code == 204
+    assert not os.path.exists(path)
+    # The name is free again once the purge has finished
+    assert client.post("/api/v1/buckets/docs", headers=HEADERS).status_code == 200
+
+
+def test_s3_multipart_upload_assembles_parts(client):
+    created = client.post("/api/s3/media/video.bin?uploads", headers={**HEADERS, "x-amz-meta-camera": "a"})
+    upload_id = re.search(r"<UploadId>(.+)</UploadId>", created.text).group(1)
+    etags = []
+    for number, body in ((1, b"first-"), (2, b"second")):
+        part = client.put(f"/api/s3/media/video.bin?partNumber={number}&uploadId={upload_id}", headers=HEADERS,
+                          content=body)
+        assert part.status_code == 200
+        assert part.headers["etag"] == f'"{hashlib.md5(body).hexdigest()}"'
+        etags.append(part.headers["etag"])
+
+    wrong = f"<CompleteMultipartUpload><Part><PartNumber>1</PartNumber><ETag>{etags[1]}</ETag></Part></CompleteMultipartUpload>"
+    assert client.post(f"/api/s3/media/video.bin?uploadId={upload_id}", headers=HEADERS,
+                       content=wrong).status_code == 400
+    complete = "<CompleteMultipartUpload>" + "".join(
+        f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>" for number, etag in enumerate(etags, 1)
+    ) + "</CompleteMultipartUpload>"
+    response = client.post(f"/api/s3/media/video.bin?uploadId={upload_id}", headers=HEADERS, content=complete)
+    assert response.status_code == 200
+    digest = hashlib.md5(b"".join(bytes.fromhex(etag.strip('"')) for etag in etags)).hexdigest()
+    assert f"<ETag>\"{digest}-2\"</ETag>" in response.text
+
+    obj = client.get("/api/s3/media/video.bin", headers=HEADERS)
+    assert obj.content == b"first-second"
+    assert obj.headers["etag"] == f'"{digest}-2"'
+    assert obj.headers["x-amz-meta-camera"] == "a"
+    assert client.get("/api/s3/media/video.bin", headers={**HEADERS, "range": "bytes=6-"}).content == b"second"
+    assert client.post(f"/api/s3/media/video.bin?uploadId={upload_id}", headers=HEADERS,
+                       content=complete).status_code == 404
+
+
+def test_s3_put_object_rejects_bad_content_md5(client):
+    response = client.put("/api/s3/media/a.txt", headers={**HEADERS, "content-md5": "AAAAAAAAAAAAAAAAAAAAAA=="},
+                          content=b"hello")
+    assert response.status_code == 400
+    assert client.get("/api/s3/media/a.txt", headers=HEADERS).status_code == 404
+    assert temp_files() == []
+
+
+def test_s3_list_objects_v2_pages_with_continuation_tokens(client):
+    for key in ("a/1.txt", "a/2.txt", "b.txt", "c.txt", "d.txt"):
+        assert client.put(f"/api/s3/media/{key}", headers=HEADERS, content=key.encode()).status_code == 200
+
+    keys, prefixes, token = [], [], None
+    while True:
+        params = {"list-type": "2", "max-keys": "2", "delimiter": "/"}
+        if token:
+            params["continuation-token"] = token
+        page = client.get("/api/s3/media", headers=HEADERS, params=params).text
+        keys += re.findall(r"<Key>(.+?)</Key>", page)
+        prefixes += re.findall(r"<CommonPrefixes><Prefix>(.+?)</Prefix>", page)
+        assert re.search(r"<KeyCount>(\d+)</KeyCount>", page).group(1) in ("1", "2")
+        match = re.search(r"<NextContinuationToken>(.+?)</NextContinuationToken>", page)
+        if not match:
+            assert "<IsTruncated>false</IsTruncated>" in page
+            break
+        assert "<IsTruncated>true</IsTruncated>" in page
+        token = match.group(1)
+    assert prefixes == ["a/"]
+    assert keys == ["b.txt", "c.txt", "d.txt"]
+
+    bad = client.get("/api/s3/media", headers=HEADERS, params={"list-type": "2", "continuation-token": "bogus"})
+    assert bad.status_code == 400
+    assert client.get("/api/s3/missing", headers=HEADERS, params={"list-type": "2"}).status_code == 404
+
+
+def test_s3_list_objects_v1_pages_with_markers(client):
+    for key in ("a/1.txt", "a/2.txt", "b.txt", "c/1.txt", "d.txt"):
+        assert client.put(f"/api/s3/media/{key}", headers=HEADERS, content=key.encode()).status_code == 200
+
+    listed, marker = [], ""
+    for _ in range(10):
+        params = {"max-keys": "1", "delimiter": "/", "marker": marker}
+        page = client.get("/api/s3/media", headers=HEADERS, params=params).text
+        listed += re.findall(r"<Key>(.+?)</Key>|<CommonPrefixes><Prefix>(.+?)</Prefix>", page)
+        match = re.search(r"<NextMarker>(.+?)</NextMarker>", page)
+        if not match:
+            assert "<IsTruncated>false</IsTruncated>" in page
+            break
+        marker = match.group(1)
+    assert ["".join(entry) for entry in listed] == ["a/", "b.txt", "c/", "d.txt"]
+
+
+def test_metrics_are_labelled_by_route_template(client, monkeypatch):
+    record_id = create(client, b"hello")
+    client.get(f"/api/v1/buckets/docs/records/{record_id}", headers=HEADERS)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = response.text
+    assert 'route="/api/v1/buckets/{bucket}/records/{record_id}",status="200"' in body
+    assert record_id not in body
+    assert 'filenest_upload_stage_seconds_count{stage="move"}' in body
+    assert "# TYPE filenest_http_request_duration_seconds histogram" in body
+
+    monkeypatch.setattr(settings, "METRICS_ENABLED", False)
+    assert client.get("/metrics").status_code == 404
+
+
+def test_scaled_images_are_rendered_once_and_cached(client):
+    Image = pytest.importorskip("PIL.Image")
+    source = io.BytesIO()
+    Image.new("RGB", (400, 200), "red").save(source, "PNG")
+    record_id = create(client, source.getvalue(), filename="red.png")
+    url = f"/api/v1/buckets/docs/records/{record_id}/content"
+
+    first = client.get(url, headers=HEADERS, params={"w": 100, "format": "png"})
+    assert first.status_code == 200
+    assert first.headers["content-type"] == "image/png"
+    assert (first.headers["x-source-width"], first.headers["x-source-height"]) == ("400", "200")
+    assert Image.open(io.BytesIO(first.content)).size == (100, 50)
+
+    second = client.get(url, headers=HEADERS, params={"w": 100, "format": "png"})
+    assert second.content == first.content
+    assert second.headers["etag"] == first.headers["etag"] != client.get(url, headers=HEADERS).headers["etag"]
+    assert client.get(url, headers={**HEADERS, "if-none-match": first.headers["etag"]},
+                      params={"w": 100, "format": "png"}).status_code == 304
+    assert client.get(url, headers=HEADERS, params={"w": 100, "format": "gif"}).status_code == 422
+
+    text_id = create(client, b"not an image", filename="notes.txt")
+    assert client.get(f"/api/v1/buckets/docs/records/{text_id}/content", headers=HEADERS,
+                      params={"w": 10}).status_code == 415
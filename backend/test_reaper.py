@@ -0,0 +1,13 @@
+import storage
+
+
+def test_reaper_lease_is_held_by_one_worker_at_a_time():
+    assert storage.acquire_lock("reaper", 60, owner="worker-a")
+    assert not storage.acquire_lock("reaper", 60, owner="worker-b")
+    # The holder renews its own lease
+    assert storage.acquire_lock("reaper", 60, owner="worker-a")
+
+    storage.release_lock("reaper", owner="worker-a")
+    assert storage.acquire_lock("reaper", 0, owner="worker-b")
+    # A lease that has run out is taken over, as when its worker died
+    assert storage.acquire_lock("reaper", 60, owner="worker-a")
@@ -1,114 +1,400 @@
+import asyncio
+import hashlib
+import hmac
+import json
 import os
+import time
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import pytest
-import asyncio
-from datetime import datetime, timedelta
-from tinydb import TinyDB
-from unittest.mock import AsyncMock
-
-# Import your module here; adjust according to your project structure
-from backend.storage_helpers import (
-    get_bucket_path, get_object_path,
-    save_file_bytes, save_uploadfile,
-    insert_file_metadata, get_file_metadata_by_id,
-    get_file_metadata_by_bucket_key,
-    remove_file_metadata, update_metadata,
-    FileTable
-)
-from backend.settings import settings
-
-@pytest.fixture(autouse=True)
-def isolate_db_and_storage(tmp_path, monkeypatch):
-    # Redirect STORAGE_ROOT and DB_PATH to tmp directory for testing
-    monkeypatch.setattr(settings, "STORAGE_DIR", tmp_path / "storage")
-    monkeypatch.setattr(settings, "DB_PATH", str(tmp_path / "db.json"))
-
-    # Re-create dirs and TinyDB instance for tests isolation
-    os.makedirs(settings.STORAGE_DIR, exist_ok=True)
-
-    # Reinitialize TinyDB with tmp DB_PATH
-    global FileTable
-    db = TinyDB(settings.DB_PATH)
-    FileTable = db.table("files")
-
-    yield
-    # cleanup after test if needed
-
-
-@pytest.mark.asyncio
-async def test_save_file_bytes_and_uploadfile(tmp_path):
-    # Prepare bytes data
-    data = b"Hello, World!"
-    file_path = tmp_path / "dummyfile.txt"
-
-    # Test save_file_bytes
-    await save_file_bytes(str(file_path), data)
-    assert file_path.exists()
-    assert file_path.read_bytes() == data
-
-    # Mock an UploadFile-like async object with read method
-    class DummyUploadFile:
-        def __init__(self, content):
-            self._content = content
-            self._pos = 0
-        async def seek(self, pos):
-            self._pos = pos
-        async def read(self, n=-1):
-            if self._pos >= len(self._content):
-                return b""
-            if n < 0:
-                chunk = self._content[self._pos :]
-                self._pos = len(self._content)
-                return chunk
-            chunk = self._content[self._pos : self._pos + n]
-            self._pos += n
-            return chunk
-
-    dummy_file = DummyUploadFile(data)
-    upload_path = tmp_path / "uploadfile.txt"
-    await save_uploadfile(dummy_file, str(upload_path))
-    assert upload_path.exists()
-    assert upload_path.read_bytes() == data
 
+import storage
+from backends import ShardedBackend
+from migrate_storage import migrate
+from query import QueryError, compile_query
+from settings import settings
+from webhooks import WebhookDispatcher
 
-def test_get_paths():
-    bucket = "mybucket"
-    key = "myfile.txt"
-    bucket_path = get_bucket_path(bucket)
-    assert bucket in bucket_path
 
-    object_path = get_object_path(bucket, key)
-    assert bucket in object_path
-    assert key in object_path
+def upload(bucket, content=b"hello", filename="file.txt", ttl_seconds=0, metadata=None):
+    """Store a record the way the upload routes do: temp file first, then store_record."""
+    upload_dir = storage.get_upload_dir(bucket)
+    os.makedirs(upload_dir, exist_ok=True)
+    temp_path = os.path.join(upload_dir, f".upload-{uuid.uuid4().hex}")
+    with open(temp_path, "wb") as f:
+        f.write(content)
+    file_id = str(uuid.uuid4())
+    storage.store_record(file_id, filename, bucket, ttl_seconds, metadata, temp_path, len(content))
+    return file_id
+
+
+def test_get_paths():
+    bucket_path = storage.get_bucket_path("mybucket")
+    assert bucket_path == os.path.join(settings.STORAGE_DIR, "mybucket")
+    assert storage.get_object_path("mybucket", "myfile.txt") == os.path.join(bucket_path, "myfile.txt")
 
 
 def test_insert_get_remove_update_metadata():
-    file_id = "testid"
-    filename = "file.txt"
-    bucket = "bucket1"
-    ttl_seconds = 3600
-    metadata = {"foo": "bar"}
-
-    insert_file_metadata(file_id, filename, bucket, ttl_seconds, metadata)
-    meta = get_file_metadata_by_id(file_id)
-    assert meta is not None
-    assert meta["id"] == file_id
-    assert meta["bucket"] == bucket
-    assert meta["filename"] == filename
-    assert meta["metadata"] == metadata
-
-    # Test get by bucket/key
-    meta2 = get_file_metadata_by_bucket_key(bucket, filename)
-    assert meta2 == meta
-
-    # Update metadata
-    new_metadata = {"foo": "baz"}
-    update_count = update_metadata(file_id, new_metadata)
-    assert update_count == 1
-
-    updated_meta = get_file_metadata_by_id(file_id)
-    assert updated_meta["metadata"] == new_metadata
-
-    # Remove metadata
-    remove_file_metadata(file_id)
-    deleted_meta = get_file_metadata_by_id(file_id)
-    assert deleted_meta is None
+    storage.insert_file_metadata("testid", "file.txt", "bucket1", 3600, {"foo": "bar"})
+    meta = storage.get_file_metadata_by_id("testid", "bucket1")
+    assert meta["id"] == "testid"
+    assert meta["bucket"] == "bucket1"
+    assert meta["filename"] == "file.txt"
+    assert meta["metadata"] == {"foo": "bar"}
+    assert storage.get_file_metadata_by_id("testid", "other") is None
+
+    assert storage.update_metadata("testid", "bucket1", {"foo": "baz"})
+    assert storage.get_file_metadata_by_id("testid", "bucket1")["metadata"] == {"foo": "baz"}
+    assert storage.set_metadata_fields("testid", "bucket1", {"n": 1}) == {"foo": "baz", "n": 1}
+
+    storage.remove_file_metadata("testid", "bucket1")
+    assert storage.get_file_metadata_by_id("testid", "bucket1") is None
+    assert not storage.update_metadata("testid", "bucket1", {})
+
+
+def test_store_and_delete_record():
+    file_id = upload("photos", b"content")
+    record = storage.get_file_metadata_by_id(file_id, "photos")
+    path = storage.get_record_path(record)
+    with open(path, "rb") as f:
+        assert f.read() == b"content"
+
+    assert storage.delete_record(file_id, "photos")["id"] == file_id
+    assert not os.path.exists(path)
+    assert storage.delete_record(file_id, "photos") is None
+
+
+def test_failed_move_leaves_no_record(monkeypatch):
+    def fail(temp_path, final_path):
+        raise OSError(28, "No space left on device")
+
+    _, start = storage.get_changes()
+    monkeypatch.setattr(storage, "_move_into_place", fail)
+    with pytest.raises(OSError):
+        upload("b")
+    with storage.get_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM files").fetchone()[0] == 0
+    assert storage.get_changes(start, "b")[0] == []
+
+
+def test_batch_skips_records_whose_move_failed(monkeypatch):
+    upload_dir = storage.get_upload_dir("b")
+    os.makedirs(upload_dir, exist_ok=True)
+    items = []
+    for name in ("ok.txt", "full.txt"):
+        temp_path = os.path.join(upload_dir, f".upload-{uuid.uuid4().hex}")
+        with open(temp_path, "wb") as f:
+            f.write(b"data")
+        items.append({"id": str(uuid.uuid4()), "filename": name, "ttl_seconds": 0, "metadata": None,
+                      "temp_path": temp_path, "size": 4, "sha256": None})
+
+    move = storage._move_into_place
+    def fail_one(temp_path, final_path):
+        if final_path.endswith("full.txt"):
+            raise OSError(28, "No space left on device")
+        move(temp_path, final_path)
+
+    monkeypatch.setattr(storage, "_move_into_place", fail_one)
+    storage.store_records("b", items)
+    stored, failed = items
+    assert "error" not in stored and "No space left" in failed["error"]
+    assert os.path.exists(storage.get_record_path(storage.get_file_metadata_by_id(stored["id"], "b")))
+    assert storage.get_file_metadata_by_id(failed["id"], "b") is None
+    assert os.path.exists(failed["temp_path"])
+
+
+def test_expired_records_are_hidden_and_purged():
+    live = upload("b", ttl_seconds=3600)
+    expired = upload("b", filename="old.txt", ttl_seconds=3600)
+    path = storage.get_record_path(storage.get_file_metadata_by_id(expired, "b"))
+    with storage.get_db() as conn:
+        conn.execute("UPDATE files SET expires_at = ? WHERE id = ?", (int(time.time()) - 1, expired))
+
+    assert storage.get_file_metadata_by_id(expired, "b") is None
+    assert storage.purge_expired() == 1
+    assert not os.path.exists(path)
+    assert storage.get_file_metadata_by_id(live, "b") is not None
+
+
+def test_search_metadata_pages_with_cursor():
+    for i in range(5):
+        storage.insert_file_metadata(f"id{i}", "f.txt", "b", 0, {"group": i % 2})
+
+    page, cursor = storage.search_metadata("b", "group", "0", "number", limit=2)
+    assert [r["id"] for r in page] == ["id0", "id2"]
+    page, cursor = storage.search_metadata("b", "group", "0", "number", limit=2, cursor=cursor)
+    assert [r["id"] for r in page] == ["id4"] and cursor is None
+
+
+def test_search_metadata_matches_loosely_across_types():
+    storage.insert_file_metadata("num", "f.txt", "b", 0, {"n": 5, "flag": "true"})
+    storage.insert_file_metadata("text", "f.txt", "b", 0, {"n": "5", "flag": True})
+    storage.insert_file_metadata("other", "f.txt", "b", 0, {"n": 6, "flag": False})
+
+    def ids(key, value, value_type):
+        return sorted(r["id"] for r in storage.search_metadata("b", key, value, value_type)[0])
+
+    assert ids("n", "5", "string") == ["num", "text"]
+    assert ids("n", "5", "number") == ["num", "text"]
+    assert ids("flag", "true", "boolean") == ["num", "text"]
+    assert ids("flag", "false", "boolean") == ["other"]
+
+
+def test_search_metadata_keeps_booleans_out_of_numeric_matches():
+    storage.insert_file_metadata("flag", "f.txt", "b", 0, {"v": True})
+    storage.insert_file_metadata("num", "f.txt", "b", 0, {"v": 1})
+    storage.insert_file_metadata("text", "f.txt", "b", 0, {"v": "1"})
+
+    def ids(value, value_type):
+        return sorted(r["id"] for r in storage.search_metadata("b", "v", value, value_type)[0])
+
+    assert ids("1", "string") == ["num", "text"]
+    assert ids("1", "number") == ["num", "text"]
+    assert ids("true", "boolean") == ["flag"]
+
+
+def test_search_text_ranks_matches_and_follows_updates():
+    report = upload("b", filename="annual_report.pdf", metadata={"author": "Zoë"})
+    notes = upload("b", filename="notes.txt", metadata={"summary": {"text": "draft of the annual report"}})
+    upload("other", filename="annual_report.pdf")
+
+    page, cursor = storage.search_text("b", "annual report", limit=1)
+    assert [r["id"] for r in page] == [report]
+    page, cursor = storage.search_text("b", "annual report", limit=1, cursor=cursor)
+    assert [r["id"] for r in page] == [notes] and cursor is None
+    assert [r["id"] for r in storage.search_text("b", "zoe")[0]] == [report]
+    assert [r["id"] for r in storage.search_text("b", "dra*")[0]] == [notes]
+
+    storage.update_metadata(notes, "b", {"summary": "final"})
+    assert storage.search_text("b", "draft")[0] == []
+    with pytest.raises(ValueError):
+        storage.search_text("b", "  ")
+
+
+def test_query_records_with_compound_filter():
+    for i, metadata in enumerate([{"status": "draft", "pages": 5}, {"status": "review", "pages": 50},
+                                  {"status": "draft", "pages": "50"}, {"status": "done", "pages": 120}]):
+        storage.insert_file_metadata(f"id{i}", "f.txt", "b", 0, metadata)
+
+    def run(filter, order_by=None):
+        compiled = compile_query(filter, order_by)
+        records, _, _ = storage.query_records("b", compiled.where, compiled.params, compiled.order_by)
+        return [r["id"] for r in records]
+
+    assert run({"key": "pages", "between": [10, 200]}) == ["id1", "id3"]
+    assert run({"or": [{"key": "status", "in": ["review", "done"]}, {"key": "pages", "lt": 10}]},
+               [{"key": "pages", "desc": True}]) == ["id3", "id1", "id0"]
+    assert run({"not": {"key": "status", "eq": "draft"}}) == ["id1", "id3"]
+    assert run({"and": [{"key": "status", "eq": "draft"}, {"key": "missing", "exists": False}]}) == ["id0", "id2"]
+    with pytest.raises(QueryError):
+        compile_query({"key": "pages", "gt": "many", "type": "number"})
+
+
+def test_bucket_stats_follow_inserts_and_deletes():
+    storage.create_bucket("empty")
+    first = upload("b", b"12345")
+    upload("b", b"123")
+    assert storage.get_bucket_stats("b")["record_count"] == 2
+    assert storage.get_bucket_stats("b")["total_bytes"] == 8
+    assert storage.get_bucket_stats("empty")["record_count"] == 0
+
+    storage.delete_record(first, "b")
+    assert storage.get_bucket_stats("b")["total_bytes"] == 3
+
+
+def test_delete_bucket_hides_then_purges():
+    file_id = upload("doomed")
+    storage.delete_bucket("doomed")
+    assert "doomed" not in storage.list_buckets()
+    assert storage.get_file_metadata_by_id(file_id, "doomed") is None
+    with pytest.raises(storage.BucketDeleting):
+        storage.create_bucket("doomed")
+
+    assert storage.purge_deleted_buckets() == 1
+    assert not os.path.exists(storage.get_bucket_path("doomed"))
+    storage.create_bucket("doomed")
+
+
+def test_record_cache_sees_changes_from_other_connections():
+    storage.insert_file_metadata("cached", "f.txt", "b", 0, {"v": 1})
+    assert storage.get_file_metadata_by_id("cached", "b")["metadata"] == {"v": 1}
+
+    # A separate connection stands in for another worker process
+    with storage._connect() as other:
+        other.execute("""UPDATE files SET metadata = '{"v": 2}' WHERE id = 'cached'""")
+    assert storage.get_file_metadata_by_id("cached", "b")["metadata"] == {"v": 2}
+
+
+def test_change_feed_records_creates_updates_and_expiry():
+    _, start = storage.get_changes()
+    kept = upload("b", ttl_seconds=3600)
+    expiring = upload("b", ttl_seconds=3600)
+    upload("other")
+    storage.update_metadata(kept, "b", {"v": 1})
+    with storage.get_db() as conn:
+        conn.execute("UPDATE files SET expires_at = 1 WHERE id = ?", (expiring,))
+    storage.purge_expired()
+    storage.delete_record(kept, "b")
+
+    changes, position = storage.get_changes(start, "b")
+    assert [(c["op"], c["id"]) for c in changes] == [
+        ("create", kept), ("create", expiring), ("update", kept), ("update", expiring),
+        ("expire", expiring), ("delete", kept),
+    ]
+    assert storage.get_changes(position, "b") == ([], position)
+
+    with storage.get_db() as conn:
+        conn.execute("UPDATE changes SET created_at = 0")
+    assert storage.purge_changes() > 0
+    with pytest.raises(storage.ChangesExpired):
+        storage.get_changes(start, "b")
+
+
+def test_webhooks_deliver_signed_batches_and_retry():
+    received, statuses = [], [200]
+
+    class Receiver(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append((dict(self.headers), self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(statuses[0])
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Receiver)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/hook"
+        storage.create_webhook("b", url, secret="s3cret")
+        storage.create_webhook("b", url, events=["expire"])
+        file_id = upload("b", metadata={"k": "v"})
+        upload("other")
+        dispatcher = WebhookDispatcher(workers=2, batch_size=10, queue_size=4)
+        asyncio.run(dispatcher.deliver_pending())
+
+        assert len(received) == 1
+        headers, body = received[0]
+        expected = hmac.new(b"s3cret", headers["X-Filenest-Timestamp"].encode() + b"." + body, hashlib.sha256)
+        assert headers["X-Filenest-Signature"] == f"sha256={expected.hexdigest()}"
+        [event] = json.loads(body)["events"]
+        assert (event["event"], event["id"], event["record"]["metadata"]) == ("create", file_id, {"k": "v"})
+
+        statuses[0] = 500
+        storage.delete_record(file_id, "b")
+        asyncio.run(dispatcher.deliver_pending())
+        assert len(received) == 2
+        hook = storage.list_webhooks("b")[0]
+        assert (hook["pending"], hook["last_error"]) == (1, "HTTP 500 Internal Server Error")
+    finally:
+        server.shutdown()
+
+
+def test_derivative_cache_evicts_least_recent_and_follows_deletes():
+    def add(key, record_id, size):
+        path = storage.get_derivative_path(key, "webp")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        return path, storage.add_derivative(key, record_id, "webp", (640, 480), max_bytes=250)
+
+    first, second = upload("b"), upload("b")
+    old_path, _ = add("aa01", first, 100)
+    with storage.get_db() as conn:
+        conn.execute("UPDATE derivatives SET last_access = 0")
+    kept_path, _ = add("aa02", second, 100)
+    new_path, added = add("aa03", first, 100)
+    assert added and storage.get_derivative("aa03") == (640, 480)
+    assert storage.get_derivative("aa01") is None and not os.path.exists(old_path)
+
+    storage.delete_record(first, "b")
+    assert storage.get_derivative("aa03") is None and not os.path.exists(new_path)
+    assert os.path.exists(kept_path)
+    _, added = add("aa04", first, 10)
+    assert not added and storage.get_derivative("aa04") is None
+
+
+def test_put_object_replaces_key_and_lists_prefixes():
+    def put(key, content):
+        upload_dir = storage.get_upload_dir("s3")
+        os.makedirs(upload_dir, exist_ok=True)
+        temp_path = os.path.join(upload_dir, f".upload-{uuid.uuid4().hex}")
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        return storage.put_object("s3", key, temp_path, len(content), "etag")
+
+    put("a/1.txt", b"one")
+    put("a/2.txt", b"two")
+    put("b.txt", b"b")
+    put("a/1.txt", b"uno")
+
+    record = storage.get_object_record("s3", "a/1.txt")
+    with open(storage.get_record_path(record), "rb") as f:
+        assert f.read() == b"uno"
+    listing = storage.list_objects("s3", delimiter="/")
+    assert [o["key"] for o in listing["objects"]] == ["b.txt"]
+    assert listing["common_prefixes"] == ["a/"]
+    assert [o["key"] for o in storage.list_objects("s3", prefix="a/")["objects"]] == ["a/1.txt", "a/2.txt"]
+
+
+def test_retried_multipart_completion_assembles_parts_once(monkeypatch):
+    upload_id = storage.create_multipart_upload("s3", "big.bin")
+    parts = []
+    for number, content in ((1, b"first-"), (2, b"second")):
+        part_dir = storage.get_multipart_path(upload_id)
+        os.makedirs(part_dir, exist_ok=True)
+        temp_path = os.path.join(part_dir, f".upload-{uuid.uuid4().hex}")
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        etag = hashlib.md5(content).hexdigest()
+        assert storage.put_part(upload_id, number, temp_path, len(content), etag)
+        parts.append((number, etag))
+
+    insert_record = storage._insert_record
+    def fail(*args, **kwargs):
+        raise storage.BucketDeleting("Bucket 's3' is being deleted")
+    monkeypatch.setattr(storage, "_insert_record", fail)
+    with pytest.raises(storage.BucketDeleting):
+        storage.complete_multipart_upload(upload_id, parts)
+    monkeypatch.setattr(storage, "_insert_record", insert_record)
+
+    # Another request holding the upload keeps this one out
+    assert storage.acquire_lock(f"multipart:{upload_id}", 60, owner="other-request")
+    with pytest.raises(storage.MultipartCompleting):
+        storage.complete_multipart_upload(upload_id, parts)
+    storage.release_lock(f"multipart:{upload_id}", owner="other-request")
+
+    _, file_id, _ = storage.complete_multipart_upload(upload_id, parts)
+    record = storage.get_object_record("s3", "big.bin")
+    assert record["id"] == file_id and record["size"] == 12
+    with open(storage.get_record_path(record), "rb") as f:
+        assert f.read() == b"first-second"
+    assert storage.complete_multipart_upload(upload_id, parts) is None
+
+
+def test_sharded_layout_keeps_duplicate_filenames_apart(monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_LAYOUT", "sharded")
+    first = upload("b", b"first", filename="same.txt")
+    second = upload("b", b"second", filename="same.txt")
+
+    for file_id, content in ((first, b"first"), (second, b"second")):
+        record = storage.get_file_metadata_by_id(file_id, "b")
+        assert record["location"] == ShardedBackend(settings.STORAGE_DIR).location("b", file_id, "same.txt")
+        with open(storage.get_record_path(record), "rb") as f:
+            assert f.read() == content
+
+
+def test_migrating_to_flat_skips_records_whose_filename_is_taken(monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_LAYOUT", "sharded")
+    first = upload("b", b"first", filename="same.txt")
+    second = upload("b", b"second", filename="same.txt")
+    copy = upload("b", b"first", filename="same.txt")
+
+    assert migrate("flat") == (2, 0, 1)
+    for file_id, content in ((first, b"first"), (second, b"second"), (copy, b"first")):
+        with open(storage.get_record_path(storage.get_file_metadata_by_id(file_id, "b")), "rb") as f:
+            assert f.read() == content
+    assert storage.get_file_metadata_by_id(second, "b")["location"].startswith("b/.shards/")
+    assert storage.get_file_metadata_by_id(copy, "b")["location"] == "b/same.txt"
@@ -0,0 +1,306 @@
+import os
+import hashlib
+import tempfile
+import time
+import aiofiles
+from dataclasses import dataclass
+from typing import Optional
+
+from executor import run_storage
+from metrics import UPLOAD_STAGE_SECONDS
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+# -----------------------------
+# Errors
+# -----------------------------
+
+class UploadError(ValueError):
+    """The request body is not an acceptable upload."""
+    status_code = 400
+
+class UploadTooLarge(UploadError):
+    status_code = 413
+
+# -----------------------------
+# Streamed Files
+# -----------------------------
+
+@dataclass
+class UploadedFile:
+    """An uploaded file written to a temporary path next to its final location."""
+    field: str
+    filename: str
+    path: Optional[str] = None
+    size: int = 0
+    sha256: Optional[str] = None
+    md5: Optional[str] = None
+    error: Optional[str] = None
+
+class _FileSink:
+    """
+    Writes one upload to a temp file in `dest_dir`, enforcing `max_size` as bytes arrive.
+
+    An oversized file raises UploadTooLarge, or with `strict=False` is dropped and
+    flagged with an error while the rest of the body keeps streaming.
+    The temp file is created by open(), which must be awaited before writing.
+    """
+
+    def __init__(self, field: str, filename: str, dest_dir: str, max_size: Optional[int], checksum: bool = False,
+                 strict: bool = True, md5: bool = False):
+        self.file = UploadedFile(field=field, filename=filename)
+        self.dest_dir = dest_dir
+        self.max_size = max_size
+        self.hasher = hashlib.sha256() if checksum else None
+        self.md5 = hashlib.md5() if md5 else None
+        self.strict = strict
+        self.out = None
+
+    async def open(self):
+        self.file.path = await run_storage(_create_temp_file, self.dest_dir)
+
+    async def write(self, data: bytes):
+        if self.file.error:
+            return
+        self.file.size += len(data)
+        if self.max_size is not None and self.file.size > self.max_size:
+            if self.strict:
+                raise UploadTooLarge("File too large")
+            self.file.error = "File too large"
+            self.hasher = None
+            await self.close()
+            await discard([self.file])
+            return
+        if self.out is None:
+            self.out = await aiofiles.open(self.file.path, "wb")
+        if self.hasher is not None:
+            self.hasher.update(data)
+        if self.md5 is not None:
+            self.md5.update(data)
+        await self.out.write(data)
+
+    async def close(self):
+        if self.out is not None:
+            await self.out.close()
+            self.out = None
+        if self.hasher is not None:
+            self.file.sha256 = self.hasher.hexdigest()
+        if self.md5 is not None:
+            self.file.md5 = self.md5.hexdigest()
+
+class _StageTimer:
+    """Splits the time spent streaming a body into awaiting chunks and handling them."""
+
+    def __init__(self):
+        self.mark = time.perf_counter()
+        self.receive = self.write = 0.0
+
+    def received(self):
+        now = time.perf_counter()
+        self.receive += now - self.mark
+        self.mark = now
+
+    def written(self):
+        now = time.perf_counter()
+        self.write += now - self.mark
+        self.mark = now
+
+    def observe(self):
+        UPLOAD_STAGE_SECONDS.observe(self.receive, stage="receive")
+        UPLOAD_STAGE_SECONDS.observe(self.write, stage="write")
+
+def _create_temp_file(dest_dir: str) -> str:
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=dest_dir, prefix=".upload-")
+    try:
+        os.fchmod(fd, 0o644)
+    finally:
+        os.close(fd)
+    return path
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+async def discard(files):
+    """Remove the temp files of uploads that will not be kept."""
+    paths = [file.path for file in files if file.path]
+    if paths:
+        await run_storage(_remove_files, paths)
+
+# -----------------------------
+# Multipart Streaming
+# -----------------------------
+
+# Largest plain (non-file) form field held in memory, the same cap as Starlette's form parser
+MAX_FIELD_SIZE = 1024 * 1024
+
+class _MultipartReader:
+    """
+    Feeds the request stream through python-multipart, writing file parts
+    straight to disk instead of spooling them first.
+    """
+
+    def __init__(self, dest_dir: str, max_file_size: Optional[int], checksum: bool = False,
+                 max_files: Optional[int] = None):
+        self.dest_dir = dest_dir
+        self.max_file_size = max_file_size
+        self.checksum = checksum
+        self.max_files = max_files
+        self.fields = {}
+        self.files = []
+        self._sinks = []
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._sink = None
+        self._value = bytearray()
+        self._opening = []
+        self._pending = []
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._sink = None
+        self._value = bytearray()
+
+    def on_header_field(self, data, start, end):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise UploadError('The Content-Disposition header field "name" must be provided.')
+        self._field = options[b"name"].decode("utf-8", "replace")
+        if b"filename" in options:
+            if self.max_files is not None and len(self._sinks) >= self.max_files:
+                raise UploadTooLarge(f"Too many files, the maximum is {self.max_files}")
+            filename = options[b"filename"].decode("utf-8", "replace")
+            self._sink = _FileSink(self._field, filename, self.dest_dir, self.max_file_size, self.checksum,
+                                   strict=self.max_files is None)
+            self._sinks.append(self._sink)
+            self._opening.append(self._sink)
+
+    def on_part_data(self, data, start, end):
+        if self._sink is None:
+            if len(self._value) + end - start > MAX_FIELD_SIZE:
+                raise UploadTooLarge(f"Form field '{self._field}' exceeds {MAX_FIELD_SIZE} bytes")
+            self._value += data[start:end]
+        else:
+            self._pending.append((self._sink, data[start:end]))
+
+    def on_part_end(self):
+        if self._sink is None:
+            self.fields[self._field] = self._value.decode("utf-8", "replace")
+        else:
+            self.files.append(self._sink.file)
+
+    async def _flush(self):
+        # The parser callbacks are synchronous; temp files are created and written here so they can be awaited
+        for sink in self._opening:
+            await sink.open()
+        self._opening.clear()
+        for sink, data in self._pending:
+            await sink.write(data)
+        self._pending.clear()
+
+    async def read(self, request):
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise UploadError("Expected a multipart/form-data body")
+
+        parser = multipart.MultipartParser(params[b"boundary"], {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        })
+        timer = _StageTimer()
+        try:
+            async for chunk in request.stream():
+                timer.received()
+                parser.write(chunk)
+                await self._flush()
+                timer.written()
+            parser.finalize()
+            await self._flush()
+            timer.observe()
+        except Exception as e:
+            for sink in self._sinks:
+                await sink.close()
+            await discard(sink.file for sink in self._sinks)
+            if isinstance(e, FormParserError):
+                raise UploadError(f"Malformed multipart body: {e}")
+            raise
+        for sink in self._sinks:
+            await sink.close()
+        return self.fields, self.files
+
+async def stream_multipart(request, dest_dir: str, max_file_size: Optional[int] = None, checksum: bool = False,
+                           max_files: Optional[int] = None):
+    """
+    Parse a multipart/form-data request while streaming its file parts to temp
+    files in `dest_dir`, so each byte is written to disk exactly once and can
+    be moved into place with os.replace.
+
+    Returns (fields, files): a dict of the plain form fields and a list of
+    UploadedFile. The caller owns the temp files and must move or discard them.
+    Raises UploadTooLarge as soon as a file part exceeds `max_file_size`, or a
+    plain field MAX_FIELD_SIZE.
+    With `checksum`, each file's SHA-256 is computed as it streams.
+
+    Passing `max_files` switches to batch mode: more file parts than that raise
+    UploadTooLarge, while an oversized file is dropped and returned with its
+    `error` set instead of failing the whole request.
+    """
+    return await _MultipartReader(dest_dir, max_file_size, checksum, max_files).read(request)
+
+# -----------------------------
+# Raw Body Streaming
+# -----------------------------
+
+async def stream_body(request, dest_dir: str, max_size: Optional[int] = None, filename: str = ""):
+    """
+    Stream a raw request body (an S3 PUT) to a temp file in `dest_dir`, computing
+    its MD5 on the way. Returns an UploadedFile the caller must move or discard.
+    Raises UploadTooLarge as soon as the body exceeds `max_size`.
+    """
+    length = request.headers.get("content-length")
+    if max_size is not None and length and length.isdigit() and int(length) > max_size:
+        raise UploadTooLarge("Body too large")
+    sink = _FileSink("body", filename, dest_dir, max_size, md5=True)
+    await sink.open()
+    timer = _StageTimer()
+    try:
+        async for chunk in request.stream():
+            timer.received()
+            await sink.write(chunk)
+            timer.written()
+        timer.observe()
+    except BaseException:
+        await sink.close()
+        await discard([sink.file])
+        raise
+    await sink.close()
+    return sink.file
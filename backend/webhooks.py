@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import settings
+from executor import run_storage
+from metrics import WEBHOOK_EVENTS_SENT, WEBHOOK_REQUEST_SECONDS
+from storage import claim_webhook_deliveries, finish_webhook_deliveries, retry_webhook_deliveries
+
+# -----------------------------
+# Delivery
+# -----------------------------
+
+def sign(secret: str, timestamp: str, body: bytes) -> str:
+    """Signature of a delivery: HMAC-SHA256 over "<timestamp>.<body>" with the subscription secret."""
+    return hmac.new(secret.encode(), timestamp.encode() + b"." + body, hashlib.sha256).hexdigest()
+
+def post(url: str, secret: str, body: bytes, timeout: float):
+    """POST one batch; raises unless the receiver answers 2xx."""
+    timestamp = str(int(time.time()))
+    request = urllib.request.Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "User-Agent": "filenest-webhooks",
+        "X-Filenest-Timestamp": timestamp,
+        "X-Filenest-Signature": f"sha256={sign(secret, timestamp, body)}",
+    })
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+
+def retry_delay(attempts: int) -> int:
+    """Exponential backoff with jitter, so failing receivers are not hit in lockstep."""
+    delay = min(settings.WEBHOOK_RETRY_BASE_SEC * 2 ** (attempts - 1), settings.WEBHOOK_RETRY_MAX_SEC)
+    return max(1, int(delay * random.uniform(0.5, 1.0)))
+
+def describe_error(error: Exception) -> str:
+    if isinstance(error, urllib.error.HTTPError):
+        return f"HTTP {error.code} {error.reason}"
+    if isinstance(error, urllib.error.URLError):
+        return str(error.reason)
+    return f"{type(error).__name__}: {error}"
+
+# -----------------------------
+# Dispatcher
+# -----------------------------
+
+class WebhookDispatcher:
+    """
+    Delivers the webhook outbox in the background, so requests only pay for the
+    outbox rows their triggers insert.
+
+    The dispatcher claims due rows with a lease, groups them into batches per
+    subscription and queues the batches in a bounded asyncio.Queue; `workers` tasks
+    send them over urllib in a thread pool. Each subscription has at most one batch
+    in flight per process. Every worker process may run a dispatcher: claims are
+    atomic, and a batch whose lease runs out unsettled is sent again, so delivery
+    is at least once and receivers should dedupe on `seq`.
+    """
+
+    def __init__(self, workers: int, batch_size: int, queue_size: int):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self._executor = None
+        self._in_flight = set()  # Webhook ids with a batch queued or being sent
+
+    @property
+    def lease_seconds(self) -> int:
+        # Long enough for a batch to wait behind a full queue and then time out
+        return settings.WEBHOOK_TIMEOUT_SEC * (self.queue_size // self.workers + 2)
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="filenest-webhooks")
+        return self._executor
+
+    async def _claim(self, max_batches: int) -> list[list[dict]]:
+        return await run_storage(
+            claim_webhook_deliveries, max_batches, self.batch_size, self.lease_seconds, list(self._in_flight)
+        )
+
+    async def deliver(self, batch: list[dict]):
+        """Send one batch and settle its outbox rows."""
+        first = batch[0]
+        ids = [delivery["id"] for delivery in batch]
+        body = json.dumps({"webhook_id": first["webhook_id"], "events": [d["event"] for d in batch]}).encode()
+        loop = asyncio.get_running_loop()
+        try:
+            with WEBHOOK_REQUEST_SECONDS.time():
+                await loop.run_in_executor(
+                    self._pool(), post, first["url"], first["secret"], body, settings.WEBHOOK_TIMEOUT_SEC
+                )
+        except Exception as e:
+            attempts = max(delivery["attempts"] for delivery in batch) + 1
+            await run_storage(retry_webhook_deliveries, ids, describe_error(e), retry_delay(attempts),
+                              settings.WEBHOOK_MAX_ATTEMPTS)
+            result = "failed" if attempts >= settings.WEBHOOK_MAX_ATTEMPTS else "retry"
+            WEBHOOK_EVENTS_SENT.inc(len(batch), result=result)
+        else:
+            await run_storage(finish_webhook_deliveries, ids)
+            WEBHOOK_EVENTS_SENT.inc(len(batch), result="delivered")
+
+    async def deliver_pending(self):
+        """Send every due event now, one batch at a time. Used by tests and one-off runs."""
+        while batches := await self._claim(self.queue_size):
+            for batch in batches:
+                await self.deliver(batch)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            batch = await queue.get()
+            try:
+                await self.deliver(batch)
+            except Exception as e:
+                # The lease runs out and the batch is claimed again
+                print(f"[ERROR] Webhook delivery failed: {e}")
+            finally:
+                self._in_flight.discard(batch[0]["webhook_id"])
+                queue.task_done()
+
+    async def run(self):
+        """Claim and queue due events for the lifetime of the app."""
+        queue = asyncio.Queue(self.queue_size)
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.workers)]
+        try:
+            while True:
+                try:
+                    free = self.queue_size - queue.qsize()
+                    batches = await self._claim(free) if free > 0 else []
+                    for batch in batches:
+                        self._in_flight.add(batch[0]["webhook_id"])
+                        await queue.put(batch)
+                except Exception as e:
+                    print(f"[ERROR] Webhook dispatch failed: {e}")
+                    batches = []
+                # Keep claiming without pause while there is a backlog
+                if not batches:
+                    await asyncio.sleep(settings.WEBHOOK_POLL_INTERVAL_MS / 1000)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self._in_flight.clear()
+
+webhook_dispatcher = WebhookDispatcher(
+    settings.WEBHOOK_WORKERS, settings.WEBHOOK_BATCH_SIZE, settings.WEBHOOK_QUEUE_SIZE
+)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+Reproducible load benchmark for the record API and storage layer.
+
+Seeds --records records across --buckets buckets directly through `storage`, then
+drives each operation (upload, get, search, patch, delete, cleanup) against the
+FastAPI app in-process (httpx ASGI transport: no network, no server) with
+--concurrency requests in flight, and reports p50/p99 latency and throughput.
+
+Every run uses a throwaway database and storage directory. With --output the
+results are written as JSON, and --compare prints the change against an earlier
+results file, so regressions between versions show up side by side.
+
+Usage: python test/benchmark.py [--records 10000] [--buckets 10] [--concurrency 16]
+                                [--requests 1000] [--output results.json] [--compare old.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+
+WORKDIR = tempfile.mkdtemp(prefix="filenest-bench-")
+os.environ.setdefault("DB_PATH", os.path.join(WORKDIR, "db.sqlite"))
+os.environ.setdefault("STORAGE_DIR", os.path.join(WORKDIR, "storage"))
+os.environ.setdefault("CLEANUP_INTERVAL_SEC", "0")
+os.makedirs(os.environ["STORAGE_DIR"], exist_ok=True)
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+import httpx  # noqa: E402
+
+import storage  # noqa: E402
+from main import app  # noqa: E402
+
+OPERATIONS = ("upload", "get", "search", "patch", "delete", "cleanup")
+HEADERS = {"x-api-key": storage.settings.API_KEY}
+GROUPS = 100
+
+
+def log(msg):
+    print(f"\033[1;33m[INFO]\033[0m {msg}")
+
+
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def summarize(latencies, errors, elapsed, items=None):
+    """Latency percentiles (ms) and throughput; `items` counts work units when one request does many."""
+    latencies = sorted(latencies)
+    done = items if items is not None else len(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+        "throughput_per_sec": round(done / elapsed, 1) if elapsed else None,
+    }
+
+
+# -----------------------------
+# Seeding
+# -----------------------------
+
+def seed(records, buckets, size, batch_size=1000):
+    """Insert records straight through storage.store_records. Returns {bucket: [ids]}."""
+    payload = os.urandom(size)
+    ids = {f"bench-{b}": [] for b in range(buckets)}
+    names = list(ids)
+    for start in range(0, records, batch_size):
+        by_bucket = {}
+        for i in range(start, min(start + batch_size, records)):
+            bucket = names[i % buckets]
+            upload_dir = storage.get_upload_dir(bucket)
+            os.makedirs(upload_dir, exist_ok=True)
+            temp_path = os.path.join(upload_dir, f".upload-seed-{i}")
+            with open(temp_path, "wb") as f:
+                f.write(payload)
+            by_bucket.setdefault(bucket, []).append({
+                "id": str(uuid.uuid4()), "filename": f"seed_{i}.bin", "ttl_seconds": 0,
+                "metadata": {"index": i, "group": i % GROUPS}, "temp_path": temp_path, "size": size, "sha256": None,
+            })
+        for bucket, items in by_bucket.items():
+            storage.store_records(bucket, items)
+            ids[bucket].extend(item["id"] for item in items)
+    return ids
+
+
+# -----------------------------
+# Load
+# -----------------------------
+
+async def drive(count, concurrency, request):
+    """Run request(i) for i in range(count) with `concurrency` in flight. Returns (latencies, errors, elapsed)."""
+    latencies, errors = [], 0
+    pending = iter(range(count))
+
+    async def worker():
+        nonlocal errors
+        for i in pending:
+            started = time.perf_counter()
+            try:
+                response = await request(i)
+                ok = response.status_code < 400
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def expire(count):
+    """Mark up to `count` seeded records as expired so the cleanup pass has work to do."""
+    with storage.get_db() as conn:
+        return conn.execute(
+            "UPDATE files SET expires_at = 1 WHERE rowid IN (SELECT rowid FROM files WHERE expires_at IS NULL LIMIT ?)",
+            (count,)
+        ).rowcount
+
+
+async def run(args, ids):
+    rng = random.Random(args.seed)
+    buckets = list(ids)
+    pool = [(bucket, record_id) for bucket in buckets for record_id in ids[bucket]]
+    rng.shuffle(pool)
+    payload = os.urandom(args.size)
+    results = {}
+
+    async def upload(i):
+        return await client.post(
+            f"/api/v1/buckets/{buckets[i % len(buckets)]}/records/", headers=HEADERS,
+            files={"file": (f"upload_{i}.bin", payload)},
+            data={"metadata_json": json.dumps({"index": i, "group": i % GROUPS})},
+        )
+
+    async def get(i):
+        bucket, record_id = pool[i % len(pool)]
+        return await client.get(f"/api/v1/buckets/{bucket}/records/{record_id}", headers=HEADERS)
+
+    async def search(i):
+        return await client.get(
+            f"/api/v1/buckets/{buckets[i % len(buckets)]}/records", headers=HEADERS,
+            params={"key": "group", "value": str(i % GROUPS), "value_type": "number", "limit": 50},
+        )
+
+    async def patch(i):
+        bucket, record_id = pool[i % len(pool)]
+        return await client.patch(f"/api/v1/buckets/{bucket}/records/{record_id}/metadata/fields",
+                                  headers=HEADERS, json={"fields": {"bench": i}})
+
+    # Deletes take ids from the end of the pool, so each request removes a distinct record
+    async def delete(i):
+        bucket, record_id = pool[-1 - i]
+        return await client.delete(f"/api/v1/buckets/{bucket}/records/{record_id}", headers=HEADERS)
+
+    requests = {"upload": upload, "get": get, "search": search, "patch": patch, "delete": delete}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for operation in args.operations:
+            if operation == "cleanup":
+                expired = expire(args.requests)
+                started = time.perf_counter()
+                response = await client.post("/cleanup-expired")
+                elapsed = time.perf_counter() - started
+                results["cleanup"] = summarize([elapsed], int(response.status_code >= 400), elapsed,
+                                               items=response.json().get("removed", expired))
+            else:
+                count = min(args.requests, len(pool)) if operation == "delete" else args.requests
+                latencies, errors, elapsed = await drive(count, args.concurrency, requests[operation])
+                results[operation] = summarize(latencies, errors, elapsed)
+            log(f"{operation:>7}  {format_result(results[operation])}")
+    return results
+
+
+# -----------------------------
+# Reporting
+# -----------------------------
+
+def format_result(result):
+    return (f"p50 {result['p50_ms']:9.3f} ms  p99 {result['p99_ms']:9.3f} ms  "
+            f"{result['throughput_per_sec']:10.1f}/s  errors {result['errors']}")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    settings = storage.settings
+    return {
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {name: getattr(settings, name) for name in (
+            "DB_POOL", "STORAGE_WORKERS", "STORAGE_LAYOUT", "CONTENT_ADDRESSED_STORAGE", "CACHE_MAX_ENTRIES",
+            "METRICS_ENABLED",
+        )},
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    print(f"\nChange against {baseline_path} (p50 / p99 latency, throughput):")
+    for operation, result in results.items():
+        old = baseline.get(operation)
+        if not old:
+            continue
+        change = lambda key: f"{(result[key] - old[key]) / old[key] * 100:+7.1f}%" if old.get(key) else "    n/a"
+        print(f"{operation:>7}  p50 {change('p50_ms')}  p99 {change('p99_ms')}  "
+              f"throughput {change('throughput_per_sec')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000, help="Records seeded before the run")
+    parser.add_argument("--buckets", type=int, default=10, help="Buckets the records are spread over")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per operation (records expired for cleanup)")
+    parser.add_argument("--size", type=int, default=1024, help="File size in bytes")
+    parser.add_argument("--operations", type=lambda s: s.split(","), default=list(OPERATIONS),
+                        help=f"Comma-separated subset of {','.join(OPERATIONS)}")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the request mix")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Print the change against an earlier --output file")
+    args = parser.parse_args()
+    unknown = set(args.operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"Unknown operations: {', '.join(sorted(unknown))}")
+
+    log(f"Working directory: {WORKDIR}")
+    try:
+        started = time.perf_counter()
+        ids = seed(args.records, args.buckets, args.size)
+        seconds = time.perf_counter() - started
+        log(f"Seeded {args.records} records in {args.buckets} buckets in {seconds:.2f}s")
+        results = asyncio.run(run(args, ids))
+    finally:
+        storage.close_db()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "environment": environment(),
+        "seed_seconds": round(seconds, 3),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        log(f"Results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()